@@ -8,6 +8,7 @@ def main():
     parser = argparse.ArgumentParser(description='Create Biaffine Dependency Parser.')
     parser.add_argument('--tree', action='store_true', help='whether to ensure well-formedness')
     parser.add_argument('--proj', action='store_true', help='whether to projectivise the data')
+    parser.add_argument('--fast-mst', action='store_true', help='whether to decode non-projective trees in O(n^2)')
     parser.add_argument('--partial', action='store_true', help='whether partial annotation is included')
     parser.set_defaults(Parser=BiaffineDependencyParser)
     subparsers = parser.add_subparsers(title='Commands', dest='mode')
@@ -18,6 +19,8 @@ def main():
     subparser.add_argument('--max-len', type=int, help='max length of the sentences')
     subparser.add_argument('--buckets', default=32, type=int, help='max num of buckets to use')
     subparser.add_argument('--train', default='data/ptb/train.conllx', help='path to train file')
+    subparser.add_argument('--stream', default=0, type=int,
+                           help='size of the buffer for streaming the train shards matching --train, 0 to disable')
     subparser.add_argument('--dev', default='data/ptb/dev.conllx', help='path to dev file')
     subparser.add_argument('--test', default='data/ptb/test.conllx', help='path to test file')
     subparser.add_argument('--embed', default='data/glove.6B.100d.txt', help='path to pretrained embeddings')
@@ -27,12 +30,20 @@ def main():
     subparser.add_argument('--epochs', default=5000, type=int)
     subparser.add_argument('--elmo_weights', help='weights file, for elmoformanylangs path to folder containing model' )
     subparser.add_argument('--elmo_options', help='options file, leave empty if using elmoformanylangs')
+    subparser.add_argument('--elmo-cache', help='path prefix of the on-disk cache of elmo representations')
+    subparser.add_argument('--elmo-types', action='store_true', help='whether to cache elmo layer 0 per word type')
+    subparser.add_argument('--elmo-types-size', type=int, help='max num of word types cached, unbounded if not set')
+    subparser.add_argument('--elmo-mix', action='store_true', help='whether to mix elmo layers instead of concatenating them')
+    subparser.add_argument('--n-elmo-proj', default=0, type=int,
+                           help='dimension of projected elmo mixture, 0 for no projection')
     subparser.add_argument('--map-layer0', help='path to mapping model for layer0')
     subparser.add_argument('--map-layer1', help='path to mapping model for layer1')
     subparser.add_argument('--map-layer2', help='path to mapping model for layer2')
     subparser.add_argument('--map-method', choices=['vecmap', 'elmogan', 'muse', 'none'], default='none')
     subparser.add_argument('--vecmap-lang', help='was data language source(src) or target(trg) during mapping (vecmap only)')
     subparser.add_argument('--orthogonal', action='store_true', help='use only orthogonal vecmap mapping, without extra processing')
+    subparser.add_argument('--map-in-model', action='store_true',
+                           help='whether to apply the mapping as a frozen layer of the model (vecmap and muse only)')
     # evaluate
     subparser = subparsers.add_parser('evaluate', help='Evaluate the specified parser and dataset.')
     subparser.add_argument('--punct', action='store_true', help='whether to include punctuation')
@@ -40,6 +51,9 @@ def main():
     subparser.add_argument('--data', default='data/ptb/test.conllx', help='path to dataset')
     subparser.add_argument('--elmo_weights', help='weights file, for elmoformanylangs path to folder containing model' )
     subparser.add_argument('--elmo_options', help='options file, leave empty if using elmoformanylangs')
+    subparser.add_argument('--elmo-cache', help='path prefix of the on-disk cache of elmo representations')
+    subparser.add_argument('--elmo-types', action='store_true', help='whether to cache elmo layer 0 per word type')
+    subparser.add_argument('--elmo-types-size', type=int, help='max num of word types cached, unbounded if not set')
     subparser.add_argument('--map-layer0', help='path to mapping model for layer0')
     subparser.add_argument('--map-layer1', help='path to mapping model for layer1')
     subparser.add_argument('--map-layer2', help='path to mapping model for layer2')
@@ -53,8 +67,12 @@ def main():
     subparser.add_argument('--buckets', default=8, type=int, help='max num of buckets to use')
     subparser.add_argument('--data', default='data/ptb/test.conllx', help='path to dataset')
     subparser.add_argument('--pred', default='pred.conllx', help='path to predicted result')
+    subparser.add_argument('--window', default=0, type=int, help='num of sentences to stream at a time, 0 to load all data')
     subparser.add_argument('--elmo_weights', help='weights file, for elmoformanylangs path to folder containing model' )
     subparser.add_argument('--elmo_options', help='options file, leave empty if using elmoformanylangs')
+    subparser.add_argument('--elmo-cache', help='path prefix of the on-disk cache of elmo representations')
+    subparser.add_argument('--elmo-types', action='store_true', help='whether to cache elmo layer 0 per word type')
+    subparser.add_argument('--elmo-types-size', type=int, help='max num of word types cached, unbounded if not set')
     subparser.add_argument('--map-layer0', help='path to mapping model for layer0')
     subparser.add_argument('--map-layer1', help='path to mapping model for layer1')
     subparser.add_argument('--map-layer2', help='path to mapping model for layer2')
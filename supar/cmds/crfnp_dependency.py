@@ -10,6 +10,8 @@ def main():
     parser = argparse.ArgumentParser(description='Create Non-projective CRF Dependency Parser.')
     parser.set_defaults(Parser=CRFNPDependencyParser)
     parser.add_argument('--mbr', action='store_true', help='whether to use MBR decoding')
+    parser.add_argument('--fast-mst', action='store_true',
+                        help='whether to ensure well-formedness by decoding trees in O(n^2)')
     subparsers = parser.add_subparsers(title='Commands', dest='mode')
     subparser = subparsers.add_parser('train', help='Train a parser.')
     subparser.add_argument('--feat', '-f', choices=['tag', 'char', 'bert'], help='choices of additional features')
@@ -13,6 +13,14 @@ def parse(parser):
     parser.add_argument('--seed', '-s', default=1, type=int, help='seed for generating random numbers')
     parser.add_argument('--threads', '-t', default=16, type=int, help='max num of threads')
     parser.add_argument('--batch-size', default=5000, type=int, help='batch size')
+    parser.add_argument('--prefetch', default=0, type=int, help='num of batches to prepare in background')
+    parser.add_argument('--data-cache', help='dir to cache the numericalized data in')
+    parser.add_argument('--workers', default=0, type=int, help='num of processes to load and numericalize data with')
+    parser.add_argument('--cost-aware', action='store_true', help='whether to budget batches by the parsing cost')
+    parser.add_argument('--columnar', action='store_true', help='whether to store the loaded sentences in columns')
+    parser.add_argument('--decode-workers', default=0, type=int,
+                        help='num of processes to decode trees with, 0 to decode in the main process')
+    parser.add_argument('--overlap', action='store_true', help='whether to run the model a batch ahead of decoding')
     parser.add_argument("--local_rank", type=int, default=-1, help='node rank for distributed training')
     args, unknown = parser.parse_known_args()
     args, _ = parser.parse_known_args(unknown, args)
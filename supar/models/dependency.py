@@ -3,12 +3,11 @@
 import torch
 import torch.nn as nn
 from supar.modules import (LSTM, MLP, BertEmbedding, Biaffine, CharLSTM,
-                           Triaffine)
+                           ElmoMapping, ScalarMix, Triaffine)
 from supar.modules.dropout import IndependentDropout, SharedDropout
 from supar.modules.treecrf import CRF2oDependency, CRFDependency, MatrixTree
 from supar.utils import Config
-from supar.utils.alg import eisner, eisner2o, mst
-from supar.utils.transform import CoNLL
+from supar.utils.alg import eisner, eisner2o, istree, mst
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
@@ -49,6 +48,17 @@ class BiaffineDependencyModel(nn.Module):
             Default: 4.
         mix_dropout (float):
             The dropout ratio of BERT layers. Required if ``feat='bert'``. Default: .0.
+        elmo_mix (bool):
+            If ``True`` and ``feat='elmo'``, the three ELMo layers are combined into a single 1024-dim vector
+            by :class:`~supar.modules.ScalarMix` instead of being concatenated. Default: ``False``.
+        n_elmo_proj (int):
+            If positive, the mixed ELMo representations are projected to this size. Only used if ``elmo_mix=True``.
+            Default: 0.
+        mapping (str):
+            Specifies the cross-lingual mapping of ELMo layers applied inside the model if ``feat='elmo'``:
+            ``'vecmap'`` | ``'muse'``. The matrices are frozen and loaded from the mapper by the parser.
+            The mapping is applied during training only if ``'vecmap'`` is used.
+            Default: ``None``.
         embed_dropout (float):
             The dropout ratio of input embeddings. Default: .33.
         n_lstm_hidden (int):
@@ -87,6 +97,9 @@ class BiaffineDependencyModel(nn.Module):
                  bert=None,
                  n_bert_layers=4,
                  mix_dropout=.0,
+                 elmo_mix=False,
+                 n_elmo_proj=0,
+                 mapping=None,
                  embed_dropout=.33,
                  n_lstm_hidden=400,
                  n_lstm_layers=3,
@@ -122,12 +135,19 @@ class BiaffineDependencyModel(nn.Module):
         elif feat == 'elmo':
             self.n_feat_embed = 3*1024
             self.n_embed = 0
+            if mapping is not None:
+                self.mapping = ElmoMapping(n_layers=3, n_embed=1024, normalize=mapping == 'vecmap')
+            if elmo_mix:
+                # mix the layers rather than concatenating them, which shrinks the inputs of the lstm
+                self.elmo_mix = ScalarMix(n_layers=3, dropout=mix_dropout)
+                self.elmo_proj = nn.Linear(1024, n_elmo_proj, False) if n_elmo_proj > 0 else nn.Identity()
+                self.n_feat_embed = n_elmo_proj if n_elmo_proj > 0 else 1024
         else:
             raise RuntimeError("The feat type should be in ['char', 'bert', 'tag'].")
         self.embed_dropout = IndependentDropout(p=embed_dropout)
 
         # the lstm layer
-        self.lstm = LSTM(input_size=n_embed+n_feat_embed,
+        self.lstm = LSTM(input_size=self.n_feat_embed if feat == 'elmo' else n_embed+n_feat_embed,
                          hidden_size=n_lstm_hidden,
                          num_layers=n_lstm_layers,
                          bidirectional=True,
@@ -184,6 +204,12 @@ class BiaffineDependencyModel(nn.Module):
         if hasattr(self, 'pretrained'):
             word_embed += self.pretrained(words)
         #feat_embed = self.feat_embed(feats)
+        if hasattr(self, 'mapping') and self.mapping.enabled and (not self.training or self.args.mapping == 'vecmap'):
+            # the elmo representation of each token is placed one position ahead of the token
+            feats = self.mapping(feats, torch.cat((mask[:, 1:], mask.new_zeros(batch_size, 1)), 1))
+        if hasattr(self, 'elmo_mix'):
+            # [batch_size, seq_len, n_elmo_proj]
+            feats = self.elmo_proj(self.elmo_mix(feats.view(batch_size, seq_len, 3, -1).unbind(2)))
         word_embed, feat_embed = self.embed_dropout(word_embed, feats)
         # concatenate the word and feat representations
         #word_embed = torch.Tensor([[[v for v in token] for token in sentence[0]] for sentence in words])
@@ -243,7 +269,7 @@ class BiaffineDependencyModel(nn.Module):
 
         return arc_loss + rel_loss
 
-    def decode(self, s_arc, s_rel, mask, tree=False, proj=False):
+    def decode(self, s_arc, s_rel, mask, tree=False, proj=False, fast=False, pool=None):
         r"""
         Args:
             s_arc (~torch.Tensor): ``[batch_size, seq_len, seq_len]``.
@@ -256,19 +282,25 @@ class BiaffineDependencyModel(nn.Module):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast (bool):
+                If ``True``, decodes non-projective trees with the :math:`O(n^2)` ChuLiu/Edmonds algorithm.
+                Default: ``False``.
+            pool (~multiprocessing.pool.Pool):
+                If specified, non-projective trees are decoded in parallel by the workers of the pool.
+                Default: ``None``.
 
         Returns:
             ~torch.Tensor, ~torch.Tensor:
                 Predicted arcs and labels of shape ``[batch_size, seq_len]``.
         """
 
-        lens = mask.sum(1)
         arc_preds = s_arc.argmax(-1)
-        bad = [not CoNLL.istree(seq[1:i+1], proj)
-               for i, seq in zip(lens.tolist(), arc_preds.tolist())]
-        if tree and any(bad):
-            alg = eisner if proj else mst
-            arc_preds[bad] = alg(s_arc[bad], mask[bad])
+        bad = ~istree(arc_preds, mask, proj)
+        if tree and bad.any():
+            if proj:
+                arc_preds[bad] = eisner(s_arc[bad], mask[bad])
+            else:
+                arc_preds[bad] = mst(s_arc[bad], mask[bad], fast=fast, pool=pool)
         rel_preds = s_rel.argmax(-1).gather(-1, arc_preds.unsqueeze(-1)).squeeze(-1)
 
         return arc_preds, rel_preds
@@ -676,11 +708,9 @@ class CRF2oDependencyModel(BiaffineDependencyModel):
                 Predicted arcs and labels of shape ``[batch_size, seq_len]``.
         """
 
-        lens = mask.sum(1)
         arc_preds = s_arc.argmax(-1)
-        bad = [not CoNLL.istree(seq[1:i+1], proj)
-               for i, seq in zip(lens.tolist(), arc_preds.tolist())]
-        if tree and any(bad):
+        bad = ~istree(arc_preds, mask, proj)
+        if tree and bad.any():
             if proj and not mbr:
                 arc_preds = eisner2o((s_arc, s_sib), mask)
             else:
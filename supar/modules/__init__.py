@@ -5,10 +5,11 @@ from .bert import BertEmbedding
 from .char_lstm import CharLSTM
 from .dropout import IndependentDropout, SharedDropout
 from .lstm import LSTM
+from .mapping import ElmoMapping
 from .mlp import MLP
 from .scalar_mix import ScalarMix
 from .treecrf import (CRF2oDependency, CRFConstituency, CRFDependency,
                       MatrixTree)
 
-__all__ = ['MLP', 'BertEmbedding', 'Biaffine', 'CharLSTM', 'CRF2oDependency', 'CRFConstituency',
-           'CRFDependency', 'IndependentDropout', 'LSTM', 'MatrixTree', 'ScalarMix', 'SharedDropout', 'Triaffine']
+__all__ = ['MLP', 'BertEmbedding', 'Biaffine', 'CharLSTM', 'CRF2oDependency', 'CRFConstituency', 'CRFDependency',
+           'ElmoMapping', 'IndependentDropout', 'LSTM', 'MatrixTree', 'ScalarMix', 'SharedDropout', 'Triaffine']
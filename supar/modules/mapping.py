@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ElmoMapping(nn.Module):
+    r"""
+    Frozen cross-lingual mapping of ELMo layers, which maps each layer by a fixed linear transformation.
+    The matrices are kept as buffers, so they follow the device and dtype of the model
+    and are saved in its state dict, but are never updated by the optimizer.
+
+    Args:
+        n_layers (int):
+            The number of ELMo layers. Default: 3.
+        n_embed (int):
+            The size of each ELMo layer. Default: 1024.
+        normalize (bool):
+            If ``True``, the tokens of each sentence are length normalized, mean centered
+            and length normalized again before mapping, as done by Vecmap. Default: ``False``.
+    """
+
+    def __init__(self, n_layers=3, n_embed=1024, normalize=False):
+        super().__init__()
+
+        self.n_layers = n_layers
+        self.n_embed = n_embed
+        self.normalize = normalize
+        # the stored matrices are only valid for the mapping the model was trained with, see `forward` of the model
+        self.enabled = True
+
+        self.register_buffer('weight', torch.eye(n_embed).repeat(n_layers, 1, 1))
+        # whether the matrices have been loaded, which is saved along with them
+        self.register_buffer('loaded', torch.tensor(False))
+
+    def __repr__(self):
+        s = f"n_layers={self.n_layers}, n_embed={self.n_embed}"
+        if self.normalize:
+            s += f", normalize={self.normalize}"
+
+        return f"{self.__class__.__name__}({s})"
+
+    @torch.no_grad()
+    def load(self, weights):
+        r"""
+        Args:
+            weights (list):
+                The matrices of shape ``[n_embed, n_embed]`` that map each layer by ``x @ W``.
+                Layers whose matrices are ``None`` are left unmapped.
+        """
+
+        self.weight.copy_(torch.eye(self.n_embed).repeat(self.n_layers, 1, 1))
+        for i, weight in enumerate(weights):
+            if weight is not None:
+                self.weight[i].copy_(torch.as_tensor(weight))
+        self.loaded.fill_(True)
+        return self
+
+    def forward(self, x, mask):
+        r"""
+        Args:
+            x (~torch.Tensor): ``[batch_size, seq_len, n_layers*n_embed]``.
+                The concatenated ELMo layers.
+            mask (~torch.BoolTensor): ``[batch_size, seq_len]``.
+                The mask for covering the unpadded representations.
+
+        Returns:
+            ~torch.Tensor:
+                The mapped representations of the same shape as ``x``, with padded positions zeroed.
+        """
+
+        batch_size, seq_len, _ = x.shape
+        mask = mask.view(batch_size, seq_len, 1, 1).to(x.dtype)
+        x = x.view(batch_size, seq_len, self.n_layers, self.n_embed)
+        if self.normalize:
+            x = F.normalize(x, dim=-1)
+            x = x - (x * mask).sum(1, True) / mask.sum(1, True).clamp(min=1)
+            x = F.normalize(x, dim=-1)
+        # [batch_size, seq_len, n_layers, n_embed]
+        x = torch.einsum('bsli,lio->bslo', x, self.weight) * mask
+
+        return x.reshape(batch_size, seq_len, -1)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import glob
 import os
 
 import torch
@@ -8,6 +9,7 @@ from supar.models import BiaffineDependencyModel
 from supar.parsers.parser import Parser
 from supar.utils import Config, Dataset, Embedding
 from supar.utils.common import bos, pad, unk
+from supar.utils.elmo import ElmoCache, ElmoTypeCache, pad_layers, registered
 from supar.utils.field import Field, SubwordField, ElmoField
 from supar.utils.fn import ispunct
 from supar.utils.logging import get_logger, progress_bar
@@ -33,6 +35,7 @@ class BiaffineDependencyParser(Parser):
 
     NAME = 'biaffine-dependency'
     MODEL = BiaffineDependencyModel
+    COST = 2
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -45,23 +48,10 @@ class BiaffineDependencyParser(Parser):
         self.puncts = torch.tensor([i
                                     for s, i in self.WORD.vocab.stoi.items()
                                     if ispunct(s)]).to(self.args.device)
-        if self.args.elmo_options:
-            self.elmo = ElmoEmbedder(self.args.elmo_options, self.args.elmo_weights, -1)
-        else:
-            self.efml = EFML(self.args.elmo_weights)
-            self.elmo = False
-        #print(self.__dict__)
-        if self.args.map_method == 'vecmap':
-            self.mapper = Vecmap(vars(self.args))
-        elif self.args.map_method == 'elmogan':
-            self.mapper = Elmogan(vars(self.args))
-        elif self.args.map_method == 'muse':
-            self.mapper = Muse(vars(self.args))
-        else:
-            self.mapper = None
-            
+        self._load(vars(self.args))
+
     def train(self, train, dev, test, buckets=32, batch_size=5000,
-              punct=False, tree=False, proj=False, partial=False, verbose=True, **kwargs):
+              punct=False, tree=False, proj=False, fast_mst=False, partial=False, verbose=True, **kwargs):
         r"""
         Args:
             train/dev/test (list[list] or str):
@@ -76,6 +66,9 @@ class BiaffineDependencyParser(Parser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, decodes non-projective trees with the :math:`O(n^2)` ChuLiu/Edmonds algorithm.
+                Default: ``False``.
             partial (bool):
                 ``True`` denotes the trees are partially annotated. Default: ``False``.
             verbose (bool):
@@ -87,7 +80,7 @@ class BiaffineDependencyParser(Parser):
         return super().train(**Config().update(locals()))
 
     def evaluate(self, data, buckets=8, batch_size=5000,
-                 punct=False, tree=True, proj=False, partial=False, verbose=True, **kwargs):
+                 punct=False, tree=True, proj=False, fast_mst=False, partial=False, verbose=True, **kwargs):
         r"""
         Args:
             data (str):
@@ -102,6 +95,9 @@ class BiaffineDependencyParser(Parser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, decodes non-projective trees with the :math:`O(n^2)` ChuLiu/Edmonds algorithm.
+                Default: ``False``.
             partial (bool):
                 ``True`` denotes the trees are partially annotated. Default: ``False``.
             verbose (bool):
@@ -112,25 +108,12 @@ class BiaffineDependencyParser(Parser):
         Returns:
             The loss scalar and evaluation results.
         """
-        if kwargs['elmo_options']:
-            self.elmo = ElmoEmbedder(kwargs['elmo_options'], kwargs['elmo_weights'], -1)
-        else:
-            self.efml = EFML(kwargs['elmo_weights'])
-        if kwargs['map_method'] == 'vecmap':
-            self.mapper = Vecmap(kwargs)
-            #print(self.mapper)
-        elif kwargs['map_method'] == 'elmogan':
-            self.mapper = Elmogan(kwargs)
-            #print(self.mapper)
-        elif kwargs['map_method'] == 'muse':
-            self.mapper = Muse(kwargs)
-        else:
-            self.mapper = None
+        self._load(kwargs)
 
         return super().evaluate(**Config().update(locals()))
 
     def predict(self, data, pred=None, buckets=8, batch_size=5000,
-                prob=False, tree=True, proj=False, verbose=True, **kwargs):
+                prob=False, tree=True, proj=False, fast_mst=False, window=0, verbose=True, **kwargs):
         r"""
         Args:
             data (list[list] or str):
@@ -147,29 +130,23 @@ class BiaffineDependencyParser(Parser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, decodes non-projective trees with the :math:`O(n^2)` ChuLiu/Edmonds algorithm.
+                Default: ``False``.
+            window (int):
+                If positive and ``data`` is a filename, sentences are read lazily and predicted in windows of
+                at most ``window`` sentences, whose results are written to ``pred`` incrementally. Default: 0.
             verbose (bool):
                 If ``True``, increases the output verbosity. Default: ``True``.
             kwargs (dict):
                 A dict holding the unconsumed arguments that can be used to update the configurations for prediction.
 
         Returns:
-            A :class:`~supar.utils.Dataset` object that stores the predicted results.
+            A :class:`~supar.utils.Dataset` object that stores the predicted results,
+            or ``None`` if the data is streamed in windows, whose results are only written to ``pred``.
         """
         
-        if kwargs['elmo_options']:
-            self.elmo = ElmoEmbedder(kwargs['elmo_options'], kwargs['elmo_weights'], -1)
-        else:
-            self.efml = EFML(kwargs['elmo_weights'])
-        if kwargs['map_method'] == 'vecmap':
-            self.mapper = Vecmap(kwargs)
-            #print(self.mapper)
-        elif kwargs['map_method'] == 'elmogan':
-            self.mapper = Elmogan(kwargs)
-            #print(self.mapper)
-        elif kwargs['map_method'] == 'muse':
-            self.mapper = Muse(kwargs)
-        else:
-            self.mapper = None
+        self._load(kwargs)
         return super().predict(**Config().update(locals()))
 
     def _train(self, loader):
@@ -179,37 +156,12 @@ class BiaffineDependencyParser(Parser):
         # words, feats, etc. come from loader! loader is train.loader, where train is Dataset
         for words, feats, arcs, rels in bar:
             self.optimizer.zero_grad()
-            if self.elmo:
-                feat_embs = self.elmo.embed_batch(feats)
-            else:
-                feat_embs = self.efml.sents2elmo(feats, output_layer=-2)
-            #TODO: dodaj mapping, ce in samo ce gre za vecmap
-            if self.args.map_method == 'vecmap':
-                # map feat_embs with vecmap, actually self.mapper defined in class init
-                feat_embs = self.mapper.map_batch(feat_embs)
-                
+
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
-            
-            feats0 = torch.zeros(words.shape+(1024,)) # words.clone()
-            feats1 = torch.zeros(words.shape+(1024,))
-            feats2 = torch.zeros(words.shape+(1024,))
-            # words get ignored, all input comes from feats - 3 elmo layers
+            # words get ignored, all input comes from feats - 3 elmo layers, see `_compose`
             # still inputting words due to reasons(tm)
-            
-            #feats0 = feats0.unsqueeze(-1)
-            #feats0 = feats0.expand(words.shape+(1024,))
-            for sentence in range(len(feat_embs)):
-                for token in range(len(feat_embs[sentence][1])):
-                    feats0[sentence][token] = torch.Tensor(feat_embs[sentence][0][token])
-                    feats1[sentence][token] = torch.Tensor(feat_embs[sentence][1][token])
-                    feats2[sentence][token] = torch.Tensor(feat_embs[sentence][2][token])
-            feats = torch.cat((feats0, feats1, feats2), -1)
-            if str(self.args.device) == '-1':
-                feats = feats.to('cpu')
-            else:
-                feats = feats.to('cuda:'+str(self.args.device)) #TODO: fix to allow cpu or gpu
             s_arc, s_rel = self.model(words, feats) #INFO: here is the data input, y = model(x)
             loss = self.model.loss(s_arc, s_rel, arcs, rels, mask, self.args.partial)
             loss.backward()
@@ -234,37 +186,16 @@ class BiaffineDependencyParser(Parser):
 
         total_loss, metric = 0, AttachmentMetric()
 
-        for words, feats, arcs, rels in loader:
-            if self.elmo:
-                feat_embs0 = self.elmo.embed_batch(feats)
-            else:
-                feat_embs0 = self.efml.sents2elmo(feats, output_layer=-2)
-            if self.mapper:
-                # map feat_embs with self.mapper defined in class init
-                feat_embs = self.mapper.map_batch(feat_embs0)
-            else:
-                feat_embs = feat_embs0
+        for (words, feats, arcs, rels), (s_arc, s_rel) in self._forward(loader):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
-            feats0 = torch.zeros(words.shape+(1024,))
-            feats1 = torch.zeros(words.shape+(1024,))
-            feats2 = torch.zeros(words.shape+(1024,))
-            for sentence in range(len(feat_embs)):
-                for token in range(len(feat_embs[sentence][1])):
-                    feats0[sentence][token] = torch.Tensor(feat_embs[sentence][0][token])
-                    feats1[sentence][token] = torch.Tensor(feat_embs[sentence][1][token])
-                    feats2[sentence][token] = torch.Tensor(feat_embs[sentence][2][token])
-            feats = torch.cat((feats0, feats1, feats2), -1)
-            if str(self.args.device) == '-1':
-                feats = feats.to('cpu')
-            else:
-                feats = feats.to('cuda:'+str(self.args.device))
-            s_arc, s_rel = self.model(words, feats)
             loss = self.model.loss(s_arc, s_rel, arcs, rels, mask, self.args.partial)
             arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask,
                                                      self.args.tree,
-                                                     self.args.proj)
+                                                     self.args.proj,
+                                                     self.args.fast_mst,
+                                                     self.pool)
             if self.args.partial:
                 mask &= arcs.ge(0)
             # ignore all punctuation if not specified
@@ -282,35 +213,16 @@ class BiaffineDependencyParser(Parser):
 
         preds = {}
         arcs, rels, probs = [], [], []
-        for words, feats in progress_bar(loader):
-            if self.elmo:
-                feat_embs = self.elmo.embed_batch(feats)
-            else:
-                feat_embs = self.efml.sents2elmo(feats, output_layer=-2)
-            if self.mapper:
-                # map feat_embs with self.mapper defined in class init
-                feat_embs = self.mapper.map_batch(feat_embs)
+        for (words, feats), (s_arc, s_rel) in self._forward(progress_bar(loader)):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
             lens = mask.sum(1).tolist()
-            feats0 = torch.zeros(words.shape+(1024,))
-            feats1 = torch.zeros(words.shape+(1024,))
-            feats2 = torch.zeros(words.shape+(1024,))
-            for sentence in range(len(feat_embs)):
-                for token in range(len(feat_embs[sentence][1])):
-                    feats0[sentence][token] = torch.Tensor(feat_embs[sentence][0][token])
-                    feats1[sentence][token] = torch.Tensor(feat_embs[sentence][1][token])
-                    feats2[sentence][token] = torch.Tensor(feat_embs[sentence][2][token])
-            feats = torch.cat((feats0, feats1, feats2), -1)
-            if str(self.args.device) == '-1':
-                feats = feats.to('cpu')
-            else:
-                feats = feats.to('cuda:'+str(self.args.device))
-            s_arc, s_rel = self.model(words, feats)
             arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask,
                                                      self.args.tree,
-                                                     self.args.proj)
+                                                     self.args.proj,
+                                                     self.args.fast_mst,
+                                                     self.pool)
             arcs.extend(arc_preds[mask].split(lens))
             rels.extend(rel_preds[mask].split(lens))
             if self.args.prob:
@@ -324,6 +236,98 @@ class BiaffineDependencyParser(Parser):
 
         return preds
 
+    @torch.no_grad()
+    def _compose(self, batch):
+        if self.args.feat != 'elmo':
+            return batch
+        words, feats = batch[0], batch[1]
+        feat_embs = self._embed(feats)
+        # during training, the features are mapped only if vecmap is used
+        mapping = self.mapper and (not self.model.training or self.args.map_method == 'vecmap')
+        # the mapping is left to the model if it holds the matrices itself
+        mapping = mapping and not self._maps_in_model(self.args.map_method)
+        # mappers supporting tensors (muse) map the assembled batch on the device instead
+        if mapping and not hasattr(self.mapper, 'map_tensor'):
+            # map feat_embs with self.mapper defined in class init
+            if self.types is not None and self.types.mapper is not None:
+                # layer 0 is mapped once per word type
+                feat_embs = self.types.map_batch(feats, feat_embs)
+            else:
+                feat_embs = self.mapper.map_batch(feat_embs)
+        feats = pad_layers(feat_embs, words.shape, words.is_cuda).to(words.device, non_blocking=True)
+        if mapping and hasattr(self.mapper, 'map_tensor'):
+            feats = self.mapper.map_tensor(feats)
+        return batch._replace(**{self.FEAT.name: feats})
+
+    def _load(self, args):
+        weights, options = args.get('elmo_weights'), args.get('elmo_options')
+        # the embedders and mappers are shared by all parsers of the process
+        if options:
+            self.elmo = registered(('elmo', os.path.abspath(weights), os.path.abspath(options), -1),
+                                   ElmoEmbedder, options, weights, -1)
+        else:
+            self.efml = registered(('efml', os.path.abspath(weights), None, -1), EFML, weights)
+            self.elmo = False
+        self.cache = self._build_cache(args)
+        self.mapper = self._build_mapper(args)
+        self.types = self._build_types(args)
+        if hasattr(self.model, 'mapping'):
+            self._set_mapping(args.get('map_method'))
+
+    def _maps_in_model(self, map_method):
+        return hasattr(self.model, 'mapping') and self.model.args.mapping == map_method
+
+    def _set_mapping(self, map_method):
+        r"""
+        Enables the frozen mapping layer of the model only if ``map_method`` is the mapping it was trained with,
+        so that the features are neither mapped twice nor by the stale matrices of another mapping.
+        """
+
+        self.model.mapping.enabled = self._maps_in_model(map_method)
+        if not self.model.mapping.enabled:
+            logger.warning(f"The {self.model.args.mapping} mapping held by the model is disabled, "
+                           f"as the features are mapped by {map_method}")
+        elif self.mapper is not None:
+            self.model.mapping.load(self.mapper.weights)
+
+    def _build_mapper(self, args):
+        mappers = {'vecmap': Vecmap, 'elmogan': Elmogan, 'muse': Muse}
+        if args.get('map_method') not in mappers:
+            return None
+        # the matrices saved along with the model are used instead of loading them again from the files
+        if self._maps_in_model(args['map_method']) and self.model.mapping.loaded:
+            return None
+        key = (args['map_method'],
+               *(os.path.abspath(path) if path else None for path in (args.get(f'map_layer{i}') for i in range(3))),
+               *(args.get(name) for name in ('map_direction', 'vecmap_lang', 'orthogonal')),
+               self.args.device)
+        return registered(key, mappers[args['map_method']], {**args, 'device': self.args.device})
+
+    def _build_cache(self, args):
+        if not args.get('elmo_cache', None):
+            return None
+        embedder = '|'.join(os.path.abspath(path)
+                            for path in (args.get('elmo_weights'), args.get('elmo_options')) if path)
+        return ElmoCache(args['elmo_cache'], embedder)
+
+    def _build_types(self, args):
+        if not args.get('elmo_types', False):
+            return None
+        # vecmap centers the representations of each sentence, so its mapping of layer 0 is context-dependent,
+        # and muse maps whole batches on the device
+        mapper = self.mapper if isinstance(self.mapper, Elmogan) else None
+        return ElmoTypeCache(self.elmo or None, mapper, args.get('elmo_types_size', None))
+
+    def _embed(self, feats):
+        if self.elmo:
+            fn = self.elmo.embed_batch if self.types is None else self.types.embed_batch
+        else:
+            def fn(sentences):
+                return self.efml.sents2elmo(sentences, output_layer=-2)
+        if self.cache is not None:
+            return self.cache.embed(feats, fn)
+        return fn(feats)
+
     @classmethod
     def build(cls, path, min_freq=2, fix_len=20, **kwargs):
         r"""
@@ -349,6 +353,8 @@ class BiaffineDependencyParser(Parser):
             parser = cls.load(**args)
             parser.model = cls.MODEL(**parser.args)
             parser.model.load_pretrained(parser.WORD.embed).to(args.device)
+            # the new model needs its mapping matrices to be loaded again
+            parser._load(vars(parser.args))
             return parser
 
         logger.info("Building the fields")
@@ -381,12 +387,18 @@ class BiaffineDependencyParser(Parser):
         else:
             transform = CoNLL(FORM=WORD, CPOS=FEAT, HEAD=ARC, DEPREL=REL)
         logger.info("initing train Dataset")
-        train = Dataset(transform, args.train)
+        # with streamed training, the vocabs are built on the first shard only
+        train = Dataset(transform, sorted(glob.glob(args.train))[0] if getattr(args, 'stream', 0) > 0 else args.train)
         #WORD.build(train, args.min_freq, (Embedding.load(args.embed, args.unk) if args.embed else None))
         logger.info("Building WORD, FEAT, REL fields")
         WORD.build(train)
         FEAT.build(train)
+        if isinstance(FEAT, SubwordField):
+            # memoize the pieces of at least all word types of the train data
+            FEAT.cache_size = max(FEAT.cache_size, len(WORD.vocab))
         REL.build(train)
+        # the cross-lingual mapping is applied by a frozen layer of the model if requested
+        mapping = getattr(args, 'map_method', None) if getattr(args, 'map_in_model', False) else None
         args.update({
             'n_words': WORD.vocab.n_init,
             'n_feats': len(FEAT.vocab),
@@ -395,6 +407,7 @@ class BiaffineDependencyParser(Parser):
             'unk_index': WORD.unk_index,
             'bos_index': WORD.bos_index,
             'feat_pad_index': FEAT.pad_index,
+            'mapping': mapping if mapping in ('vecmap', 'muse') else None
         })
         logger.info("Loading model")
         model = cls.MODEL(**args)
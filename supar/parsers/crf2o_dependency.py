@@ -31,6 +31,7 @@ class CRF2oDependencyParser(BiaffineDependencyParser):
 
     NAME = 'crf2o-dependency'
     MODEL = CRF2oDependencyModel
+    COST = 3
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -189,12 +190,11 @@ class CRF2oDependencyParser(BiaffineDependencyParser):
 
         preds = {}
         arcs, rels, probs = [], [], []
-        for words, feats in progress_bar(loader):
+        for (words, feats), (s_arc, s_sib, s_rel) in self._forward(progress_bar(loader)):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
             lens = mask.sum(1).tolist()
-            s_arc, s_sib, s_rel = self.model(words, feats)
             if self.args.mbr:
                 s_arc = self.model.crf((s_arc, s_sib), mask, mbr=True)
             arc_preds, rel_preds = self.model.decode(s_arc, s_sib, s_rel, mask,
@@ -30,6 +30,7 @@ class CRFConstituencyParser(Parser):
 
     NAME = 'crf-constituency'
     MODEL = CRFConstituencyModel
+    COST = 3
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -180,12 +181,11 @@ class CRFConstituencyParser(Parser):
 
         preds, probs = {'trees': []}, []
 
-        for words, feats, trees in progress_bar(loader):
+        for (words, feats, trees), (s_span, s_label) in self._forward(progress_bar(loader)):
             batch_size, seq_len = words.shape
             lens = words.ne(self.args.pad_index).sum(1) - 1
             mask = lens.new_tensor(range(seq_len - 1)) < lens.view(-1, 1, 1)
             mask = mask & mask.new_ones(seq_len-1, seq_len-1).triu_(1)
-            s_span, s_label = self.model(words, feats)
             if self.args.mbr:
                 s_span = self.model.crf(s_span, mask, mbr=True)
             chart_preds = self.model.decode(s_span, s_label, mask)
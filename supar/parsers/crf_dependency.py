@@ -25,6 +25,7 @@ class CRFDependencyParser(BiaffineDependencyParser):
 
     NAME = 'crf-dependency'
     MODEL = CRFDependencyModel
+    COST = 3
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -182,12 +183,11 @@ class CRFDependencyParser(BiaffineDependencyParser):
 
         preds = {}
         arcs, rels, probs = [], [], []
-        for words, feats in progress_bar(loader):
+        for (words, feats), (s_arc, s_rel) in self._forward(progress_bar(loader)):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
             lens = mask.sum(1).tolist()
-            s_arc, s_rel = self.model(words, feats)
             if self.args.mbr:
                 s_arc = self.model.crf(s_arc, mask, mbr=True)
             arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask,
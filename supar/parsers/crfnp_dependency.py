@@ -30,12 +30,13 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
 
     NAME = 'crfnp-dependency'
     MODEL = CRFNPDependencyModel
+    COST = 3
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def train(self, train, dev, test, buckets=32, batch_size=5000, punct=False,
-              mbr=True, tree=False, proj=False, verbose=True, **kwargs):
+              mbr=True, tree=False, proj=False, fast_mst=False, verbose=True, **kwargs):
         r"""
         Args:
             train/dev/test (list[list] or str):
@@ -52,6 +53,9 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, ensures to output well-formed trees,
+                which are decoded with the :math:`O(n^2)` ChuLiu/Edmonds algorithm. Default: ``False``.
             partial (bool):
                 ``True`` denotes the trees are partially annotated. Default: ``False``.
             verbose (bool):
@@ -63,7 +67,7 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
         return super().train(**Config().update(locals()))
 
     def evaluate(self, data, buckets=8, batch_size=5000, punct=False,
-                 mbr=True, tree=True, proj=False, verbose=True, **kwargs):
+                 mbr=True, tree=False, proj=False, fast_mst=False, verbose=True, **kwargs):
         r"""
         Args:
             data (str):
@@ -80,6 +84,9 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, ensures to output well-formed trees,
+                which are decoded with the :math:`O(n^2)` ChuLiu/Edmonds algorithm. Default: ``False``.
             partial (bool):
                 ``True`` denotes the trees are partially annotated. Default: ``False``.
             verbose (bool):
@@ -94,7 +101,7 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
         return super().evaluate(**Config().update(locals()))
 
     def predict(self, data, pred=None, buckets=8, batch_size=5000, prob=False,
-                mbr=True, tree=True, proj=False, verbose=True, **kwargs):
+                mbr=True, tree=False, proj=False, fast_mst=False, verbose=True, **kwargs):
         r"""
         Args:
             data (list[list] or str):
@@ -113,6 +120,9 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
                 If ``True``, ensures to output well-formed trees. Default: ``False``.
             proj (bool):
                 If ``True``, ensures to output projective trees. Default: ``False``.
+            fast_mst (bool):
+                If ``True``, ensures to output well-formed trees,
+                which are decoded with the :math:`O(n^2)` ChuLiu/Edmonds algorithm. Default: ``False``.
             verbose (bool):
                 If ``True``, increases the output verbosity. Default: ``True``.
             kwargs (dict):
@@ -155,13 +165,16 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
 
         total_loss, metric = 0, AttachmentMetric()
 
-        for words, feats, arcs, rels in loader:
+        for (words, feats, arcs, rels), (s_arc, s_rel) in self._forward(loader):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
-            s_arc, s_rel = self.model(words, feats)
             loss, s_arc = self.model.loss(s_arc, s_rel, arcs, rels, mask, self.args.mbr)
-            arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask)
+            arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask,
+                                                     self.args.tree or self.args.fast_mst,
+                                                     self.args.proj,
+                                                     self.args.fast_mst,
+                                                     self.pool)
             # ignore all punctuation if not specified
             if not self.args.punct:
                 mask &= words.unsqueeze(-1).ne(self.puncts).all(-1)
@@ -177,13 +190,16 @@ class CRFNPDependencyParser(BiaffineDependencyParser):
 
         preds = {}
         arcs, rels, probs = [], [], []
-        for words, feats in progress_bar(loader):
+        for (words, feats), (s_arc, s_rel) in self._forward(progress_bar(loader)):
             mask = words.ne(self.WORD.pad_index)
             # ignore the first token of each sentence
             mask[:, 0] = 0
             lens = mask.sum(1).tolist()
-            s_arc, s_rel = self.model(words, feats)
-            arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask)
+            arc_preds, rel_preds = self.model.decode(s_arc, s_rel, mask,
+                                                     self.args.tree or self.args.fast_mst,
+                                                     self.args.proj,
+                                                     self.args.fast_mst,
+                                                     self.pool)
             arcs.extend(arc_preds[mask].split(lens))
             rels.extend(rel_preds[mask].split(lens))
             if self.args.prob:
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import glob
+import multiprocessing as mp
 import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import supar
 import torch
 import torch.distributed as dist
 from supar.utils import Config, Dataset
+from supar.utils.data import StreamingDataset, prefetch
 from supar.utils.field import Field
 from supar.utils.logging import init_logger, logger
 from supar.utils.metric import Metric
@@ -20,6 +24,10 @@ class Parser(object):
 
     NAME = None
     MODEL = None
+    # the cost of parsing a sentence grows with its length to this power, see `Sampler`
+    COST = 1
+    # the pool of processes decoding trees, see `_decoding`
+    pool = None
 
     def __init__(self, args, model, transform):
         self.args = args
@@ -38,6 +46,14 @@ class Parser(object):
               decay_steps=5000,
               epochs=5000,
               patience=100,
+              prefetch=0,
+              data_cache=None,
+              workers=0,
+              stream=0,
+              columnar=False,
+              cost_aware=False,
+              decode_workers=0,
+              overlap=False,
               verbose=True,
               **kwargs):
         args = self.args.update(locals())
@@ -47,15 +63,16 @@ class Parser(object):
         if dist.is_initialized():
             args.batch_size = args.batch_size // dist.get_world_size()
         logger.info("Loading the data")
-        train = Dataset(self.transform, args.train, **args)
-        dev = Dataset(self.transform, args.dev)
-        test = Dataset(self.transform, args.test)
+        train = self._load_train(args)
+        dev = Dataset(self.transform, args.dev, args.workers, args.data_cache, columnar=args.columnar)
+        test = Dataset(self.transform, args.test, args.workers, args.data_cache, columnar=args.columnar)
         logger.info("Building the datasets")
-        train.build(args.batch_size, args.buckets, True, dist.is_initialized())
+        cost = self.COST if args.cost_aware else 1
+        train.build(args.batch_size, args.buckets, True, dist.is_initialized(), self._compose, args.prefetch, cost=cost)
         logger.info("train built")
-        dev.build(args.batch_size, args.buckets)
+        dev.build(args.batch_size, args.buckets, fn=self._compose, prefetch=args.prefetch, cost=cost)
         logger.info("dev built")
-        test.build(args.batch_size, args.buckets)
+        test.build(args.batch_size, args.buckets, fn=self._compose, prefetch=args.prefetch, cost=cost)
         logger.info(f"\n{'train:':6} {train}\n{'dev:':6} {dev}\n{'test:':6} {test}\n")
 
         logger.info(f"{self.model}\n")
@@ -64,39 +81,44 @@ class Parser(object):
         self.optimizer = Adam(self.model.parameters(), args.lr, (args.mu, args.nu), args.epsilon)
         self.scheduler = ExponentialLR(self.optimizer, args.decay**(1/args.decay_steps))
 
-        elapsed = timedelta()
-        best_e, best_metric = 1, Metric()
-
-        for epoch in range(1, args.epochs + 1):
-            start = datetime.now()
-
-            logger.info(f"Epoch {epoch} / {args.epochs}:")
-            self._train(train.loader)
-            loss, dev_metric = self._evaluate(dev.loader)
-            logger.info(f"{'dev:':6} - loss: {loss:.4f} - {dev_metric}")
-            loss, test_metric = self._evaluate(test.loader)
-            logger.info(f"{'test:':6} - loss: {loss:.4f} - {test_metric}")
-
-            t = datetime.now() - start
-            # save the model if it is the best so far
-            if dev_metric > best_metric:
-                best_e, best_metric = epoch, dev_metric
-                if is_master():
-                    self.save(args.path)
-                logger.info(f"{t}s elapsed (saved)\n")
-            else:
-                logger.info(f"{t}s elapsed\n")
-            elapsed += t
-            if epoch - best_e >= args.patience:
-                break
-        loss, metric = self.load(**args)._evaluate(test.loader)
+        with self._decoding():
+            elapsed = timedelta()
+            best_e, best_metric = 1, Metric()
+
+            for epoch in range(1, args.epochs + 1):
+                start = datetime.now()
+
+                logger.info(f"Epoch {epoch} / {args.epochs}:")
+                self._train(train.loader)
+                loss, dev_metric = self._evaluate(dev.loader)
+                logger.info(f"{'dev:':6} - loss: {loss:.4f} - {dev_metric}")
+                loss, test_metric = self._evaluate(test.loader)
+                logger.info(f"{'test:':6} - loss: {loss:.4f} - {test_metric}")
+
+                t = datetime.now() - start
+                # save the model if it is the best so far
+                if dev_metric > best_metric:
+                    best_e, best_metric = epoch, dev_metric
+                    if is_master():
+                        self.save(args.path)
+                    logger.info(f"{t}s elapsed (saved)\n")
+                else:
+                    logger.info(f"{t}s elapsed\n")
+                elapsed += t
+                if epoch - best_e >= args.patience:
+                    break
+            parser = self.load(**args)
+            # share the pool of decoding processes with the best parser
+            parser.pool = self.pool
+            loss, metric = parser._evaluate(test.loader)
 
         logger.info(f"Epoch {best_e} saved")
         logger.info(f"{'dev:':6} - {best_metric}")
         logger.info(f"{'test:':6} - {metric}")
         logger.info(f"{elapsed}s elapsed, {elapsed / epoch}s/epoch")
 
-    def evaluate(self, data, buckets=8, batch_size=5000, **kwargs):
+    def evaluate(self, data, buckets=8, batch_size=5000, prefetch=0, data_cache=None, workers=0, columnar=False,
+                 cost_aware=False, decode_workers=0, overlap=False, **kwargs):
         args = self.args.update(locals())
         print("called evaluate from parser.py")
         #print("args:", args)
@@ -104,35 +126,43 @@ class Parser(object):
         init_logger(logger, verbose=args.verbose)
         self.transform.train()
         logger.info("Loading the data")
-        dataset = Dataset(self.transform, data)
-        dataset.build(args.batch_size, args.buckets)
+        dataset = Dataset(self.transform, data, args.workers, args.data_cache, columnar=args.columnar)
+        dataset.build(args.batch_size, args.buckets, fn=self._compose, prefetch=args.prefetch,
+                      cost=self.COST if args.cost_aware else 1)
         logger.info(f"\n{dataset}")
 
         logger.info("Evaluating the dataset")
         start = datetime.now()
-        loss, metric = self._evaluate(dataset.loader)
+        with self._decoding():
+            loss, metric = self._evaluate(dataset.loader)
         elapsed = datetime.now() - start
         logger.info(f"loss: {loss:.4f} - {metric}")
         logger.info(f"{elapsed}s elapsed, {len(dataset)/elapsed.total_seconds():.2f} Sents/s")
 
         return loss, metric
 
-    def predict(self, data, pred=None, buckets=8, batch_size=5000, prob=False, **kwargs):
+    def predict(self, data, pred=None, buckets=8, batch_size=5000, prob=False, prefetch=0, window=0, data_cache=None,
+                workers=0, columnar=False, cost_aware=False, decode_workers=0, overlap=False, **kwargs):
         args = self.args.update(locals())
         init_logger(logger, verbose=args.verbose)
 
         self.transform.eval()
         if args.prob:
             self.transform.append(Field('probs'))
+        if args.window > 0 and isinstance(data, str):
+            with self._decoding():
+                return self._stream(data, pred)
 
         logger.info("Loading the data")
-        dataset = Dataset(self.transform, data)
-        dataset.build(args.batch_size, args.buckets)
+        dataset = Dataset(self.transform, data, args.workers, args.data_cache, columnar=args.columnar)
+        dataset.build(args.batch_size, args.buckets, fn=self._compose, prefetch=args.prefetch,
+                      cost=self.COST if args.cost_aware else 1)
         logger.info(f"\n{dataset}")
 
         logger.info("Making predictions on the dataset")
         start = datetime.now()
-        preds = self._predict(dataset.loader)
+        with self._decoding():
+            preds = self._predict(dataset.loader)
         elapsed = datetime.now() - start
 
         for name, value in preds.items():
@@ -144,6 +174,90 @@ class Parser(object):
 
         return dataset
 
+    def _stream(self, data, pred=None):
+        r"""
+        Makes predictions on windows of at most ``args.window`` sentences read lazily from the file,
+        and appends the results of each window to ``pred`` in the original order,
+        so that the memory footprint does not grow with the size of the data.
+        Nothing is returned, as the results are not kept in memory.
+        """
+
+        args = self.args
+        logger.info(f"Streaming the data in windows of {args.window} sentences")
+        start, n_sentences = datetime.now(), 0
+        # the results of all windows are appended to the file, which is created even if there are no sentences
+        if pred is not None and is_master():
+            open(pred, 'w').close()
+        for sentences in self.transform.stream(data, args.window):
+            dataset = Dataset(self.transform, sentences)
+            dataset.build(args.batch_size, args.buckets, fn=self._compose, prefetch=args.prefetch,
+                          cost=self.COST if args.cost_aware else 1)
+            for name, value in self._predict(dataset.loader).items():
+                setattr(dataset, name, value)
+            if pred is not None and is_master():
+                self.transform.save(pred, dataset.sentences, 'a')
+            n_sentences += len(dataset)
+        elapsed = datetime.now() - start
+        if pred is not None and is_master():
+            logger.info(f"Saved predicted results to {pred}")
+        logger.info(f"{elapsed}s elapsed, {n_sentences / elapsed.total_seconds():.2f} Sents/s")
+
+    def _compose(self, batch):
+        r"""
+        Turns a batch yielded by the loader into the inputs consumed by the model.
+        This is called in the background when prefetching is enabled.
+        """
+
+        return batch
+
+    def _load_train(self, args):
+        r"""
+        Loads the train data given the training arguments.
+        If ``args.stream`` is positive, ``args.train`` is a glob pattern of shards,
+        which are streamed through a shuffle buffer of ``args.stream`` sentences.
+        """
+
+        if args.stream > 0:
+            return StreamingDataset(self.transform, sorted(glob.glob(args.train)), args.stream,
+                                    proj=getattr(args, 'proj', False), max_len=getattr(args, 'max_len', None))
+        return Dataset(self.transform, args.train, cache=args.data_cache, **args)
+
+    def _forward(self, loader):
+        r"""
+        Iterates over the batches yielded by the loader along with the outputs of the model on their words and features.
+        If ``args.overlap`` is set, the model runs one batch ahead in a background thread,
+        so that the forward pass of the next batch overlaps the decoding of the current one.
+        """
+
+        def forward():
+            # the grad mode is thread-local
+            with torch.no_grad():
+                for batch in loader:
+                    yield batch, self.model(*batch[:2])
+
+        batches = forward()
+        if self.args.overlap:
+            batches = prefetch(batches, 1)
+        yield from batches
+
+    @contextmanager
+    def _decoding(self):
+        r"""
+        Starts a pool of ``args.decode_workers`` processes for decoding the trees of batches in parallel,
+        which is shared by all evaluations and predictions made within the context.
+        The processes are spawned rather than forked, as the parser may hold threads and CUDA states.
+        No pool is started if ``args.decode_workers`` is 0, and the trees are then decoded in the main process.
+        """
+
+        if self.args.decode_workers <= 0:
+            yield
+            return
+        with mp.get_context('spawn').Pool(self.args.decode_workers) as self.pool:
+            try:
+                yield
+            finally:
+                self.pool = None
+
     def _train(self, loader):
         raise NotImplementedError
 
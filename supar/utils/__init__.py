@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 
 from . import alg, field, fn, metric, transform
-from .alg import chuliu_edmonds, cky, eisner, eisner2o, kmeans, mst, tarjan
+from .alg import (bucketize, chuliu_edmonds, cky, eisner, eisner2o, fast_chuliu_edmonds,
+                  istree, kmeans, mst, tarjan)
 from .config import Config
 from .data import Dataset
+from .elmo import ElmoCache
 from .embedding import Embedding
 from .field import ChartField, Field, RawField, SubwordField, ElmoField
 from .transform import CoNLL, Transform, Tree
 from .vocab import Vocab
 
-__all__ = ['ChartField', 'CoNLL', 'Config', 'Dataset', 'Embedding', 'Field',
+__all__ = ['ChartField', 'CoNLL', 'Config', 'Dataset', 'ElmoCache', 'Embedding', 'Field',
            'RawField', 'SubwordField', 'Transform', 'Tree', 'Vocab',
-           'alg', 'field', 'fn', 'metric', 'chuliu_edmonds', 'cky',
-           'eisner', 'eisner2o', 'kmeans', 'mst', 'tarjan', 'transform']
+           'alg', 'field', 'fn', 'metric', 'bucketize', 'chuliu_edmonds', 'cky',
+           'eisner', 'eisner2o', 'fast_chuliu_edmonds', 'istree', 'kmeans', 'mst', 'tarjan', 'transform']
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+
+import numpy as np
 import torch
 from supar.utils.fn import pad, stripe
 
@@ -77,9 +80,115 @@ def kmeans(x, k, max_it=32):
     return centroids, clusters
 
 
+def bucketize(x, k, objective='padding'):
+    r"""
+    Exact and deterministic bucketing of the sentences by length, which is a drop-in replacement of :func:`kmeans`.
+
+    As lengths are one-dimensional, the optimal buckets cover contiguous ranges of sorted lengths,
+    which are found by dynamic programming over the histogram of distinct lengths.
+    Both objectives satisfy the quadrangle inequality, so the best start of the last bucket is monotone in its end,
+    and each step of the dynamic programming is solved by divide and conquer.
+    The time and memory are thus :math:`O(km\log m)` and :math:`O(km)` w.r.t. the number of distinct lengths :math:`m`,
+    on top of a single pass over the data for the histogram.
+
+    Args:
+        x (list[int]):
+            The list of sentence lengths.
+        k (int):
+            The number of buckets.
+            The final number of buckets is the smaller one of `k` and the number of distinct lengths.
+        objective (str):
+            The objective to be minimized. ``'kmeans'`` for the sum of squared deviations from the mean length
+            of each bucket, i.e., the optimal 1-D k-means, and ``'padding'`` for the total number of pads
+            when padding each sentence to the longest one of its bucket. Default: ``'padding'``.
+
+    Returns:
+        list[float], list[list[int]]:
+            The first list contains average lengths of sentences in each bucket.
+            The second is the list of buckets holding indices of data points.
+
+    Examples:
+        >>> x = [15, 10, 17, 11, 18, 13, 17, 19, 18, 14]
+        >>> centroids, clusters = bucketize(x, 3, 'kmeans')
+        >>> centroids
+        [10.5, 14.0, 17.8]
+        >>> clusters
+        [[1, 3], [0, 5, 9], [2, 4, 6, 7, 8]]
+    """
+
+    if objective not in ('kmeans', 'padding'):
+        raise ValueError(f"Unknown objective {objective}")
+    if len(x) == 0:
+        return [], []
+    x = np.asarray(x, dtype=np.int64)
+    # the histogram of distinct lengths
+    counts = np.bincount(x)
+    values = np.flatnonzero(counts)
+    counts, inverse = counts[values], np.cumsum(counts > 0)[x] - 1
+    m = len(values)
+    k = min(m, k)
+    # prefix sums of the histogram, [m + 1]
+    n = np.concatenate(([0], np.cumsum(counts))).astype(np.float64)
+    s1 = np.concatenate(([0], np.cumsum(counts * values))).astype(np.float64)
+    s2 = np.concatenate(([0], np.cumsum(counts * values.astype(np.float64) ** 2)))
+
+    def cost(i, j):
+        # the costs of the buckets covering distinct lengths [i, j]
+        size, total = n[j + 1] - n[i], s1[j + 1] - s1[i]
+        if objective == 'kmeans':
+            return s2[j + 1] - s2[i] - total ** 2 / size
+        return values[j] * size - total
+
+    # dp[j] is the min cost of covering lengths [0, j] with t buckets, and backs[t][j] the start of the last bucket
+    dp, backs = cost(np.zeros(m, dtype=np.int64), np.arange(m)), []
+    for t in range(1, k):
+        new, back = np.full(m, np.inf), np.zeros(m, dtype=np.int64)
+        # segments of ends [jl, jr] whose last buckets start in [il, ir], all segments of the same depth solved at once
+        jl, jr, il, ir = (np.array([i]) for i in (t, m - 1, t, m - 1))
+        while len(jl) > 0:
+            mid = (jl + jr) // 2
+            lo, lens = il, np.minimum(mid, ir) - il + 1
+            offsets = np.cumsum(lens) - lens
+            segments = np.repeat(np.arange(len(mid)), lens)
+            # the candidate starts of the last bucket of each mid
+            i = lo[segments] + np.arange(lens.sum()) - offsets[segments]
+            scores = dp[i - 1] + cost(i, mid[segments])
+            mins = np.minimum.reduceat(scores, offsets)
+            # the first start reaching the min of each segment
+            hits = np.flatnonzero(scores == mins[segments])
+            hits = hits[np.concatenate(([True], segments[hits[1:]] != segments[hits[:-1]]))]
+            new[mid], back[mid] = mins, i[hits]
+            left, right = jl < mid, mid < jr
+            jl, jr, il, ir = (np.concatenate((jl[left], mid[right] + 1)),
+                              np.concatenate((mid[left] - 1, jr[right])),
+                              np.concatenate((il[left], i[hits][right])),
+                              np.concatenate((i[hits][left], ir[right])))
+        dp = new
+        backs.append(back)
+    # recover the starts of all buckets
+    starts, j = [], m - 1
+    for back in reversed(backs):
+        starts.append(back[j])
+        j = back[j] - 1
+    starts = [0] + starts[::-1]
+    # map each distinct length and then each data point to its bucket
+    y = np.searchsorted(starts, np.arange(m), 'right')[inverse] - 1
+    order = np.argsort(y, kind='stable')
+    clusters = [i.tolist() for i in np.split(order, np.cumsum(np.bincount(y, minlength=k))[:-1])]
+    ends = starts[1:] + [m]
+    centroids = [float((s1[j] - s1[i]) / (n[j] - n[i])) for i, j in zip(starts, ends)]
+
+    return centroids, clusters
+
+
 def tarjan(sequence):
     r"""
-    Tarjan algorithm for finding Strongly Connected Components (SCCs) of a graph.
+    Finds all cycles of the graph defined by the head indices, i.e., its Strongly Connected Components (SCCs)
+    with more than one node, as Tarjan algorithm does.
+
+    As each node has exactly one head, the SCCs are found iteratively in :math:`O(n)` time:
+    the heads are followed from each node until reaching a node visited before,
+    which lies on a new cycle if it was visited during the same walk.
 
     Args:
         sequence (list):
@@ -87,50 +196,93 @@ def tarjan(sequence):
 
     Yields:
         A list of indices that make up a SCC. All self-loops are ignored.
+        The SCCs are yielded in the order of their smallest indices,
+        each starting from the head of its smallest index and ending with that index.
 
     Examples:
         >>> next(tarjan([2, 5, 0, 3, 1]))  # (1 -> 5 -> 2 -> 1) is a cycle
         [2, 5, 1]
     """
 
-    sequence = [-1] + sequence
-    # record the search order, i.e., the timestep
-    dfn = [-1] * len(sequence)
-    # record the the smallest timestep in a SCC
-    low = [-1] * len(sequence)
-    # push the visited into the stack
-    stack, onstack = [], [False] * len(sequence)
-
-    def connect(i, timestep):
-        dfn[i] = low[i] = timestep[0]
-        timestep[0] += 1
-        stack.append(i)
-        onstack[i] = True
-
-        for j, head in enumerate(sequence):
-            if head != i:
-                continue
-            if dfn[j] == -1:
-                yield from connect(j, timestep)
-                low[i] = min(low[i], low[j])
-            elif onstack[j]:
-                low[i] = min(low[i], dfn[j])
-
-        # a SCC is completed
-        if low[i] == dfn[i]:
-            cycle = [stack.pop()]
-            while cycle[-1] != i:
-                onstack[cycle[-1]] = False
-                cycle.append(stack.pop())
-            onstack[i] = False
-            # ignore the self-loop
-            if len(cycle) > 1:
-                yield cycle
-
-    timestep = [0]
-    for i in range(len(sequence)):
-        if dfn[i] == -1:
-            yield from connect(i, timestep)
+    sequence = [-1] + list(sequence)
+    n = len(sequence)
+    # record the walk each node is visited in
+    walks = [-1] * n
+    # the cycles indexed by their smallest nodes
+    cycles = [None] * n
+    for i in range(n):
+        j = i
+        while 0 <= j < n and walks[j] < 0:
+            walks[j] = i
+            j = sequence[j]
+        # the walk runs into itself, so j lies on a new cycle
+        if 0 <= j < n and walks[j] == i and sequence[j] != j:
+            cycle, k = [j], sequence[j]
+            while k != j:
+                cycle.append(k)
+                k = sequence[k]
+            k = cycle.index(min(cycle)) + 1
+            cycles[cycle[k-1]] = cycle[k:] + cycle[:k]
+    for cycle in cycles:
+        if cycle is not None:
+            yield cycle
+
+
+def istree(heads, mask, proj=False, multiroot=False):
+    r"""
+    Checks if the arcs of each sentence in the batch form a valid dependency tree,
+    which is the batched counterpart of :meth:`~supar.utils.transform.CoNLL.istree` working on the same device.
+
+    Cycles are detected by pointer jumping: after :math:`\lceil\log_2 n\rceil` rounds of replacing
+    the head of each token by the head of its head, all tokens reach the root unless they are on or lead into a cycle.
+    A valid tree is projective iff none of its arcs, including those from the root, cross each other.
+
+    Args:
+        heads (~torch.LongTensor): ``[batch_size, seq_len]``.
+            Head indices of all tokens, where the first column for the pseudo root is ignored.
+        mask (~torch.BoolTensor): ``[batch_size, seq_len]``.
+            The mask to avoid checking over padding tokens.
+            The first column serving as pseudo words for roots should be ``False``.
+        proj (bool):
+            If ``True``, requires the trees to be projective. Default: ``False``.
+        multiroot (bool):
+            If ``False``, requires the trees to contain only a single root. Default: ``False``.
+
+    Returns:
+        ~torch.BoolTensor:
+            A tensor with shape ``[batch_size]``, ``True`` for the sentences whose arcs form valid trees.
+
+    Examples:
+        >>> heads = torch.tensor([[0, 3, 0, 0, 3], [0, 2, 3, 1, 0]])
+        >>> mask = torch.tensor([[False,  True,  True,  True,  True], [False,  True,  True,  True, False]])
+        >>> istree(heads, mask, multiroot=True)
+        tensor([ True, False])
+        >>> istree(heads, mask)
+        tensor([False, False])
+    """
+
+    lens = mask.sum(1)
+    seq_len = heads.shape[1]
+    # the padding tokens and the pseudo root are attached to the root
+    heads = heads.masked_fill(~mask, 0)
+    indices = torch.arange(seq_len, device=heads.device)
+    roots = (heads.eq(0) & mask).sum(1)
+    valid = roots.eq(1) if not multiroot else roots.gt(0)
+    # the heads should lie in the sentence and differ from the tokens themselves
+    valid &= heads.le(lens.unsqueeze(-1)).all(1) & (heads.ne(indices) | ~mask).all(1)
+    ancestors = heads
+    for _ in range(max(seq_len - 1, 1).bit_length()):
+        ancestors = ancestors.gather(1, ancestors)
+    valid &= ancestors.eq(0).all(1)
+    if proj:
+        # [batch_size, seq_len], the left and right boundaries of the arcs
+        left, right = torch.min(heads, indices), torch.max(heads, indices)
+        # [batch_size, seq_len, seq_len], arc i crosses arc j if l_i < l_j < r_i < r_j
+        crossed = left.unsqueeze(-1).lt(left.unsqueeze(-2)) & left.unsqueeze(-2).lt(right.unsqueeze(-1))
+        crossed &= right.unsqueeze(-1).lt(right.unsqueeze(-2))
+        crossed &= mask.unsqueeze(-1) & mask.unsqueeze(-2)
+        valid &= ~crossed.flatten(1).any(1)
+    return valid
 
 
 def chuliu_edmonds(s):
@@ -232,7 +384,117 @@ def chuliu_edmonds(s):
     return tree
 
 
-def mst(scores, mask, multiroot=False):
+def fast_chuliu_edmonds(s, multiroot=True):
+    r"""
+    ChuLiu/Edmonds algorithm for non-projective decoding in :math:`O(n^2)` time on NumPy arrays,
+    following the dense-graph variant of `Tarjan (1977)`_.
+
+    The nodes are visited one by one, each picking its best incoming edge.
+    Whenever the picked edge closes a cycle, the cycle is contracted into a new node in :math:`O(n)` per member,
+    with the incoming scores rescaled by those of the cycle edges.
+    The tree is finally recovered by expanding the contracted nodes top-down.
+
+    If ``multiroot=False``, all edges from the root are penalized by more than
+    the difference of the scores of any two trees, so that the best tree has exactly one edge from the root,
+    which is thus found in a single pass without trying each candidate root.
+
+    Args:
+        s (~numpy.ndarray): ``[seq_len, seq_len]``.
+            Scores of all dependent-head pairs.
+        multiroot (bool):
+            Ensures to parse a single-root tree If ``False``. Default: ``True``.
+
+    Returns:
+        ~numpy.ndarray:
+            An array with shape ``[seq_len]`` for the resulting non-projective parse tree.
+
+    .. _Tarjan (1977):
+        https://doi.org/10.1002/net.3230070103
+    """
+
+    s = np.array(s, dtype=np.float64)
+    n = len(s)
+    if n <= 2:
+        return np.zeros(n, dtype=np.int64)
+    s[0] = float('-inf')
+    np.fill_diagonal(s, float('-inf'))
+    if not multiroot:
+        finite = s[np.isfinite(s)]
+        s[1:, 0] -= (finite.max() - finite.min()) * n + 1
+
+    # the nodes, including those created by contraction, are indexed in [0, 2n)
+    size, m = n, 2 * n
+    w = np.full((m, m), float('-inf'))
+    w[:n, :n] = s
+    # the original dependent and head of the edge behind each score
+    dep, head = np.zeros((m, m), dtype=np.int64), np.zeros((m, m), dtype=np.int64)
+    dep[:n, :n], head[:n, :n] = np.arange(n)[:, None], np.arange(n)
+    # the best incoming edge of each node, with its source, score and original endpoints
+    src, score, src_dep, src_head = (np.zeros(m, dtype=t) for t in (np.int64, np.float64, np.int64, np.int64))
+    # the node each node is contracted into, and the union-find sets of current nodes and weak components
+    parent, outer, weak = np.arange(m), np.arange(m), np.arange(m)
+    children = dict()
+
+    def find(sets, x):
+        root = x
+        while sets[root] != root:
+            root = sets[root]
+        while sets[x] != root:
+            sets[x], x = root, sets[x]
+        return root
+
+    pending = list(range(n - 1, 0, -1))
+    while pending:
+        v = pending.pop()
+        # the contracted nodes have their columns set to -inf
+        u = w[v, :size].argmax()
+        src[v], score[v], src_dep[v], src_head[v] = u, w[v, u], dep[v, u], head[v, u]
+        if find(weak, u) != find(weak, v):
+            weak[find(weak, u)] = find(weak, v)
+            continue
+        # the picked edge closes a cycle, which is contracted into a new node
+        cycle, x = [v], find(outer, u)
+        while x != v:
+            cycle.append(x)
+            x = find(outer, src[x])
+        c, cycle = size, np.array(cycle)
+        size, index = size + 1, np.arange(size)
+        # w(u->c) = max(w(u->x) - w(in(x)->x)), x in cycle
+        scores = w[cycle, :c] - score[cycle, None]
+        best = scores.argmax(0)
+        w[c, :c], dep[c, :c], head[c, :c] = scores[best, index], dep[cycle[best], index], head[cycle[best], index]
+        # w(c->u) = max(w(x->u)), x in cycle
+        scores = w[:c, cycle]
+        best = scores.argmax(1)
+        w[:c, c], dep[:c, c], head[:c, c] = scores[index, best], dep[index, cycle[best]], head[index, cycle[best]]
+        w[:size, cycle] = float('-inf')
+        parent[cycle], outer[cycle], weak[c] = c, c, find(weak, v)
+        children[c] = cycle.tolist()
+        pending.append(c)
+
+    # expand the contracted nodes top-down, each with the original node its incoming edge enters
+    tree = np.zeros(n, dtype=np.int64)
+    stack = [x for x in range(1, size) if parent[x] == x]
+    tree[src_dep[stack]] = src_head[stack]
+    stack = [(x, src_dep[x]) for x in stack]
+    while stack:
+        c, entry = stack.pop()
+        if c < n:
+            continue
+        # the incoming edge of the member holding the entry is replaced by that of the contracted node
+        x = entry
+        while parent[x] != c:
+            x = parent[x]
+        for y in children[c]:
+            if y == x:
+                stack.append((y, entry))
+            else:
+                tree[src_dep[y]] = src_head[y]
+                stack.append((y, src_dep[y]))
+    return tree
+
+
+def mst(scores, mask, multiroot=False, fast=False, pool=None):
     r"""
     MST algorithm for decoding non-pojective trees.
     This is a wrapper for ChuLiu/Edmonds algorithm.
@@ -241,6 +503,7 @@ def mst(scores, mask, multiroot=False):
     If ``multiroot=True`` and there indeed exist multi-roots, the algorithm seeks to find
     best single-root trees by iterating all possible single-root trees parsed by ChuLiu/Edmonds.
     Otherwise the resulting trees are directly taken as the final outputs.
+    If ``fast=True``, :func:`fast_chuliu_edmonds` is used instead, which enforces the single root in the same pass.
 
     Args:
         scores (~torch.Tensor): ``[batch_size, seq_len, seq_len]``.
@@ -250,6 +513,11 @@ def mst(scores, mask, multiroot=False):
             The first column serving as pseudo words for roots should be ``False``.
         muliroot (bool):
             Ensures to parse a single-root tree If ``False``.
+        fast (bool):
+            If ``True``, decodes with the :math:`O(n^2)` ChuLiu/Edmonds algorithm on NumPy arrays. Default: ``False``.
+        pool (~multiprocessing.pool.Pool):
+            If specified, the sentences are decoded in parallel by the workers of the pool,
+            which can be any object providing ``map``, e.g., a thread or process pool. Default: ``None``.
 
     Returns:
         ~torch.Tensor:
@@ -268,27 +536,35 @@ def mst(scores, mask, multiroot=False):
     """
 
     batch_size, seq_len, _ = scores.shape
-    scores = scores.cpu().unbind()
-
-    preds = []
-    for i, length in enumerate(mask.sum(1).tolist()):
-        s = scores[i][:length+1, :length+1]
-        tree = chuliu_edmonds(s)
-        roots = torch.where(tree[1:].eq(0))[0] + 1
-        if not multiroot and len(roots) > 1:
-            s_root = s[:, 0]
-            s_best = float('-inf')
-            s = s.index_fill(1, torch.tensor(0), float('-inf'))
-            for root in roots:
-                s[:, 0] = float('-inf')
-                s[root, 0] = s_root[root]
-                t = chuliu_edmonds(s)
-                s_tree = s[1:].gather(1, t[1:].unsqueeze(-1)).sum()
-                if s_tree > s_best:
-                    s_best, tree = s_tree, t
-        preds.append(tree)
-
-    return pad(preds, total_length=seq_len).to(mask.device)
+    scores = [s[:i+1, :i+1].numpy() for i, s in zip(mask.sum(1).tolist(), scores.detach().cpu().unbind())]
+    preds = (pool.map if pool is not None else map)(partial(_mst, multiroot=multiroot, fast=fast), scores)
+
+    return pad([torch.from_numpy(tree) for tree in preds], total_length=seq_len).to(mask.device)
+
+
+def _mst(s, multiroot=False, fast=False):
+    r"""
+    Decodes the MST of a single sentence for :func:`mst`.
+    This is defined at the module level so that it can be sent to the workers of a process pool.
+    """
+
+    if fast:
+        return fast_chuliu_edmonds(s, multiroot)
+    s = torch.from_numpy(s)
+    tree = chuliu_edmonds(s)
+    roots = torch.where(tree[1:].eq(0))[0] + 1
+    if not multiroot and len(roots) > 1:
+        s_root = s[:, 0]
+        s_best = float('-inf')
+        s = s.index_fill(1, torch.tensor(0), float('-inf'))
+        for root in roots:
+            s[:, 0] = float('-inf')
+            s[root, 0] = s_root[root]
+            t = chuliu_edmonds(s)
+            s_tree = s[1:].gather(1, t[1:].unsqueeze(-1)).sum()
+            if s_tree > s_best:
+                s_best, tree = s_tree, t
+    return tree.numpy()
 
 
 def eisner(scores, mask):
@@ -328,8 +604,10 @@ def eisner(scores, mask):
     scores = scores.permute(2, 1, 0)
     s_i = torch.full_like(scores, float('-inf'))
     s_c = torch.full_like(scores, float('-inf'))
-    p_i = scores.new_zeros(seq_len, seq_len, batch_size).long()
-    p_c = scores.new_zeros(seq_len, seq_len, batch_size).long()
+    # the split points never exceed seq_len, so a narrower dtype suffices
+    dtype = torch.int16 if seq_len < 2**15 else torch.int32
+    p_i = scores.new_zeros(seq_len, seq_len, batch_size, dtype=dtype)
+    p_c = scores.new_zeros(seq_len, seq_len, batch_size, dtype=dtype)
     s_c.diagonal().fill_(0)
 
     for w in range(1, seq_len):
@@ -360,28 +638,26 @@ def eisner(scores, mask):
         s_c[0, w][lens.ne(w)] = float('-inf')
         p_c.diagonal(w).copy_(cr_path + starts + 1)
 
-    def backtrack(p_i, p_c, heads, i, j, complete):
-        if i == j:
-            return
-        if complete:
-            r = p_c[i, j]
-            backtrack(p_i, p_c, heads, i, r, False)
-            backtrack(p_i, p_c, heads, r, j, True)
-        else:
-            r, heads[j] = p_i[i, j], i
-            i, j = sorted((i, j))
-            backtrack(p_i, p_c, heads, i, r, True)
-            backtrack(p_i, p_c, heads, j, r + 1, True)
-
-    preds = []
-    p_c = p_c.permute(2, 0, 1).cpu()
-    p_i = p_i.permute(2, 0, 1).cpu()
-    for i, length in enumerate(lens.tolist()):
-        heads = p_c.new_zeros(length + 1, dtype=torch.long)
-        backtrack(p_i[i], p_c[i], heads, 0, length, True)
-        preds.append(heads.to(mask.device))
-
-    return pad(preds, total_length=seq_len).to(mask.device)
+    # backtrack the spans of all sentences simultaneously, level by level
+    heads = lens.new_zeros(batch_size, seq_len)
+    # the pending spans, each with its sentence, endpoints and whether it is complete
+    b = torch.arange(batch_size, device=lens.device)
+    i, j, complete = lens.new_zeros(batch_size), lens.clone(), lens.new_ones(batch_size).bool()
+    while True:
+        b, i, j, complete = (x[i.ne(j)] for x in (b, i, j, complete))
+        if len(b) == 0:
+            break
+        r_c, r_i = p_c[i, j, b].long(), p_i[i, j, b].long()
+        # I(i->j) assigns i as the head of j
+        heads[b[~complete], j[~complete]] = i[~complete]
+        # C(i->j) = I(i->r) + C(r->j), I(i->j) = C(i->r) + C(j->r+1), where the endpoints of I are sorted
+        left = torch.where(complete, i, torch.min(i, j)), torch.where(complete, r_c, r_i), ~complete
+        right = (torch.where(complete, r_c, torch.max(i, j)),
+                 torch.where(complete, j, r_i + 1),
+                 complete.new_ones(len(b)))
+        b, i, j, complete = b.repeat(2), *(torch.cat(x) for x in zip(left, right))
+
+    return heads.to(mask.device)
 
 
 def eisner2o(scores, mask):
@@ -446,9 +722,11 @@ def eisner2o(scores, mask):
     s_i = torch.full_like(s_arc, float('-inf'))
     s_s = torch.full_like(s_arc, float('-inf'))
     s_c = torch.full_like(s_arc, float('-inf'))
-    p_i = s_arc.new_zeros(seq_len, seq_len, batch_size).long()
-    p_s = s_arc.new_zeros(seq_len, seq_len, batch_size).long()
-    p_c = s_arc.new_zeros(seq_len, seq_len, batch_size).long()
+    # the split points never exceed seq_len, so a narrower dtype suffices
+    dtype = torch.int16 if seq_len < 2**15 else torch.int32
+    p_i = s_arc.new_zeros(seq_len, seq_len, batch_size, dtype=dtype)
+    p_s = s_arc.new_zeros(seq_len, seq_len, batch_size, dtype=dtype)
+    p_c = s_arc.new_zeros(seq_len, seq_len, batch_size, dtype=dtype)
     s_c.diagonal().fill_(0)
 
     for w in range(1, seq_len):
@@ -506,37 +784,33 @@ def eisner2o(scores, mask):
         s_c[0, w][lens.ne(w)] = float('-inf')
         p_c.diagonal(w).copy_(cr_path + starts + 1)
 
-    def backtrack(p_i, p_s, p_c, heads, i, j, flag):
-        if i == j:
-            return
-        if flag == 'c':
-            r = p_c[i, j]
-            backtrack(p_i, p_s, p_c, heads, i, r, 'i')
-            backtrack(p_i, p_s, p_c, heads, r, j, 'c')
-        elif flag == 's':
-            r = p_s[i, j]
-            i, j = sorted((i, j))
-            backtrack(p_i, p_s, p_c, heads, i, r, 'c')
-            backtrack(p_i, p_s, p_c, heads, j, r + 1, 'c')
-        elif flag == 'i':
-            r, heads[j] = p_i[i, j], i
-            if r == i:
-                r = i + 1 if i < j else i - 1
-                backtrack(p_i, p_s, p_c, heads, j, r, 'c')
-            else:
-                backtrack(p_i, p_s, p_c, heads, i, r, 'i')
-                backtrack(p_i, p_s, p_c, heads, r, j, 's')
-
-    preds = []
-    p_i = p_i.permute(2, 0, 1).cpu()
-    p_s = p_s.permute(2, 0, 1).cpu()
-    p_c = p_c.permute(2, 0, 1).cpu()
-    for i, length in enumerate(lens.tolist()):
-        heads = p_c.new_zeros(length + 1, dtype=torch.long)
-        backtrack(p_i[i], p_s[i], p_c[i], heads, 0, length, 'c')
-        preds.append(heads.to(mask.device))
-
-    return pad(preds, total_length=seq_len).to(mask.device)
+    # backtrack the spans of all sentences simultaneously, level by level
+    heads = lens.new_zeros(batch_size, seq_len)
+    # the pending spans, each with its sentence, endpoints and type, 0 for C, 1 for S and 2 for I
+    COMP, SIB, INCOMP = lens.new_tensor(range(3)).unbind()
+    b = torch.arange(batch_size, device=lens.device)
+    i, j, flag = lens.new_zeros(batch_size), lens.clone(), lens.new_zeros(batch_size)
+    while True:
+        b, i, j, flag = (x[i.ne(j)] for x in (b, i, j, flag))
+        if len(b) == 0:
+            break
+        is_c, is_s, is_i = flag.eq(COMP), flag.eq(SIB), flag.eq(INCOMP)
+        r = torch.where(is_c, p_c[i, j, b], torch.where(is_s, p_s[i, j, b], p_i[i, j, b])).long()
+        # I(i->j) assigns i as the head of j
+        heads[b[is_i], j[is_i]] = i[is_i]
+        # I(i->j) without inner siblings = C(j->i+1) or C(j->i-1), whose right span is left empty
+        first = is_i & r.eq(i)
+        lo, hi = torch.min(i, j), torch.max(i, j)
+        # C(i->j) = I(i->r) + C(r->j), S(i, j) = C(i->r) + C(j->r+1), I(i->j) = I(i->r) + S(r, j)
+        left = (torch.where(is_s, lo, torch.where(first, j, i)),
+                torch.where(first, torch.where(i < j, i + 1, i - 1), r),
+                torch.where(is_c, INCOMP, torch.where(is_s | first, COMP, INCOMP)))
+        right = (torch.where(is_s, hi, r),
+                 torch.where(is_c, j, torch.where(is_s, r + 1, torch.where(first, r, j))),
+                 torch.where(is_i, SIB, COMP))
+        b, i, j, flag = b.repeat(2), *(torch.cat(x) for x in zip(left, right))
+
+    return heads.to(mask.device)
 
 
 def cky(scores, mask):
@@ -579,7 +853,8 @@ def cky(scores, mask):
     scores = scores.permute(1, 2, 0)
     seq_len, seq_len, batch_size = scores.shape
     s = scores.new_zeros(seq_len, seq_len, batch_size)
-    p = scores.new_zeros(seq_len, seq_len, batch_size).long()
+    # the split points never exceed seq_len, so a narrower dtype suffices
+    p = scores.new_zeros(seq_len, seq_len, batch_size, dtype=torch.int16 if seq_len < 2**15 else torch.int32)
 
     for w in range(1, seq_len):
         n = seq_len - w
@@ -597,15 +872,19 @@ def cky(scores, mask):
         s.diagonal(w).copy_(s_span + scores.diagonal(w))
         p.diagonal(w).copy_(p_span + starts + 1)
 
-    def backtrack(p, i, j):
-        if j == i + 1:
-            return [(i, j)]
-        split = p[i][j]
-        ltree = backtrack(p, i, split)
-        rtree = backtrack(p, split, j)
-        return [(i, j)] + ltree + rtree
-
-    p = p.permute(2, 0, 1).tolist()
-    trees = [backtrack(p[i], 0, length) for i, length in enumerate(lens.tolist())]
+    # collect the spans of all sentences simultaneously, level by level
+    spans = []
+    b = torch.arange(batch_size, device=lens.device)
+    i, j = lens.new_zeros(batch_size), lens.clone()
+    while len(b) > 0:
+        spans.append(torch.stack((b, i, j), -1))
+        b, i, j = (x[j.gt(i + 1)] for x in (b, i, j))
+        split = p[i, j, b].long()
+        b, i, j = b.repeat(2), torch.cat((i, split)), torch.cat((split, j))
+    b, i, j = torch.cat(spans).unbind(-1)
+    # sorting by sentences, left boundaries and then descending right boundaries gives the pre-order traversal
+    spans = torch.stack((i, j), -1)[((b * seq_len + i) * seq_len + seq_len - j).argsort()]
+    spans, offsets = spans.tolist(), (2 * lens - 1).cumsum(0).tolist()
+    trees = [list(map(tuple, spans[i:j])) for i, j in zip([0] + offsets[:-1], offsets)]
 
     return trees
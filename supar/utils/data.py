@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import math
+import multiprocessing as mp
+import os
+import pickle
+import random
+import shutil
+import threading
+from bisect import bisect_left
 from collections import namedtuple
+from queue import Empty, Queue
 
+import numpy as np
 import torch
 import torch.distributed as dist
-from supar.utils.alg import kmeans
+from supar.utils.alg import bucketize
+from supar.utils.logging import get_logger
+from supar.utils.transform import CoNLLCorpus, Sentence
+
+logger = get_logger(__name__)
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -21,6 +36,15 @@ class Dataset(torch.utils.data.Dataset):
         data (list[list] or str):
             A list of instances or a filename.
             This will be passed into :meth:`transform.load`.
+            A list of already loaded :class:`Sentence` objects is also allowed, e.g., a window yielded by
+            :meth:`CoNLL.stream`.
+        workers (int):
+            If larger than 1 and ``data`` is a filename, the file is split into chunks at sentence boundaries,
+            which are loaded and numericalized with the built fields by ``workers`` processes. Default: 0.
+        cache (str):
+            If specified and ``data`` is a filename, the loaded sentences, numericalized fields and buckets
+            are cached under this directory, keyed by the hash of the file, the fields and the loading options,
+            so that later runs on the same data skip loading and preprocessing entirely. Default: ``None``.
         kwargs (dict):
             Keyword arguments that will be passed into :meth:`transform.load` together with `data`
             to control the loading behaviour.
@@ -33,11 +57,23 @@ class Dataset(torch.utils.data.Dataset):
             Each sentence includes fields obeying the data format defined in ``transform``.
     """
 
-    def __init__(self, transform, data, **kwargs):
+    def __init__(self, transform, data, workers=0, cache=None, **kwargs):
         super(Dataset, self).__init__()
 
         self.transform = transform
-        self.sentences = transform.load(data, **kwargs)
+        # the file and loading options, which identify the data in the cache
+        self.path = data if isinstance(data, str) else None
+        self.kwargs = kwargs
+        self.cache = self.cache_dir(cache) if cache and self.path is not None else None
+        if isinstance(data, list) and data and isinstance(data[0], Sentence):
+            self.sentences = data
+        elif self.cache is not None and os.path.exists(self.cache):
+            logger.info(f"Loading the preprocessed data from {self.cache}")
+            self.load(self.cache)
+        elif workers > 1 and self.path is not None and hasattr(transform, 'split') and 'indices' not in kwargs:
+            self.load_parallel(workers)
+        else:
+            self.sentences = transform.load(data, **kwargs)
 
     def __repr__(self):
         s = f"{self.__class__.__name__}("
@@ -45,7 +81,7 @@ class Dataset(torch.utils.data.Dataset):
         if hasattr(self, 'loader'):
             s += f", n_batches={len(self.loader)}"
         if hasattr(self, 'buckets'):
-            s += f", n_buckets={len(self.buckets)}"
+            s += f", n_buckets={len(self.buckets)}, padding={self.padding:.2%}"
         s += ")"
 
         return s
@@ -53,6 +89,16 @@ class Dataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.sentences)
 
+    @property
+    def padding(self):
+        r"""
+        The expected ratio of pads in the batches, when each sentence is padded to the longest one of its bucket.
+        """
+
+        lengths = np.asarray(self.lengths)
+        n_tokens = sum(lengths[bucket].max() * len(bucket) for bucket in self.buckets.values() if bucket)
+        return 1 - lengths.sum() / max(n_tokens, 1)
+
     def __getitem__(self, index):
         if not hasattr(self, 'fields'):
             raise RuntimeError("The fields are not numericalized. Please build the dataset first.")
@@ -65,7 +111,7 @@ class Dataset(torch.utils.data.Dataset):
         return [getattr(sentence, name) for sentence in self.sentences]
 
     def __setattr__(self, name, value):
-        if 'sentences' in self.__dict__ and name in self.sentences[0]:
+        if 'sentences' in self.__dict__ and len(self.sentences) > 0 and name in self.sentences[0]:
             # restore the order of sequences in the buckets
             indices = torch.tensor([i
                                     for bucket in self.buckets.values()
@@ -85,31 +131,420 @@ class Dataset(torch.utils.data.Dataset):
     def collate_fn(self, batch):
         return {f: d for f, d in zip(self.fields.keys(), zip(*batch))}
 
-    def build(self, batch_size, n_buckets=1, shuffle=False, distributed=False):
-        # numericalize all fields
-        self.fields = self.transform(self.sentences)
-        # NOTE: the final bucket count is roughly equal to n_buckets
-        self.lengths = [len(i) for i in self.fields[next(iter(self.fields))]]
-        self.buckets = dict(zip(*kmeans(self.lengths, n_buckets)))
+    def build(self, batch_size, n_buckets=1, shuffle=False, distributed=False, fn=None, prefetch=0, cost=1):
+        # numericalize all fields, unless done while loading
+        if 'fields' not in self.__dict__:
+            self.fields = self.transform(self.sentences)
+            self.lengths = [len(i) for i in self.fields[next(iter(self.fields))]]
+        if self.cache is not None and not os.path.exists(self.cache):
+            self.save(self.cache)
+        path = os.path.join(self.cache, f"buckets.{n_buckets}") if self.cache is not None else None
+        if path is not None and os.path.exists(path):
+            self.buckets = self.load_buckets(path)
+        else:
+            # NOTE: the final bucket count is roughly equal to n_buckets
+            self.buckets = dict(zip(*bucketize(self.lengths, n_buckets)))
+            if path is not None:
+                self.save_buckets(path)
         self.loader = DataLoader(dataset=self,
                                  batch_sampler=Sampler(buckets=self.buckets,
                                                        batch_size=batch_size,
                                                        shuffle=shuffle,
-                                                       distributed=distributed),
-                                 collate_fn=self.collate_fn)
+                                                       distributed=distributed,
+                                                       cost=cost,
+                                                       lengths=self.lengths),
+                                 collate_fn=self.collate_fn,
+                                 fn=fn,
+                                 prefetch=prefetch)
+
+    def load_parallel(self, workers):
+        chunks = [(self.transform, self.path, start, end, self.kwargs)
+                  for start, end in self.transform.split(self.path, workers)]
+        # the processes are spawned rather than forked, as the parser may hold threads, e.g., of prefetching,
+        # and CUDA states
+        with mp.get_context('spawn').Pool(workers) as pool:
+            results = pool.map(numericalize, chunks)
+        if self.kwargs.get('columnar', False):
+            # the corpora of the chunks are merged into one, which holds the transform of the dataset
+            self.sentences = CoNLLCorpus(self.transform)
+            for corpus, _ in results:
+                self.sentences.extend(corpus)
+        else:
+            self.sentences = [sentence for sentences, _ in results for sentence in sentences]
+            # drop the copies of the transform made by the workers
+            for sentence in self.sentences:
+                sentence.transform = self.transform
+        self.fields = {field: [i for _, fields in results for i in fields[n]]
+                       for n, field in enumerate(self.transform.flatten())}
+        self.lengths = [len(i) for i in self.fields[next(iter(self.fields))]]
+
+    def cache_dir(self, root):
+        r"""
+        Returns the directory caching the sentences, numericalized fields and buckets of the data under ``root``,
+        which is keyed by the hash of the file, the fingerprint of the fields and vocabs, and the loading options.
+        This needs no parsing of the file, so that loading can be skipped if the directory exists.
+        """
+
+        digest = hashlib.sha1()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        for field in self.transform.flatten():
+            digest.update(repr(field).encode('utf-8'))
+            for attr in ('fn', 'tokenize'):
+                digest.update(getattr(getattr(field, attr, None), '__qualname__', '').encode('utf-8'))
+            digest.update(str(getattr(field, 'fix_len', None)).encode('utf-8'))
+            if hasattr(field, 'vocab'):
+                vocab = field.vocab
+                # e.g., the vocabs of pretrained tokenizers are dicts mapping tokens to ids
+                items = sorted(vocab.items()) if isinstance(vocab, dict) else enumerate(vocab.itos)
+                digest.update('\n'.join(f"{token}\t{i}" for token, i in items).encode('utf-8'))
+        # the fields held by the sentences, and the options filtering and storing the loaded sentences
+        options = (self.transform.training, [getattr(i, 'name', None) for i in self.transform],
+                   *(self.kwargs.get(name, False) for name in ('proj', 'max_len', 'columnar')))
+        if self.kwargs.get('indices', None) is not None:
+            digest.update(np.asarray(self.kwargs['indices'], dtype=np.int64).tobytes())
+        digest.update(repr(options).encode('utf-8'))
+        return os.path.join(root, digest.hexdigest())
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        with open(os.path.join(tmp, 'sentences.pkl'), 'wb') as f:
+            SentencePickler(f, self.transform).dump(self.sentences)
+        for field, sequences in self.fields.items():
+            # only tensors are cached, others are cheap to recompute
+            if all(isinstance(i, torch.Tensor) for i in sequences):
+                Sequences.save(os.path.join(tmp, field.name), sequences)
+        np.save(os.path.join(tmp, 'lengths.npy'), np.array(self.lengths, dtype=np.int64))
+        commit(tmp, path)
+
+    def load(self, path):
+        with open(os.path.join(path, 'sentences.pkl'), 'rb') as f:
+            self.sentences = SentenceUnpickler(f, self.transform).load()
+        self.fields = dict()
+        for field in self.transform.flatten():
+            if os.path.exists(os.path.join(path, f"{field.name}.data.npy")):
+                self.fields[field] = Sequences.load(os.path.join(path, field.name))
+            else:
+                self.fields[field] = field.transform([getattr(i, field.name) for i in self.sentences])
+        self.lengths = np.load(os.path.join(path, 'lengths.npy')).tolist()
+
+    def save_buckets(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'centroids.npy'), np.array(list(self.buckets.keys()), dtype=np.float64))
+        Sequences.save(os.path.join(tmp, 'buckets'), [torch.tensor(i, dtype=torch.long) for i in self.buckets.values()])
+        commit(tmp, path)
+
+    def load_buckets(self, path):
+        buckets = Sequences.load(os.path.join(path, 'buckets'))
+        return dict(zip(np.load(os.path.join(path, 'centroids.npy')).tolist(),
+                        [buckets[i].tolist() for i in range(len(buckets))]))
+
+
+def commit(tmp, path):
+    r"""
+    Moves the directory ``tmp`` written by a process to ``path`` atomically,
+    which is discarded if another process has saved the same data first.
+    """
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class SentencePickler(pickle.Pickler):
+    r"""
+    Pickles sentences without the transform they refer to, which is restored by :class:`SentenceUnpickler`.
+    """
+
+    def __init__(self, file, transform):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+
+        self.transform = transform
+
+    def persistent_id(self, obj):
+        return 'transform' if obj is self.transform else None
+
+
+class SentenceUnpickler(pickle.Unpickler):
+    r"""
+    Unpickles sentences pickled by :class:`SentencePickler`, which refer to the given transform.
+    """
+
+    def __init__(self, file, transform):
+        super().__init__(file)
+
+        self.transform = transform
+
+    def persistent_load(self, pid):
+        if pid != 'transform':
+            raise pickle.UnpicklingError(f"Unsupported persistent id: {pid}")
+        return self.transform
+
+
+def numericalize(chunk):
+    r"""
+    Loads and numericalizes the sentences in a chunk of the file, which is called in worker processes.
+    """
+
+    transform, path, start, end, kwargs = chunk
+    if kwargs.get('columnar', False):
+        sentences = transform.compact(transform.lines(path, start, end), kwargs.get('proj', False), kwargs.get('max_len'))
+    else:
+        sentences = transform.filter(list(transform.read(path, start, end)), **kwargs)
+    return sentences, list(transform(sentences).values())
+
+
+class Sequences(object):
+    r"""
+    A list of tensors stored as a flat array, along with the offsets and shapes of the tensors.
+    The arrays are memory-mapped when loaded, and each tensor is a view into them.
+
+    Args:
+        data (~numpy.ndarray):
+            The flattened and concatenated tensors.
+        offsets (~numpy.ndarray):
+            The offsets of the tensors in ``data``, including the end of the last one.
+        shapes (~numpy.ndarray):
+            The shapes of the tensors.
+    """
+
+    def __init__(self, data, offsets, shapes):
+        self.data = data
+        self.offsets = offsets
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, index):
+        data = self.data[self.offsets[index]:self.offsets[index+1]]
+        return torch.from_numpy(data).view(*self.shapes[index].tolist())
+
+    @classmethod
+    def save(cls, path, sequences):
+        sizes = [i.numel() for i in sequences]
+        data = torch.cat([i.flatten() for i in sequences]) if sequences else torch.tensor([], dtype=torch.long)
+        np.save(f"{path}.data.npy", data.numpy())
+        np.save(f"{path}.offsets.npy", np.cumsum([0] + sizes, dtype=np.int64))
+        np.save(f"{path}.shapes.npy", np.array([i.shape for i in sequences], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        # copy-on-write, so that in-place modifications of the views never reach the file
+        return cls(np.load(f"{path}.data.npy", mmap_mode='c'),
+                   np.load(f"{path}.offsets.npy"),
+                   np.load(f"{path}.shapes.npy"))
+
+
+class StreamingDataset(object):
+    r"""
+    Dataset streaming the data from shards of files, which is used for training on corpora that do not fit in memory.
+
+    The shards are read sequentially, and the numericalized sentences are kept in a bounded shuffle buffer,
+    in which they are grouped by length ranges.
+    Whenever the buffer is full, a batch of roughly ``batch_size`` tokens, or the same cost if ``cost > 1``,
+    is drawn from the group holding the most tokens, so that the batches are similar to those of :class:`Sampler`.
+    Each pass over the shards makes up an epoch.
+
+    Args:
+        transform (Transform):
+            An instance of :class:`Transform` supporting :meth:`stream`, e.g., :class:`CoNLL`.
+        paths (list[str]):
+            The filenames of the shards.
+        buffer_size (int):
+            The max number of sentences held in the buffer. Default: 10000.
+        proj (bool):
+            If ``True``, discards all non-projective sentences. Default: ``False``.
+        max_len (int):
+            Sentences exceeding the length will be discarded. Default: ``None``.
+    """
+
+    def __init__(self, transform, paths, buffer_size=10000, proj=False, max_len=None):
+        self.transform = transform
+        self.paths = paths
+        self.buffer_size = buffer_size
+        self.proj = proj
+        self.max_len = max_len
+
+    def __repr__(self):
+        s = f"{self.__class__.__name__}("
+        s += f"n_shards={len(self.paths)}, buffer_size={self.buffer_size}"
+        if getattr(self, 'centroids', None) is not None:
+            s += f", n_buckets={len(self.centroids)}"
+        s += ")"
+
+        return s
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.prefetch > 0:
+            batches = prefetch(batches, self.prefetch)
+        yield from batches
+
+    def build(self, batch_size, n_buckets=1, shuffle=True, distributed=False, fn=None, prefetch=0, cost=1):
+        self.batch_size = batch_size
+        self.cost = cost
+        self.n_buckets = n_buckets
+        self.shuffle = shuffle
+        self.rank = dist.get_rank() if distributed else 0
+        self.replicas = dist.get_world_size() if distributed else 1
+        self.fn = fn
+        self.prefetch = prefetch
+        # the length ranges are determined by the first full buffer
+        self.centroids = None
+        self.epoch = 0
+        # the dataset serves as its own loader
+        self.loader = self
+
+    def samples(self, rng):
+        paths = list(self.paths)
+        if self.shuffle:
+            rng.shuffle(paths)
+        for path in paths:
+            for sentences in self.transform.stream(path, self.buffer_size, self.proj, self.max_len):
+                yield from zip(*self.transform(sentences).values())
+
+    def batches(self):
+        rng = random.Random(self.epoch)
+        fields = self.transform.flatten()
+        Batch = namedtuple('Batch', [f.name for f in fields])
+        buckets, sizes, pending, total = None, None, [], 0
+
+        def assign(samples):
+            for sample in samples:
+                i = bisect_left(self.bounds, len(sample[0]))
+                buckets[i].append(sample)
+                sizes[i] += len(sample[0])
+
+        def draw(i):
+            samples, n_tokens, total_cost = [], 0, 0
+            while buckets[i] and total_cost < self.budget:
+                # pop a random sample by swapping it with the last one
+                j = rng.randrange(len(buckets[i]))
+                buckets[i][j], buckets[i][-1] = buckets[i][-1], buckets[i][j]
+                samples.append(buckets[i].pop())
+                n_tokens += len(samples[-1][0])
+                total_cost += len(samples[-1][0]) ** self.cost
+            sizes[i] -= n_tokens
+            return samples
+
+        def compose(samples):
+            batch = Batch(*[f.compose(list(d)) for f, d in zip(fields, zip(*samples))])
+            return self.fn(batch) if self.fn is not None else batch
+
+        def init(samples):
+            if self.centroids is None:
+                lengths = [len(i[0]) for i in samples]
+                self.centroids, clusters = bucketize(lengths, self.n_buckets)
+                # the max length of each bucket, as buckets cover contiguous ranges of lengths
+                self.bounds = [max(lengths[i] for i in cluster) for cluster in clusters[:-1]]
+                self.budget = self.batch_size * (sum(lengths) / len(lengths)) ** (self.cost - 1)
+            return [[] for _ in self.centroids], [0] * len(self.centroids)
+
+        for sample in self.samples(rng):
+            if buckets is None:
+                pending.append(sample)
+                if len(pending) < self.buffer_size:
+                    continue
+                buckets, sizes = init(pending)
+                assign(pending)
+                pending = None
+            else:
+                assign([sample])
+            if sum(len(i) for i in buckets) >= self.buffer_size:
+                samples = draw(max(range(len(buckets)), key=lambda i: sizes[i]))
+                if total % self.replicas == self.rank:
+                    yield compose(samples)
+                total += 1
+        # flush the buffer at the end of the epoch
+        if buckets is None and pending:
+            buckets, sizes = init(pending)
+            assign(pending)
+        for i in range(len(buckets or [])):
+            while buckets[i]:
+                samples = draw(i)
+                if total % self.replicas == self.rank:
+                    yield compose(samples)
+                total += 1
+        self.epoch += 1
 
 
 class DataLoader(torch.utils.data.DataLoader):
     r"""
     DataLoader, matching with :class:`Dataset`.
+
+    Args:
+        fn (function):
+            The function applied to each composed batch, e.g., to compute pretrained representations. Default: ``None``.
+        prefetch (int):
+            If positive, batches are prepared by a background thread and at most ``prefetch`` of them
+            are buffered ahead of the consumer, which overlaps the data preparation with model computations.
+            Default: 0.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, fn=None, prefetch=0, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self.fn = fn
+        self.prefetch = prefetch
+
     def __iter__(self):
+        batches = self.batches()
+        if self.prefetch > 0:
+            batches = prefetch(batches, self.prefetch)
+        yield from batches
+
+    def batches(self):
         for batch in super().__iter__():
-            yield namedtuple('Batch', [f.name for f in batch.keys()])(*[f.compose(d) for f, d in batch.items()])
+            batch = namedtuple('Batch', [f.name for f in batch.keys()])(*[f.compose(d) for f, d in batch.items()])
+            yield self.fn(batch) if self.fn is not None else batch
+
+
+def prefetch(iterator, size):
+    r"""
+    Iterates over the items of ``iterator``, which are produced by a background thread through a bounded queue.
+
+    Args:
+        iterator (iterable):
+            The iterator to be consumed in the background.
+        size (int):
+            The max number of items buffered in the queue.
+    """
+
+    queue, stop = Queue(size), threading.Event()
+
+    def produce():
+        try:
+            for item in iterator:
+                queue.put((True, item))
+                if stop.is_set():
+                    return
+            queue.put((False, None))
+        except Exception as e:
+            queue.put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+        # unblock the producer if it is waiting for a free slot
+        while thread.is_alive():
+            try:
+                queue.get(timeout=.1)
+            except Empty:
+                pass
 
 
 class Sampler(torch.utils.data.Sampler):
@@ -128,15 +563,35 @@ class Sampler(torch.utils.data.Sampler):
             If ``True``, the sampler will be used in conjunction with :class:`torch.nn.parallel.DistributedDataParallel`
             that restricts data loading to a subset of the dataset.
             Default: ``False``.
+        cost (int):
+            The power of sentence lengths the cost of each batch is measured in,
+            e.g., 2 for parsers building ``[batch_size, seq_len, seq_len]`` scores,
+            and 3 for those running the inside algorithm.
+            The budget of each batch is what ``batch_size`` tokens of sentences of the mean length cost,
+            so that batches of long sentences get fewer sentences than with plain token counts.
+            Default: 1, i.e., the number of tokens.
+        lengths (list[int]):
+            The lengths of all sentences, with which the cost of each bucket is computed exactly if ``cost > 1``.
+            Default: ``None``, i.e., estimated by the centroids.
     """
 
-    def __init__(self, buckets, batch_size, shuffle=False, distributed=False):
+    def __init__(self, buckets, batch_size, shuffle=False, distributed=False, cost=1, lengths=None):
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.cost = cost
         self.sizes, self.buckets = zip(*[(size, bucket) for size, bucket in buckets.items()])
+        if cost == 1 or lengths is None:
+            costs = [size ** cost * len(bucket) for size, bucket in zip(self.sizes, self.buckets)]
+            n_tokens = sum(size * len(bucket) for size, bucket in zip(self.sizes, self.buckets))
+            mean = n_tokens / sum(len(bucket) for bucket in self.buckets)
+        else:
+            costs = [sum(lengths[i] ** cost for i in bucket) for bucket in self.buckets]
+            mean = sum(lengths) / len(lengths)
+        budget = batch_size * mean ** (cost - 1)
         # number of chunks in each bucket, clipped by range [1, len(bucket)]
-        self.chunks = [min(len(bucket), max(round(size * len(bucket) / batch_size), 1))
-                       for size, bucket in zip(self.sizes, self.buckets)]
+        # the costs are rounded up so that the mean cost of the batches in a bucket never exceeds the budget
+        rounding = round if cost == 1 else math.ceil
+        self.chunks = [min(len(bucket), max(rounding(c / budget), 1)) for c, bucket in zip(costs, self.buckets)]
 
         self.rank = dist.get_rank() if distributed else 0
         self.replicas = dist.get_world_size() if distributed else 1
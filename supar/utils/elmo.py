@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+from supar.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+# objects shared by all parsers of the process, see `registered`
+_registry, _lock = dict(), threading.Lock()
+
+
+class ElmoCache(object):
+    r"""
+    A persistent cache of ELMo representations backed by a memory-mapped file.
+
+    As the biLM is frozen, the representations of a sentence never change during training
+    and only need to be computed once. Each sentence is keyed by the hash of its tokens mixed with the identity
+    of the embedder, and its representations are appended to a flat float32 file in token-major order.
+    Later lookups return read-only zero-copy views of shape ``[n_layers, seq_len, n_embed]`` into the memory map,
+    so that in-place modifications, e.g., by mappers, can never leak into later lookups of the same sentence.
+    The files can be shared by several processes, e.g., DDP ranks, which append to them under a file lock.
+
+    Args:
+        path (str):
+            The path prefix of the cache. Two files, ``<path>.bin`` and ``<path>.idx``,
+            holding the representations and the index respectively, will be created if not existing.
+        embedder (str):
+            A string identifying the embedder, e.g., the paths of its weights and options files.
+            Caches of different embedders sharing the same files never collide.
+        n_layers (int):
+            The number of ELMo layers. Default: 3.
+        n_embed (int):
+            The size of each ELMo layer. Default: 1024.
+
+    Examples:
+        >>> cache = ElmoCache('exp/ptb.elmo', 'elmo_weights.hdf5|elmo_options.json')
+        >>> embs = cache.embed([['She', 'enjoys', 'playing', 'tennis', '.']], elmo.embed_batch)
+        >>> embs[0].shape
+        (3, 5, 1024)
+    """
+
+    def __init__(self, path, embedder, n_layers=3, n_embed=1024):
+        self.path = path
+        self.embedder = embedder
+        self.n_layers = n_layers
+        self.n_embed = n_embed
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.index = dict()
+        self.size = os.path.getsize(self.bin) if os.path.exists(self.bin) else 0
+        if os.path.exists(self.idx):
+            with open(self.idx, 'r') as f:
+                for line in f:
+                    key, offset, length = line.split()
+                    offset, length = int(offset), int(length)
+                    # discard the entries left incomplete by interrupted writes
+                    if (offset + length * self.n_layers * self.n_embed) * 4 <= self.size:
+                        self.index[key] = (offset, length)
+        self.memmap = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(path={self.path}, n_sentences={len(self)})"
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, tokens):
+        return self.key(tokens) in self.index
+
+    def __getitem__(self, tokens):
+        offset, length = self.index[self.key(tokens)]
+        end = offset + length * self.n_layers * self.n_embed
+        if self.memmap is None or end > len(self.memmap):
+            self.memmap = np.memmap(self.bin, dtype=np.float32, mode='r')
+        return self.memmap[offset:end].reshape(length, self.n_layers, self.n_embed).transpose(1, 0, 2)
+
+    @property
+    def bin(self):
+        return f"{self.path}.bin"
+
+    @property
+    def idx(self):
+        return f"{self.path}.idx"
+
+    def key(self, tokens):
+        return hashlib.sha1('\n'.join([self.embedder, *tokens]).encode('utf-8')).hexdigest()
+
+    def update(self, sentences, embs):
+        r"""
+        Appends the representations of sentences to the cache.
+
+        Args:
+            sentences (list[list[str]]):
+                A list of tokenized sentences.
+            embs (list[~numpy.ndarray]):
+                The corresponding representations, each of shape ``[n_layers, seq_len, n_embed]``.
+        """
+
+        with open(self.bin, 'ab') as fb, open(self.idx, 'a') as fi:
+            # the files may be shared by other processes, e.g., DDP ranks or concurrent jobs,
+            # so the offsets are taken from the actual end of the file under an exclusive lock,
+            # which is released when the index is flushed and closed
+            fcntl.flock(fi, fcntl.LOCK_EX)
+            fb.seek(0, os.SEEK_END)
+            for tokens, emb in zip(sentences, embs):
+                key = self.key(tokens)
+                if key in self.index:
+                    continue
+                offset = fb.tell() // 4
+                fb.write(np.ascontiguousarray(np.asarray(emb).transpose(1, 0, 2), dtype=np.float32).tobytes())
+                fb.flush()
+                fi.write(f"{key}\t{offset}\t{len(tokens)}\n")
+                self.index[key] = (offset, len(tokens))
+            self.size = fb.tell()
+
+    def embed(self, sentences, fn):
+        r"""
+        Gets the representations of sentences, computing and storing the missing ones with ``fn``.
+
+        Args:
+            sentences (list[list[str]]):
+                A list of tokenized sentences.
+            fn (function):
+                The function mapping a list of sentences to their representations,
+                e.g., :meth:`allennlp.commands.elmo.ElmoEmbedder.embed_batch`.
+
+        Returns:
+            A list of arrays of shape ``[n_layers, seq_len, n_embed]``.
+        """
+
+        missing = [tokens for tokens in dict.fromkeys(map(tuple, sentences)) if tokens not in self]
+        if missing:
+            self.update(missing, fn([list(tokens) for tokens in missing]))
+        return [self[tokens] for tokens in sentences]
+
+
+def writeable(embs):
+    r"""
+    Gets the ELMo representations in arrays that can be modified in place,
+    copying those that are read-only, e.g., the views returned by :class:`ElmoCache`.
+
+    Args:
+        embs (list[~numpy.ndarray]):
+            A list of arrays of shape ``[n_layers, seq_len, n_embed]``.
+
+    Returns:
+        A list of writeable arrays.
+    """
+
+    embs = [np.asarray(emb) for emb in embs]
+    return [emb if emb.flags.writeable else emb.copy() for emb in embs]
+
+
+def pad_layers(embs, shape, pin_memory=False):
+    r"""
+    Assembles the ELMo representations of a batch into a single padded tensor,
+    in which all layers of each token are concatenated.
+
+    Args:
+        embs (list[~numpy.ndarray]):
+            A list of arrays of shape ``[n_layers, seq_len, n_embed]``.
+        shape (tuple):
+            The size ``[batch_size, seq_len]`` of the padded batch.
+        pin_memory (bool):
+            If ``True``, the tensor is allocated in page-locked memory
+            to allow for asynchronous copies to GPUs. Default: ``False``.
+
+    Returns:
+        ~torch.Tensor:
+            A tensor of shape ``[batch_size, seq_len, n_layers*n_embed]``.
+    """
+
+    n_layers, _, n_embed = embs[0].shape
+    x = torch.zeros(*shape, n_layers * n_embed, pin_memory=pin_memory)
+    # the arrays may be read-only, e.g., views into the cache, so they are copied through a numpy view of the tensor
+    out = x.view(*shape, n_layers, n_embed).numpy()
+    for i, emb in enumerate(embs):
+        emb = np.asarray(emb)
+        # copy the whole sentence at once, [n_layers, seq_len, n_embed] -> [seq_len, n_layers, n_embed]
+        out[i, :emb.shape[1]] = emb.transpose(1, 0, 2)
+    return x
+
+
+def registered(key, fn, *args, **kwargs):
+    r"""
+    Gets the object registered under ``key`` in a process-wide registry,
+    which is loaded by ``fn(*args, **kwargs)`` only on the first request.
+    This allows the embedders and mappers, which are expensive to load,
+    to be shared by all parser instances and repeated calls of ``evaluate`` and ``predict``.
+
+    Args:
+        key (tuple):
+            A hashable key identifying the object, e.g., the type, paths, options and device.
+        fn (function):
+            The function to load the object.
+
+    Returns:
+        The registered object.
+
+    Examples:
+        >>> elmo = registered(('elmo', weights, options, -1), ElmoEmbedder, options, weights, -1)
+        >>> elmo is registered(('elmo', weights, options, -1), ElmoEmbedder, options, weights, -1)
+        True
+    """
+
+    with _lock:
+        if key not in _registry:
+            logger.info(f"Loading {key[0]} from {', '.join(str(i) for i in key[1:] if i is not None)}")
+            _registry[key] = fn(*args, **kwargs)
+        return _registry[key]
+
+
+class TypeTable(object):
+    r"""
+    A table holding a vector for each word type, in which row 0 is left zero for padding.
+
+    The rows are preallocated and the capacity is doubled when exhausted,
+    so that adding the new types of each batch takes time proportional to their number.
+    The table can be bounded by ``max_size``, and once the types requested at a time would exceed it,
+    all others are evicted, so that at least the types of the current batch are kept.
+
+    Args:
+        max_size (int):
+            The max number of types kept in the table. Default: ``None``, i.e., unbounded.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+
+        self.stoi, self.data = dict(), None
+
+    def __repr__(self):
+        s = f"n_types={len(self)}"
+        if self.max_size is not None:
+            s += f", max_size={self.max_size}"
+        return f"{self.__class__.__name__}({s})"
+
+    def __len__(self):
+        return len(self.stoi)
+
+    def __contains__(self, token):
+        return token in self.stoi
+
+    def missing(self, tokens):
+        r"""
+        Gets the distinct tokens not held by the table, in their order of appearance.
+        If adding them would exceed ``max_size``, the table is flushed and all the distinct tokens are returned.
+        """
+
+        tokens = list(dict.fromkeys(tokens))
+        missing = [token for token in tokens if token not in self.stoi]
+        if self.max_size is not None and missing and len(self) + len(missing) > self.max_size:
+            self.stoi = dict()
+            return tokens
+        return missing
+
+    def add(self, tokens, vectors):
+        r"""
+        Adds the vectors of new tokens, which are either tensors or arrays of shape ``[n_tokens, n_embed]``.
+        """
+
+        start, end = len(self) + 1, len(self) + 1 + len(tokens)
+        if self.data is None or end > len(self.data):
+            size = max(end, 2 * len(self.data) if self.data is not None else 1024)
+            if self.max_size is not None:
+                size = max(end, min(size, self.max_size + 1))
+            if torch.is_tensor(vectors):
+                data = vectors.new_zeros(size, *vectors.shape[1:])
+            else:
+                data = np.zeros((size, *vectors.shape[1:]), dtype=vectors.dtype)
+            if self.data is not None:
+                data[:start] = self.data[:start]
+            self.data = data
+        self.data[start:end] = vectors
+        self.stoi.update({token: i for i, token in enumerate(tokens, start)})
+
+    def index(self, tokens):
+        return [self.stoi[token] for token in tokens]
+
+
+class ElmoTypeCache(object):
+    r"""
+    A cache of the context-independent layer 0 of ELMo for each word type.
+
+    Layer 0 of ELMo is produced by the character CNN and does not depend on the context.
+    With an ``ElmoEmbedder`` of allennlp, :meth:`embed_batch` passes only unseen word types through the CNN,
+    and the contextual biLSTM layers run on the representations gathered from the cache.
+    If a mapper applying the same transformation to each token regardless of the context is given,
+    e.g., :class:`~supar.xlingual.elmo_mapper.Elmogan`,
+    mapped layer-0 representations are also cached per type by :meth:`map_batch`,
+    which works for any embedder.
+
+    Args:
+        elmo (allennlp.commands.elmo.ElmoEmbedder):
+            The embedder whose character CNN is cached. Default: ``None``.
+        mapper (object):
+            The cross-lingual mapper whose layer-0 mapping is cached. Default: ``None``.
+        max_size (int):
+            The max number of types cached by each of the tables, see :class:`TypeTable`.
+            Default: ``None``, i.e., unbounded.
+    """
+
+    def __init__(self, elmo=None, mapper=None, max_size=None):
+        self.elmo = elmo
+        self.mapper = mapper
+
+        # word types and their CNN representations
+        self.embed = TypeTable(max_size)
+        # word types and their mapped layer-0 representations
+        self.mapped = TypeTable(max_size)
+
+    def __repr__(self):
+        s = f"n_types={len(self.embed)}"
+        if self.mapper is not None:
+            s += f", n_mapped={len(self.mapped)}"
+        return f"{self.__class__.__name__}({s})"
+
+    def __len__(self):
+        return len(self.embed)
+
+    def extend(self, tokens):
+        from allennlp.modules.elmo import batch_to_ids
+
+        bilm = self.elmo.elmo_bilm
+        tokens = self.embed.missing(tokens)
+        if not tokens:
+            return
+        # [n_tokens, 3, n_embed], the boundaries are added by the CNN
+        embed = bilm._token_embedder(batch_to_ids([[token] for token in tokens]).to(self.device))['token_embedding']
+        self.bos, self.eos = embed[0, 0], embed[0, 2]
+        self.embed.add(tokens, embed[:, 1])
+
+    @property
+    def device(self):
+        return next(self.elmo.elmo_bilm.parameters()).device
+
+    def embed_batch(self, batch):
+        r"""
+        A drop-in replacement of :meth:`allennlp.commands.elmo.ElmoEmbedder.embed_batch`.
+
+        Args:
+            batch (list[list[str]]):
+                A list of tokenized sentences.
+
+        Returns:
+            A list of arrays of shape ``[3, seq_len, 1024]``.
+        """
+
+        from allennlp.nn.util import add_sentence_boundary_token_ids, remove_sentence_boundaries
+
+        bilm = self.elmo.elmo_bilm
+        self.extend(token for tokens in batch for token in tokens)
+        lens = torch.tensor([len(tokens) for tokens in batch], device=self.device)
+        mask = lens.unsqueeze(-1).gt(torch.arange(lens.max(), device=self.device)).long()
+        # the padded positions point to the zero row
+        ids = mask.new_zeros(mask.shape)
+        ids[mask.bool()] = torch.tensor(self.embed.index(token for tokens in batch for token in tokens),
+                                        device=self.device)
+        embed, mask = add_sentence_boundary_token_ids(self.embed.data[ids], mask, self.bos, self.eos)
+        lstm_outputs = bilm._elmo_lstm(embed, mask)
+        layers = [torch.cat((embed, embed), -1) * mask.float().unsqueeze(-1), *lstm_outputs.unbind()]
+        embs = torch.stack([remove_sentence_boundaries(layer, mask)[0] for layer in layers], 1)
+        return [emb[:, :i].cpu().numpy() for i, emb in zip(lens.tolist(), embs.unbind())]
+
+    def map_batch(self, batch, embs):
+        r"""
+        Maps the ELMo representations of a batch, during which layer 0 is gathered from the cache.
+
+        Args:
+            batch (list[list[str]]):
+                A list of tokenized sentences.
+            embs (list[~numpy.ndarray]):
+                The corresponding representations, each of shape ``[3, seq_len, 1024]``.
+
+        Returns:
+            The mapped representations.
+        """
+
+        embs = writeable(embs)
+        missing = self.mapped.missing(token for tokens in batch for token in tokens)
+        if missing:
+            vectors = dict.fromkeys(missing)
+            for tokens, emb in zip(batch, embs):
+                vectors.update({token: vector for token, vector in zip(tokens, emb[0])
+                                if token in vectors and vectors[token] is None})
+            mapped = self.mapper.apply_mapping(np.stack(list(vectors.values())), self.mapper.layer0)
+            self.mapped.add(missing, np.asarray(mapped))
+        for tokens, emb in zip(batch, embs):
+            emb[0][:len(tokens)] = self.mapped.data[self.mapped.index(tokens)]
+        return self.mapper.map_batch(embs, layers=(1, 2))
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from collections import Counter
+from collections import Counter, OrderedDict
 
+import numpy as np
 import torch
 from supar.utils.fn import pad
 from supar.utils.vocab import Vocab
@@ -201,6 +202,8 @@ class Field(RawField):
         Turns a list of sequences that use this field into tensors.
 
         Each sequence is first preprocessed and then numericalized if needed.
+        All sequences are numericalized at once as a flat stream of tokens,
+        and the returned tensors are views into a single tensor.
 
         Args:
             sequences (list[list[str]]):
@@ -210,14 +213,32 @@ class Field(RawField):
             A list of tensors transformed from the input sequences.
         """
 
-        sequences = [self.preprocess(seq) for seq in sequences]
+        # lowercasing is deferred to the token types if it is the only preprocessing
+        lower = self.lower and self.use_vocab and self.fn is None and self.tokenize is None
+        if not lower:
+            sequences = [self.preprocess(seq) for seq in sequences]
+        if not sequences:
+            return []
+        lens = torch.tensor([len(seq) for seq in sequences])
+        tokens = [token for seq in sequences for token in seq]
         if self.use_vocab:
-            sequences = [self.vocab[seq] for seq in sequences]
-        if self.bos:
-            sequences = [[self.bos_index] + seq for seq in sequences]
-        if self.eos:
-            sequences = [seq + [self.eos_index] for seq in sequences]
-        sequences = [torch.tensor(seq) for seq in sequences]
+            # look up each token type only once, which also keeps unknown tokens out of the vocab
+            stoi = {token: self.vocab.stoi.get(token.lower() if lower else token, self.vocab.unk_index)
+                    for token in dict.fromkeys(tokens)}
+            ids = torch.from_numpy(np.fromiter(map(stoi.__getitem__, tokens), dtype=np.int64, count=len(tokens)))
+        else:
+            ids = torch.tensor(tokens)
+        if self.bos or self.eos:
+            sizes = lens + bool(self.bos) + bool(self.eos)
+            starts, ends = sizes.cumsum(0) - sizes, sizes.cumsum(0) - 1
+            flat, mask = ids.new_empty(sizes.sum().item()), lens.new_ones(sizes.sum().item()).bool()
+            if self.bos:
+                flat[starts], mask[starts] = self.bos_index, False
+            if self.eos:
+                flat[ends], mask[ends] = self.eos_index, False
+            flat[mask] = ids
+            ids, lens = flat, sizes
+        sequences = list(ids.split(lens.tolist()))
 
         return sequences
 
@@ -248,6 +269,9 @@ class SubwordField(Field):
             This is used for truncating the subword pieces that exceed the length.
             To save the memory, the final length will be the smaller value
             between the max length of subword pieces in a batch and `fix_len`.
+        cache_size (int):
+            The max number of word types whose subword pieces are memoized,
+            beyond which the least recently used ones are evicted. Default: 65536.
 
     Examples:
         >>> from transformers import AutoTokenizer
@@ -272,16 +296,48 @@ class SubwordField(Field):
 
     def __init__(self, *args, **kwargs):
         self.fix_len = kwargs.pop('fix_len') if 'fix_len' in kwargs else 0
+        self.cache_size = kwargs.pop('cache_size') if 'cache_size' in kwargs else 65536
         super().__init__(*args, **kwargs)
 
+    def __getstate__(self):
+        # the memo is rebuilt on demand
+        state = dict(self.__dict__)
+        state.pop('memo', None)
+        return state
+
+    def pieces(self, token):
+        r"""
+        Gets the subword pieces of a token, numericalized if needed, which are memoized per word type.
+
+        Args:
+            token (str):
+                The token to be tokenized.
+
+        Returns:
+            A list of piece ids, or of pieces if ``use_vocab=False``.
+        """
+
+        memo = self.__dict__.setdefault('memo', OrderedDict())
+        if token in memo:
+            memo.move_to_end(token)
+            return memo[token]
+        pieces = self.preprocess(token)
+        if self.use_vocab:
+            pieces = [self.vocab[i] for i in pieces] if pieces else [self.unk_index]
+        memo[token] = pieces
+        if len(memo) > getattr(self, 'cache_size', 65536):
+            memo.popitem(last=False)
+        return pieces
+
     def build(self, dataset, min_freq=1, embed=None):
         if hasattr(self, 'vocab'):
             return
         sequences = getattr(dataset, self.name)
-        counter = Counter(piece
-                          for seq in sequences
-                          for token in seq
-                          for piece in self.preprocess(token))
+        # tokenize each word type only once
+        counter = Counter()
+        for token, freq in Counter(token for seq in sequences for token in seq).items():
+            for piece in self.preprocess(token):
+                counter[piece] += freq
         self.vocab = Vocab(counter, min_freq, self.specials, self.unk_index)
 
         if not embed:
@@ -298,20 +354,26 @@ class SubwordField(Field):
             self.embed[self.vocab[tokens]] = embed.vectors
 
     def transform(self, sequences):
-        sequences = [[self.preprocess(token) for token in seq]
-                     for seq in sequences]
+        sequences = [[self.pieces(token) for token in seq] for seq in sequences]
+        if not sequences:
+            return []
         if self.fix_len <= 0:
             self.fix_len = max(len(token) for seq in sequences for token in seq)
-        if self.use_vocab:
-            sequences = [[[self.vocab[i] for i in token] if token else [self.unk_index] for token in seq]
-                         for seq in sequences]
         if self.bos:
             sequences = [[[self.bos_index]] + seq for seq in sequences]
         if self.eos:
             sequences = [seq + [[self.eos_index]] for seq in sequences]
-        lens = [min(self.fix_len, max(len(ids) for ids in seq)) for seq in sequences]
-        sequences = [pad([torch.tensor(ids[:i]) for ids in seq], self.pad_index, i)
-                     for i, seq in zip(lens, sequences)]
+        # pad the pieces of all tokens at once, and then take the sentences as views
+        rows = [ids[:self.fix_len] for seq in sequences for ids in seq]
+        widths = np.array([len(ids) for ids in rows], dtype=np.int64)
+        offsets = np.cumsum([0] + [len(seq) for seq in sequences])
+        lens = [int(widths[i:j].max(initial=0)) for i, j in zip(offsets[:-1], offsets[1:])]
+        x = torch.full((len(rows), max(lens)), self.pad_index, dtype=torch.long)
+        starts = np.repeat(np.cumsum(widths) - widths, widths)
+        cols = np.arange(widths.sum()) - starts
+        flat = np.fromiter((i for ids in rows for i in ids), dtype=np.int64, count=widths.sum())
+        x[torch.from_numpy(np.repeat(np.arange(len(rows)), widths)), torch.from_numpy(cols)] = torch.from_numpy(flat)
+        sequences = [x[i:j, :n] for i, j, n in zip(offsets[:-1], offsets[1:], lens)]
 
         return sequences
 
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+from array import array
 from collections.abc import Iterable
 
 import nltk
+import numpy as np
 from supar.utils.logging import get_logger, progress_bar
 
 logger = get_logger(__name__)
@@ -27,16 +30,8 @@ class Transform(object):
 
     def __call__(self, sentences):
         pairs = dict()
-        for field in self:
-            if field not in self.src and field not in self.tgt:
-                continue
-            if not self.training and field in self.tgt:
-                continue
-            if not isinstance(field, Iterable):
-                field = [field]
-            for f in field:
-                if f is not None:
-                    pairs[f] = f.transform([getattr(i, f.name) for i in sentences])
+        for f in self.flatten():
+            pairs[f] = f.transform([getattr(i, f.name) for i in sentences])
 
         return pairs
 
@@ -49,6 +44,22 @@ class Transform(object):
     def eval(self):
         self.train(False)
 
+    def flatten(self):
+        r"""
+        Returns the flattened list of fields to be numericalized in the current mode, in the order of the outputs.
+        """
+
+        fields = []
+        for field in self:
+            if field not in self.src and field not in self.tgt:
+                continue
+            if not self.training and field in self.tgt:
+                continue
+            if not isinstance(field, Iterable):
+                field = [field]
+            fields.extend(f for f in field if f is not None)
+        return fields
+
     def append(self, field):
         self.fields.append(field.name)
         setattr(self, field.name, field)
@@ -61,8 +72,8 @@ class Transform(object):
     def tgt(self):
         raise AttributeError
 
-    def save(self, path, sentences):
-        with open(path, 'w') as f:
+    def save(self, path, sentences, mode='w'):
+        with open(path, mode) as f:
             f.write('\n'.join([str(i) for i in sentences]) + '\n')
 
 
@@ -97,8 +108,9 @@ class Sentence(object):
     def __getattr__(self, name):
         if name in self.__dict__:
             return self.__dict__[name]
-        else:
-            return self.values[self.maps[name]]
+        if name not in self.__dict__.get('maps', {}):
+            raise AttributeError(name)
+        return self.values[self.maps[name]]
 
     def __setattr__(self, name, value):
         if 'keys' in self.__dict__ and name in self:
@@ -303,7 +315,7 @@ class CoNLL(Transform):
             return False
         return next(tarjan(sequence), None) is None
 
-    def load(self, data, proj=False, max_len=None, **kwargs):
+    def load(self, data, proj=False, max_len=None, indices=None, columnar=False, **kwargs):
         r"""
         Loads the data in CoNLL-X format.
         Also supports for loading data from CoNLL-U file with comments and non-integer IDs.
@@ -315,17 +327,29 @@ class CoNLL(Transform):
                 If ``True``, discards all non-projective sentences. Default: ``False``.
             max_len (int):
                 Sentences exceeding the length will be discarded. Default: ``None``.
+            indices (list[int]):
+                If specified, only the sentences with these indices are loaded from the file in the given order,
+                which are located with the :class:`CoNLLIndex` of the file. Default: ``None``.
+            columnar (bool):
+                If ``True``, the sentences are stored in a compact :class:`CoNLLCorpus`. Default: ``False``.
 
         Returns:
-            A list of :class:`CoNLLSentence` instances.
+            A list of :class:`CoNLLSentence` instances, or a :class:`CoNLLCorpus` if ``columnar=True``.
         """
 
+        if isinstance(data, str) and indices is not None:
+            return self.filter(list(self.seek(data, indices)), proj, max_len)
+        if isinstance(data, str) and columnar:
+            with open(data, 'r') as f:
+                return self.compact((line.strip() for line in f), proj, max_len)
         if isinstance(data, str):
             with open(data, 'r') as f:
                 lines = [line.strip() for line in f]
         else:
             data = [data] if isinstance(data[0], str) else data
             lines = '\n'.join([self.toconll(i) for i in data]).split('\n')
+        if columnar:
+            return self.compact(lines, proj, max_len)
 
         i, start, sentences = 0, 0, []
         for line in progress_bar(lines, leave=False):
@@ -333,13 +357,252 @@ class CoNLL(Transform):
                 sentences.append(CoNLLSentence(self, lines[start:i]))
                 start = i + 1
             i += 1
+        return self.filter(sentences, proj, max_len)
+
+    def compact(self, lines, proj=False, max_len=None):
+        r"""
+        Loads the sentences composed of the given lines into a :class:`CoNLLCorpus`,
+        filtering them one by one so that no per-sentence objects are kept.
+
+        Args:
+            lines (Iterable[str]):
+                The stripped lines in CoNLL-X format, in which sentences are separated by empty lines.
+            proj (bool):
+                If ``True``, discards all non-projective sentences. Default: ``False``.
+            max_len (int):
+                Sentences exceeding the length will be discarded. Default: ``None``.
+
+        Returns:
+            A :class:`CoNLLCorpus` instance.
+        """
+
+        corpus, sentence = CoNLLCorpus(self), []
+        for line in progress_bar(lines, leave=False):
+            if line:
+                sentence.append(line)
+                continue
+            if sentence:
+                corpus.append(sentence)
+                if not self.filter([corpus[-1]], proj, max_len):
+                    corpus.pop()
+            sentence = []
+        if sentence:
+            corpus.append(sentence)
+            if not self.filter([corpus[-1]], proj, max_len):
+                corpus.pop()
+        return corpus
+
+    def read(self, path, start=0, end=None):
+        r"""
+        Lazily reads the sentences in the byte range ``[start, end)`` of a file in CoNLL-X format.
+
+        Args:
+            path (str):
+                The filename.
+            start (int):
+                The byte offset to start from, which should be at the beginning of a sentence. Default: 0.
+            end (int):
+                The byte offset to stop at, which should be right after the end of a sentence.
+                Default: ``None``, i.e., the end of the file.
+
+        Returns:
+            A generator of :class:`CoNLLSentence` instances.
+        """
+
+        lines = []
+        for line in self.lines(path, start, end):
+            if line:
+                lines.append(line)
+            elif lines:
+                yield CoNLLSentence(self, lines)
+                lines = []
+        if lines:
+            yield CoNLLSentence(self, lines)
+
+    def lines(self, path, start=0, end=None):
+        r"""
+        Lazily reads the stripped lines in the byte range ``[start, end)`` of a file in CoNLL-X format,
+        which can be fed to :meth:`compact`.
+        """
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                start += len(line)
+                yield line.decode('utf-8').strip()
+                if end is not None and start >= end:
+                    break
+
+    def seek(self, path, indices):
+        r"""
+        Lazily reads the sentences with the given indices from a file in CoNLL-X format,
+        seeking to each of them with the :class:`CoNLLIndex` of the file.
+
+        Args:
+            path (str):
+                The filename.
+            indices (list[int]):
+                The indices of sentences in the file.
+
+        Returns:
+            A generator of :class:`CoNLLSentence` instances in the order of ``indices``.
+        """
+
+        offsets = CoNLLIndex.load(path).offsets
+        with open(path, 'rb') as f:
+            for i in indices:
+                f.seek(offsets[i])
+                lines = f.read(offsets[i+1] - offsets[i]).decode('utf-8').split('\n')
+                yield CoNLLSentence(self, [line.strip() for line in lines if line.strip()])
+
+    def split(self, path, n):
+        r"""
+        Splits a file in CoNLL-X format into at most ``n`` chunks of roughly equal sizes at sentence boundaries.
+
+        Args:
+            path (str):
+                The filename.
+            n (int):
+                The number of chunks.
+
+        Returns:
+            A list of ``(start, end)`` byte ranges, which can be fed to :meth:`read`.
+        """
+
+        size, bounds = os.path.getsize(path), [0]
+        with open(path, 'rb') as f:
+            for i in range(1, n):
+                f.seek(max(size * i // n, bounds[-1]))
+                # skip the possibly incomplete line, and then the rest of the sentence
+                f.readline()
+                line = f.readline()
+                while line and line.strip():
+                    line = f.readline()
+                bounds.append(f.tell())
+        bounds.append(size)
+        return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+    def filter(self, sentences, proj=False, max_len=None, **kwargs):
         if proj:
             sentences = [i for i in sentences if self.isprojective(list(map(int, i.arcs)))]
         if max_len is not None:
             sentences = [i for i in sentences if len(i) < max_len]
-
         return sentences
 
+    def stream(self, path, size, proj=False, max_len=None, **kwargs):
+        r"""
+        Lazily loads the data in CoNLL-X format, holding only a bounded window of sentences in memory.
+
+        Args:
+            path (str):
+                The filename.
+            size (int):
+                The max number of sentences in each window.
+            proj (bool):
+                If ``True``, discards all non-projective sentences. Default: ``False``.
+            max_len (int):
+                Sentences exceeding the length will be discarded. Default: ``None``.
+
+        Returns:
+            A generator of lists of :class:`CoNLLSentence` instances, following the order in the file.
+        """
+
+        sentences = []
+        for sentence in self.read(path):
+            sentences.extend(self.filter([sentence], proj, max_len))
+            if len(sentences) == size:
+                yield sentences
+                sentences = []
+        if sentences:
+            yield sentences
+
+
+class CoNLLIndex(object):
+    r"""
+    An index of a file in CoNLL-X format, which records the byte offset and the number of tokens of each sentence.
+    This allows for accessing arbitrary sentences, bucketing and sharding without reading the whole file.
+
+    The index is built once with a fast scan of the file and saved to ``<path>.idx.npz``,
+    which is rebuilt if the file has changed since.
+
+    Args:
+        offsets (~numpy.ndarray):
+            The byte offsets of all sentences, followed by the size of the file.
+        lengths (~numpy.ndarray):
+            The number of tokens of each sentence, excluding comments and non-integer IDs.
+
+    Examples:
+        >>> index = CoNLLIndex.load('data/ptb/train.conllx')
+        >>> sentences = transform.load('data/ptb/train.conllx', indices=index.shard(0, 4))
+    """
+
+    def __init__(self, offsets, lengths):
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_sentences={len(self)}, n_tokens={self.lengths.sum()})"
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, path):
+        offsets, lengths, start, n_tokens, position = [], [], None, 0, 0
+        with open(path, 'rb') as f:
+            for line in f:
+                value = line.strip()
+                if value:
+                    if start is None:
+                        start, n_tokens = position, 0
+                    n_tokens += value.split(b'\t', 1)[0].isdigit()
+                elif start is not None:
+                    offsets.append(start)
+                    lengths.append(n_tokens)
+                    start = None
+                position += len(line)
+        if start is not None:
+            offsets.append(start)
+            lengths.append(n_tokens)
+        return cls(np.array(offsets + [position], dtype=np.int64), np.array(lengths, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        stat, idx = os.stat(path), f"{path}.idx.npz"
+        if os.path.exists(idx):
+            state = np.load(idx)
+            if state['stat'].tolist() == [stat.st_size, stat.st_mtime_ns]:
+                return cls(state['offsets'], state['lengths'])
+        index = cls.build(path)
+        try:
+            with open(idx, 'wb') as f:
+                np.savez(f, offsets=index.offsets, lengths=index.lengths, stat=[stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            logger.warning(f"Failed to save the index of {path}")
+        return index
+
+    def shard(self, rank, replicas, shuffle=False, seed=0):
+        r"""
+        Returns the indices of sentences assigned to the ``rank``-th of ``replicas`` shards.
+        """
+
+        indices = np.random.RandomState(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        return indices[rank::replicas].tolist()
+
+    def buckets(self, n_buckets, indices=None):
+        r"""
+        Clusters the sentences (with the given indices) into buckets by their lengths with :func:`bucketize`.
+
+        Returns:
+            A dict that maps each centroid to the indices of sentences in the file.
+        """
+
+        from supar.utils.alg import bucketize
+
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        centroids, clusters = bucketize(self.lengths[indices], n_buckets)
+        return {centroid: indices[cluster].tolist() for centroid, cluster in zip(centroids, clusters)}
+
 
 class CoNLLSentence(Sentence):
     r"""
@@ -412,6 +675,204 @@ class CoNLLSentence(Sentence):
         return '\n'.join(merged.values()) + '\n'
 
 
+class CoNLLCorpus(object):
+    r"""
+    Columnar storage of sentences in CoNLL-X format, which is a compact alternative to a list of :class:`CoNLLSentence`.
+
+    All strings are interned, and the tokens of all sentences are kept in a flat array of string ids
+    with ten columns per token, which is delimited by the token offsets of the sentences.
+    Only the raw lines of comments and non-integer IDs are stored as they are.
+    Indexing or iterating over the corpus gives :class:`CoNLLSentenceView` objects created on the fly,
+    which can be used in place of :class:`CoNLLSentence`, e.g., by :class:`~supar.utils.data.Dataset`
+    and :meth:`Transform.save`.
+
+    Args:
+        transform (CoNLL):
+            A :class:`CoNLL` object.
+
+    Examples:
+        >>> corpus = transform.load('data/ptb/test.conllx', columnar=True)
+        >>> corpus
+        CoNLLCorpus(n_sentences=2416, n_tokens=56684, n_types=13497)
+        >>> corpus[0].words
+        ('No', ',', 'it', 'was', "n't", 'Black', 'Monday', '.')
+    """
+
+    n_columns = 10
+
+    def __init__(self, transform):
+        self.transform = transform
+
+        # interned strings
+        self.stoi, self.itos = dict(), []
+        # string ids of all tokens, n_columns per token
+        self.ids = array('i')
+        # token offsets of the sentences
+        self.offsets = array('q', [0])
+        # raw lines of comments and non-integer IDs along with their positions, only for sentences having them
+        self.annotations = dict()
+        # values of the fields beyond the columns, e.g., probs, for each sentence
+        self.extras = dict()
+        # mapping from each nested field to their proper position, shared by all views
+        self.maps = dict()
+        for i, field in enumerate(transform):
+            if not isinstance(field, Iterable):
+                field = [field]
+            for f in field:
+                if f is not None:
+                    self.maps[f.name] = i
+
+    def __repr__(self):
+        s = f"n_sentences={len(self)}, n_tokens={self.offsets[-1]}, n_types={len(self.itos)}"
+        return f"{self.__class__.__name__}({s})"
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("corpus index out of range")
+        return CoNLLSentenceView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield CoNLLSentenceView(self, i)
+
+    def intern(self, s):
+        i = self.stoi.get(s)
+        if i is None:
+            i = self.stoi[s] = len(self.itos)
+            self.itos.append(s)
+        return i
+
+    def append(self, lines):
+        r"""
+        Appends a sentence to the corpus.
+
+        Args:
+            lines (list[str]):
+                A list of strings composing a sentence in CoNLL-X format.
+                Token lines with missing columns are padded with underscores.
+        """
+
+        annotations = []
+        for i, line in enumerate(lines):
+            value = line.split('\t')
+            if value[0].startswith('#') or not value[0].isdigit():
+                annotations.append((i, line))
+            else:
+                value = (value + ['_'] * self.n_columns)[:self.n_columns]
+                self.ids.extend([self.intern(j) for j in value])
+        if annotations:
+            self.annotations[len(self)] = annotations
+        self.offsets.append(len(self.ids) // self.n_columns)
+
+    def extend(self, corpus):
+        r"""
+        Appends all sentences of another corpus, whose strings are interned again.
+
+        Args:
+            corpus (CoNLLCorpus):
+                The corpus to be appended.
+        """
+
+        ids, n_sentences, n_tokens = [self.intern(s) for s in corpus.itos], len(self), self.offsets[-1]
+        self.ids.extend(array('i', [ids[i] for i in corpus.ids]))
+        self.offsets.extend(n_tokens + i for i in corpus.offsets[1:])
+        for index, annotations in corpus.annotations.items():
+            self.annotations[n_sentences + index] = annotations
+        for name, values in corpus.extras.items():
+            self.extras.setdefault(name, dict()).update((n_sentences + i, value) for i, value in values.items())
+
+    def pop(self):
+        r"""
+        Removes the last sentence from the corpus. The interned strings are kept.
+        """
+
+        index = len(self) - 1
+        del self.ids[self.offsets[index] * self.n_columns:]
+        del self.offsets[-1]
+        self.annotations.pop(index, None)
+        for values in self.extras.values():
+            values.pop(index, None)
+
+    def column(self, index, column):
+        start, end = self.offsets[index] * self.n_columns, self.offsets[index + 1] * self.n_columns
+        return tuple(self.itos[i] for i in self.ids[start+column:end:self.n_columns])
+
+    def update(self, index, column, values):
+        start, end = self.offsets[index] * self.n_columns, self.offsets[index + 1] * self.n_columns
+        if len(values) != (end - start) // self.n_columns:
+            raise ValueError(f"Expected {(end - start) // self.n_columns} values, got {len(values)}")
+        self.ids[start+column:end:self.n_columns] = array('i', [self.intern(str(i)) for i in values])
+
+
+class CoNLLSentenceView(Sentence):
+    r"""
+    A view of a sentence stored in a :class:`CoNLLCorpus`, which behaves like :class:`CoNLLSentence`.
+
+    Values assigned to the fields are written back to the corpus as strings,
+    except for the fields beyond the ten columns, e.g., ``probs``, which are kept aside by the corpus.
+
+    Args:
+        corpus (CoNLLCorpus):
+            The corpus holding the sentence.
+        index (int):
+            The index of the sentence in the corpus.
+    """
+
+    def __init__(self, corpus, index):
+        self.__dict__.update(corpus=corpus, index=index)
+
+    def __repr__(self):
+        annotations = dict(self.corpus.annotations.get(self.index, []))
+        tokens = iter('\t'.join(i) for i in zip(*self.values))
+        lines = [annotations[i] if i in annotations else next(tokens) for i in range(len(self) + len(annotations))]
+        return '\n'.join(lines) + '\n'
+
+    def __len__(self):
+        return self.corpus.offsets[self.index + 1] - self.corpus.offsets[self.index]
+
+    def __contains__(self, key):
+        return key in self.corpus.maps
+
+    def __getattr__(self, name):
+        if 'corpus' not in self.__dict__ or name not in self.corpus.maps:
+            raise AttributeError(name)
+        column = self.corpus.maps[name]
+        if column >= self.corpus.n_columns:
+            return self.corpus.extras[name][self.index]
+        return self.corpus.column(self.index, column)
+
+    def __setattr__(self, name, value):
+        if name not in self.corpus.maps:
+            self.__dict__[name] = value
+        elif self.corpus.maps[name] >= self.corpus.n_columns:
+            self.corpus.extras.setdefault(name, dict())[self.index] = value
+        else:
+            self.corpus.update(self.index, self.corpus.maps[name], value)
+
+    @property
+    def transform(self):
+        return self.corpus.transform
+
+    @property
+    def maps(self):
+        return self.corpus.maps
+
+    @property
+    def keys(self):
+        return set(self.corpus.maps)
+
+    @property
+    def values(self):
+        return [self.corpus.column(self.index, i) for i in range(self.corpus.n_columns)]
+
+
 class Tree(Transform):
     r"""
     The Tree object factorize a constituency tree into four fields, each associated with one or more :class:`Field` objects.
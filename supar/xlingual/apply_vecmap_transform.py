@@ -8,6 +8,16 @@ def vecmap_orth(x, w):
     x.dot(w, out=xw)
     return xw
 
+
+def normalize_segments(x, lens):
+    # ['unit', 'center', 'unit'] applied to each of the sentences packed in x, centering within sentences
+    lens = np.asarray(lens)
+    embeddings.length_normalize(x)
+    x -= np.repeat(np.add.reduceat(x, np.cumsum(lens) - lens, axis=0) / lens[:, np.newaxis], lens, axis=0)
+    embeddings.length_normalize(x)
+    return x
+
+
 def vecmap(x, W2, s): #src: W2=wx2, trg: W2=wz2
     #xp = get_cupy()
     xp = np
@@ -1,58 +1,89 @@
-import tensorflow
-from tensorflow.keras.models import Model, load_model
-from supar.xlingual.apply_vecmap_transform import vecmap, vecmap_orth
+from supar.utils.elmo import writeable
+from supar.utils.logging import get_logger
+from supar.xlingual.apply_vecmap_transform import normalize_segments, vecmap, vecmap_orth
 import numpy as np
 
+logger = get_logger(__name__)
+
 
 class Elmogan():
     def __init__(self, args):
         #print(args)
-        self.layer0 = load_model(args['map_layer0'])
-        self.layer1 = load_model(args['map_layer1'])
-        self.layer2 = load_model(args['map_layer2'])
         self.direction = args['map_direction']
-        
-    def map_batch(self, batch):
-        for x,sentence in enumerate(batch):
-            seqlen = sentence[0].shape[0]
-            batch[x][0][0:seqlen] = self.apply_mapping(sentence[0], self.layer0)
-            batch[x][1][0:seqlen] = self.apply_mapping(sentence[1], self.layer1)
-            batch[x][2][0:seqlen] = self.apply_mapping(sentence[2], self.layer2)
+        self.device = args.get('device', 'cpu')
+        self.layer0 = self.load(args['map_layer0'])
+        self.layer1 = self.load(args['map_layer1'])
+        self.layer2 = self.load(args['map_layer2'])
+
+    def load(self, path):
+        # generators exported by supar.xlingual.elmogan_torch need no tensorflow
+        if path.endswith('.pt'):
+            from supar.xlingual.elmogan_torch import load
+            return load(path, self.device)
+        from tensorflow.keras.models import Model, load_model
+        model = load_model(path)
+        # only the requested direction is computed
+        if len(model.outputs) < 2:
+            logger.warning(f"The generator {path} has a single output, which is used for mapping as a whole")
+            return model
+        return Model(model.inputs, model.outputs[0 if self.direction == 0 else 1])
+
+    def map_batch(self, batch, layers=(0, 1, 2)):
+        batch = writeable(batch)
+        lens = [sentence[0].shape[0] for sentence in batch]
+        for layer in layers:
+            # all tokens of the batch are mapped by a single call
+            x = np.concatenate([sentence[layer] for sentence in batch])
+            x = self.apply_mapping(x, getattr(self, f'layer{layer}'))
+            for sentence, mapped in zip(batch, np.split(x, np.cumsum(lens)[:-1])):
+                sentence[layer][0:len(mapped)] = mapped
         return batch
-            
-    def apply_mapping(self, sentence, W):
-        if W:
-            #print('apply_mapping=True')
-            if self.direction == 0:
-                input = [sentence, sentence]
-                mapped_sentence, _ = W.predict(input)
-            else:
-                input = [sentence, sentence]
-                _, mapped_sentence = W.predict(input)
-        else:
-            #print('apply_mapping=False')
-            mapped_sentence = sentence
 
-        return mapped_sentence
+    def apply_mapping(self, sentence, W):
+        if W is None:
+            return sentence
+        if hasattr(W, 'parameters'):
+            import torch
+            with torch.no_grad():
+                return W(torch.as_tensor(sentence, dtype=torch.float, device=self.device)).cpu().numpy()
+        mapped_sentence = W.predict_on_batch([sentence] * len(W.inputs))
+        if isinstance(mapped_sentence, list):
+            mapped_sentence = mapped_sentence[0 if self.direction == 0 else 1]
+        return np.asarray(mapped_sentence)
 
 class Muse():
     def __init__(self, args):
         import torch
-        self.layer0 = torch.load(args['map_layer0'])
-        self.layer1 = torch.load(args['map_layer1'])
-        self.layer2 = torch.load(args['map_layer2'])
+        # the matrices are kept as tensors on the device of the parser
+        self.device = args.get('device', 'cpu')
+        self.layer0 = torch.as_tensor(torch.load(args['map_layer0']), dtype=torch.float, device=self.device)
+        self.layer1 = torch.as_tensor(torch.load(args['map_layer1']), dtype=torch.float, device=self.device)
+        self.layer2 = torch.as_tensor(torch.load(args['map_layer2']), dtype=torch.float, device=self.device)
+        # the matrices mapping each layer by x @ W
+        self.weights = [self.layer0.t(), self.layer1.t(), self.layer2.t()]
 
-    def map_batch(self, batch):
-        for x,sentence in enumerate(batch):
-            seqlen = sentence[0].shape[0]
-            batch[x][0][0:seqlen] = self.apply_mapping(sentence[0], self.layer0)
-            batch[x][1][0:seqlen] = self.apply_mapping(sentence[1], self.layer1)
-            batch[x][2][0:seqlen] = self.apply_mapping(sentence[2], self.layer2)
+    def map_batch(self, batch, layers=(0, 1, 2)):
+        batch = writeable(batch)
+        lens = [sentence[0].shape[0] for sentence in batch]
+        for layer in layers:
+            # all tokens of the batch are mapped at once
+            x = np.concatenate([sentence[layer] for sentence in batch])
+            x = self.apply_mapping(x, getattr(self, f'layer{layer}'))
+            for sentence, mapped in zip(batch, np.split(x, np.cumsum(lens)[:-1])):
+                sentence[layer][0:len(mapped)] = mapped
         return batch
 
+    def map_tensor(self, x, layers=(0, 1, 2)):
+        # x: [batch_size, seq_len, n_layers*n_embed], padded positions stay zeros under the linear mapping
+        x = x.view(*x.shape[:-1], -1, self.layer0.shape[-1])
+        for layer in layers:
+            x[..., layer, :] = x[..., layer, :] @ getattr(self, f'layer{layer}').t()
+        return x.view(*x.shape[:-2], -1)
+
     def apply_mapping(self, sentence, W):
-        mapped_sentence = np.array([np.matmul(W,v) for v in sentence])
-        return mapped_sentence
+        import torch
+        mapped_sentence = torch.as_tensor(sentence, dtype=W.dtype, device=W.device) @ W.t()
+        return mapped_sentence.cpu().numpy()
 
 class Vecmap():
     def __init__(self, args):
@@ -65,17 +96,31 @@ class Vecmap():
             self.lang = 'wz2'
         else:
             self.lang = None
-        if 'orthogonal' in args:
-            self.orth = args['orthogonal']
-    
-    def map_batch(self, batch):    
-        for x,sentence in enumerate(batch):
-            seqlen = sentence[0].shape[0]
-            batch[x][0][0:seqlen] = self.apply_mapping(sentence[0], self.layer0)
-            batch[x][1][0:seqlen] = self.apply_mapping(sentence[1], self.layer1)
-            batch[x][2][0:seqlen] = self.apply_mapping(sentence[2], self.layer2)
+        self.orth = args.get('orthogonal', False)
+        # W2·diag(s^0.5) of each layer, composed once so that a layer is mapped by a single matrix product
+        self.weights = [self.compose(W) for W in (self.layer0, self.layer1, self.layer2)]
+
+    def compose(self, W):
+        if not W:
+            return None
+        if self.orth:
+            return np.asarray(W[self.lang], dtype=np.float32)
+        return (np.asarray(W[self.lang]) * np.asarray(W['s'])**0.5).astype(np.float32)
+
+    def map_batch(self, batch, layers=(0, 1, 2)):
+        batch = writeable(batch)
+        # all tokens of the batch are packed into a [total_tokens, 1024] array per layer
+        lens = [sentence[0].shape[0] for sentence in batch]
+        for layer in layers:
+            W = self.weights[layer]
+            if W is None:
+                continue
+            x = np.concatenate([sentence[layer] for sentence in batch]).astype(np.float32, copy=False)
+            x = normalize_segments(x, lens)
+            for sentence, mapped in zip(batch, np.split(x.dot(W), np.cumsum(lens)[:-1])):
+                sentence[layer][0:len(mapped)] = mapped
         return batch
-    
+
     def apply_mapping(self, sentence, W):
         if W:
             #print('apply_mapping=True')
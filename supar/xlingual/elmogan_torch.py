@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+ACTIVATIONS = {'relu': nn.ReLU, 'tanh': nn.Tanh, 'sigmoid': nn.Sigmoid, 'elu': nn.ELU, 'selu': nn.SELU}
+
+
+def flatten(layers):
+    for layer in layers:
+        # the generators may be nested models
+        if hasattr(layer, 'layers'):
+            yield from flatten(layer.layers)
+        else:
+            yield layer
+
+
+def convert(model, direction=0):
+    r"""
+    Converts the generator of a trained Elmogan Keras model into an equivalent chain of torch layers.
+
+    Only the generator producing the requested direction is converted.
+    The supported Keras layers are ``Dense``, ``Activation``, ``LeakyReLU``, ``BatchNormalization``,
+    ``Dropout`` and ``InputLayer``, which are expected to form a chain.
+
+    Args:
+        model (str or tf.keras.Model):
+            The Keras model or the path to it.
+        direction (int):
+            The output of the model to convert, 0 for xx->yy and 1 for yy->xx. Default: 0.
+
+    Returns:
+        A list of ``(name, kwargs)`` tuples describing the layers, and the state dict of the corresponding
+        :class:`torch.nn.Sequential`, which can be fed to :func:`build`.
+    """
+
+    if isinstance(model, str):
+        from tensorflow.keras.models import load_model
+        model = load_model(model)
+    if len(model.outputs) > 1:
+        from tensorflow.keras.models import Model
+        model = Model(model.inputs, model.outputs[0 if direction == 0 else 1])
+
+    layers, state_dict = [], {}
+    for layer in flatten(model.layers):
+        kind = layer.__class__.__name__
+        if kind in ('InputLayer', 'Dropout', 'GaussianNoise'):
+            continue
+        i = str(len(layers))
+        if kind == 'Dense':
+            kernel = layer.kernel.numpy()
+            layers.append(('linear', {'in_features': kernel.shape[0], 'out_features': kernel.shape[1],
+                                      'bias': layer.use_bias}))
+            state_dict[f'{i}.weight'] = torch.tensor(kernel.T)
+            if layer.use_bias:
+                state_dict[f'{i}.bias'] = torch.tensor(layer.bias.numpy())
+            activation = layer.activation.__name__
+        elif kind == 'Activation':
+            activation = layer.activation.__name__
+        elif kind == 'LeakyReLU':
+            alpha = getattr(layer, 'alpha', getattr(layer, 'negative_slope', 0.3))
+            layers.append(('leaky_relu', {'negative_slope': float(alpha)}))
+            continue
+        elif kind == 'BatchNormalization':
+            mean, var = layer.moving_mean.numpy(), layer.moving_variance.numpy()
+            layers.append(('batch_norm', {'num_features': len(mean), 'eps': float(layer.epsilon)}))
+            state_dict[f'{i}.weight'] = torch.tensor(layer.gamma.numpy() if layer.scale else np.ones_like(mean))
+            state_dict[f'{i}.bias'] = torch.tensor(layer.beta.numpy() if layer.center else np.zeros_like(mean))
+            state_dict[f'{i}.running_mean'] = torch.tensor(mean)
+            state_dict[f'{i}.running_var'] = torch.tensor(var)
+            continue
+        else:
+            raise ValueError(f"Unsupported layer {layer.name} of type {kind}")
+        if activation != 'linear':
+            if activation not in ACTIVATIONS:
+                raise ValueError(f"Unsupported activation {activation} of layer {layer.name}")
+            layers.append((activation, {}))
+    return layers, state_dict
+
+
+def build(layers, state_dict=None):
+    r"""
+    Builds the torch generator from the layers described by :func:`convert`.
+
+    Args:
+        layers (list[tuple]):
+            A list of ``(name, kwargs)`` tuples.
+        state_dict (dict):
+            The parameters and buffers of the generator. Default: ``None``.
+
+    Returns:
+        A :class:`torch.nn.Sequential` in evaluation mode.
+    """
+
+    modules = {'linear': nn.Linear, 'leaky_relu': nn.LeakyReLU, 'batch_norm': nn.BatchNorm1d, **ACTIVATIONS}
+    generator = nn.Sequential(*[modules[name](**kwargs) for name, kwargs in layers])
+    if state_dict is not None:
+        generator.load_state_dict(state_dict)
+    return generator.eval()
+
+
+def save(path, layers, state_dict):
+    torch.save({'layers': layers, 'state_dict': state_dict}, path)
+
+
+def load(path, device='cpu'):
+    r"""
+    Loads a generator exported by the converter, which requires no TensorFlow.
+
+    Args:
+        path (str):
+            The path to the exported generator.
+        device (str):
+            The device to put the generator on. Default: ``'cpu'``.
+
+    Returns:
+        A frozen :class:`torch.nn.Sequential`.
+    """
+
+    state = torch.load(path, map_location='cpu')
+    return build(state['layers'], state['state_dict']).to(device).requires_grad_(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the generator of an Elmogan Keras model to torch.')
+    parser.add_argument('--model', required=True, help='path to the Keras model')
+    parser.add_argument('--direction', choices=[0, 1], type=int, default=0,
+                        help='which direction to export, 0 implies xx->yy, 1 implies yy->xx')
+    parser.add_argument('--output', required=True, help='path to save the torch generator')
+    parser.add_argument('--check', type=int, default=100, help='num of random vectors to check the export with')
+    args = parser.parse_args()
+
+    from tensorflow.keras.models import load_model
+
+    model = load_model(args.model)
+    layers, state_dict = convert(model, args.direction)
+    save(args.output, layers, state_dict)
+    if args.check > 0:
+        x = np.random.randn(args.check, model.inputs[0].shape[-1]).astype(np.float32)
+        expected = model.predict_on_batch([x] * len(model.inputs))
+        if isinstance(expected, list):
+            expected = expected[0 if args.direction == 0 else 1]
+        with torch.no_grad():
+            mapped = load(args.output)(torch.tensor(x)).numpy()
+        print(f"Max absolute difference to the Keras model: {np.abs(mapped - np.asarray(expected)).max():.4e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import random
+import timeit
+
+from supar.utils import tarjan
+from supar.utils.transform import CoNLL
+
+
+def sample(length, rng):
+    # random heads, which mostly contain cycles
+    heads = [rng.randint(0, length) for _ in range(length)]
+    # a tree built by attaching each token to one placed before it
+    order = rng.sample(range(1, length + 1), length)
+    tree = [0] * length
+    for i, dep in enumerate(order[1:], 1):
+        tree[dep - 1] = order[rng.randrange(i)]
+    return heads, tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of finding cycles.')
+    parser.add_argument('--lens', default=[10, 20, 50, 100, 200, 500], type=int, nargs='+',
+                        help='lengths of the sentences')
+    parser.add_argument('--n-sents', default=1000, type=int, help='num of sentences of each length')
+    parser.add_argument('--seed', '-s', default=1, type=int, help='seed for generating random heads')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'Length':>6} | {'tarjan (random)':>19} | {'tarjan (tree)':>19} | {'istree (tree)':>19}")
+    for length in args.lens:
+        sequences, trees = zip(*[sample(length, rng) for _ in range(args.n_sents)])
+        times = [timeit.timeit(lambda: [list(tarjan(seq)) for seq in sequences], number=1),
+                 timeit.timeit(lambda: [list(tarjan(seq)) for seq in trees], number=1),
+                 timeit.timeit(lambda: [CoNLL.istree(seq) for seq in trees], number=1)]
+        print(f"{length:>6} | " + ' | '.join(f"{args.n_sents / t:>10.2f} sents/s" for t in times))
+
+
+if __name__ == '__main__':
+    main()
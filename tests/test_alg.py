@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from supar.utils import tarjan
+import itertools
+import multiprocessing as mp
+import random
+
+import torch
+from supar.models import BiaffineDependencyModel
+from supar.utils import bucketize, cky, eisner, eisner2o, istree, mst, tarjan
+from supar.utils.transform import CoNLL
 
 
 def test_tarjan():
@@ -14,3 +21,168 @@ def test_tarjan():
             assert next(tarjan(sequence), None) == answer
         else:
             assert list(tarjan(sequence)) == answer
+    # long chains should not hit the recursion limit
+    sequence = list(range(2, 10001)) + [10000 - 1]
+    assert list(tarjan(sequence)) == [[10000, 9999]]
+
+
+def test_bucketize():
+    def cost(x, buckets, objective):
+        costs = []
+        for bucket in buckets:
+            lens = [x[i] for i in bucket]
+            if objective == 'kmeans':
+                costs.append(sum((i - sum(lens) / len(lens)) ** 2 for i in lens))
+            else:
+                costs.append(sum(max(lens) - i for i in lens))
+        return sum(costs)
+
+    x = [15, 10, 17, 11, 18, 13, 17, 19, 18, 14, 3, 3, 10]
+    values = sorted(set(x))
+    for objective in ('kmeans', 'padding'):
+        for k in range(1, 5):
+            centroids, buckets = bucketize(x, k, objective)
+            assert sorted(i for bucket in buckets for i in bucket) == list(range(len(x)))
+            # the buckets are optimal among all splits of the sorted distinct lengths
+            best = min(cost(x, [[i for i, j in enumerate(x) if values[start] <= j <= values[end - 1]]
+                                for start, end in zip((0, *splits), (*splits, len(values)))], objective)
+                       for splits in itertools.combinations(range(1, len(values)), k - 1))
+            assert abs(cost(x, buckets, objective) - best) < 1e-6
+    assert bucketize([], 4) == ([], [])
+    # a single bucket holding all sentences
+    assert bucketize(x, 1) == ([sum(x) / len(x)], [list(range(len(x)))])
+    # each distinct length in its own bucket if there are no more than the buckets
+    for k in (len(values), len(values) + 3):
+        centroids, buckets = bucketize(x, k)
+        assert centroids == values
+        assert buckets == [[i for i, j in enumerate(x) if j == value] for value in values]
+
+    # the optimal costs of all splits into k buckets, by the plain O(km^2) dynamic programming
+    def optimal(x, k, objective):
+        values = sorted(set(x))
+        costs = [[cost(x, [[i for i, j in enumerate(x) if values[start] <= j <= values[end]]], objective)
+                  for end in range(len(values))] for start in range(len(values))]
+        dp = costs[0]
+        for _ in range(1, min(k, len(values))):
+            dp = [min((dp[i - 1] + costs[i][j] for i in range(1, j + 1)), default=float('inf'))
+                  for j in range(len(values))]
+        return dp[-1]
+
+    rng = random.Random(1)
+    for _ in range(10):
+        x = [rng.randint(1, 40) for _ in range(rng.randint(1, 100))]
+        for objective in ('kmeans', 'padding'):
+            for k in (2, 5, 13):
+                _, buckets = bucketize(x, k, objective)
+                assert abs(cost(x, buckets, objective) - optimal(x, k, objective)) < 1e-6
+
+
+def test_mst():
+    torch.manual_seed(1)
+    for multiroot in (False, True):
+        for seq_len in range(2, 7):
+            scores = torch.randn(16, seq_len, seq_len, dtype=torch.double)
+            scores[:, 0, 1:] = float('-inf')
+            scores.diagonal(0, 1, 2)[1:].fill_(float('-inf'))
+            mask = torch.ones(16, seq_len, dtype=torch.bool)
+            mask[:, 0] = False
+            trees = mst(scores, mask, multiroot, fast=True)
+            # the best tree among all possible ones
+            for s, tree in zip(scores, trees.tolist()):
+                assert CoNLL.istree(tree[1:], multiroot=multiroot)
+                best = max(sum(s[i, j] for i, j in enumerate(heads, 1))
+                           for heads in itertools.product(range(seq_len), repeat=seq_len - 1)
+                           if CoNLL.istree(list(heads), multiroot=multiroot))
+                assert abs(sum(s[i, j] for i, j in enumerate(tree[1:], 1)) - best) < 1e-6
+
+
+def test_pool():
+    torch.manual_seed(1)
+    s_arc, s_rel = torch.randn(32, 12, 12), torch.randn(32, 12, 12, 3)
+    # sentences of various lengths padded to the longest one
+    mask = torch.arange(12).lt(torch.randint(2, 13, (32, 1)))
+    mask[:, 0] = False
+    model = BiaffineDependencyModel(n_words=10, n_feats=10, n_rels=3, n_embed=4, n_feat_embed=4, n_char_embed=4,
+                                    n_lstm_hidden=4, n_lstm_layers=1, n_mlp_arc=4, n_mlp_rel=4)
+    with mp.get_context('spawn').Pool(2) as pool:
+        for fast in (False, True):
+            for multiroot in (False, True):
+                assert torch.equal(mst(s_arc, mask, multiroot, fast, pool), mst(s_arc, mask, multiroot, fast))
+            for proj in (False, True):
+                for serial, parallel in zip(model.decode(s_arc, s_rel, mask, True, proj, fast),
+                                            model.decode(s_arc, s_rel, mask, True, proj, fast, pool)):
+                    assert torch.equal(serial[mask], parallel[mask])
+
+
+def projective_trees(n):
+    # all projective single-root trees of n tokens, as sequences of heads
+    return [list(heads) for heads in itertools.product(range(n + 1), repeat=n) if CoNLL.istree(list(heads), True)]
+
+
+def test_eisner():
+    torch.manual_seed(1)
+    lens = torch.tensor([1, 2, 3, 4, 5] * 4)
+    mask = torch.arange(6).unsqueeze(0).le(lens.unsqueeze(-1))
+    mask[:, 0] = False
+    s_arc, s_sib = torch.randn(20, 6, 6, dtype=torch.double), torch.randn(20, 6, 6, 6, dtype=torch.double)
+    # the second half of the sentences are partially annotated, with the head of a token fixed
+    for b in range(10, 20):
+        rng = random.Random(b)
+        dep = rng.randint(1, lens[b].item())
+        head = rng.choice([i for i in range(lens[b].item() + 1) if i != dep])
+        s_arc[b, dep, torch.arange(6).ne(head)] = float('-inf')
+    trees = {n: projective_trees(n) for n in range(1, 6)}
+
+    def score(b, heads, second_order):
+        arcs = [s_arc[b, dep, head].item() for dep, head in enumerate(heads, 1)]
+        if not second_order:
+            return sum(arcs)
+        sibs = [s_sib[b, dep, head, sib].item() for dep, (head, sib) in enumerate(zip(heads, CoNLL.get_sibs(heads)), 1)
+                if sib > 0]
+        return sum(arcs) + sum(sibs)
+
+    for second_order in (False, True):
+        preds = eisner2o((s_arc, s_sib), mask) if second_order else eisner(s_arc, mask)
+        for b, n in enumerate(lens.tolist()):
+            pred = preds[b, 1:n+1].tolist()
+            assert pred in trees[n]
+            best = max(score(b, heads, second_order) for heads in trees[n])
+            assert abs(score(b, pred, second_order) - best) < 1e-6
+
+
+def test_cky():
+    torch.manual_seed(1)
+    lens = torch.tensor([1, 2, 3, 4, 5] * 4)
+    mask = (torch.arange(6).unsqueeze(-1).lt(torch.arange(6))).unsqueeze(0) & torch.arange(6).le(lens.view(-1, 1, 1))
+    scores = torch.randn(20, 6, 6, dtype=torch.double)
+    # the second half of the sentences are constrained, with a random span of at least two tokens disallowed
+    for b in range(10, 20):
+        if lens[b] > 2:
+            rng = random.Random(b)
+            i = rng.randint(0, lens[b].item() - 2)
+            j = rng.randint(i + 2, lens[b].item())
+            if j - i < lens[b]:
+                scores[b, i, j] = float('-inf')
+
+    def trees(i, j):
+        # all binary trees over the span [i, j), traversed in pre-order
+        if j == i + 1:
+            return [[(i, j)]]
+        return [[(i, j)] + left + right for k in range(i + 1, j) for left in trees(i, k) for right in trees(k, j)]
+
+    for b, tree in enumerate(cky(scores, mask)):
+        candidates = trees(0, lens[b].item())
+        best = max(candidates, key=lambda t: sum(scores[b, i, j].item() for i, j in t))
+        assert tree == best
+
+
+def test_istree():
+    torch.manual_seed(1)
+    lens = torch.randint(1, 8, (1000,))
+    mask = torch.arange(8).unsqueeze(0).le(lens.unsqueeze(-1))
+    mask[:, 0] = False
+    heads = torch.randint(0, 8, (1000, 8)).min(lens.unsqueeze(-1))
+    for proj in (False, True):
+        for multiroot in (False, True):
+            assert istree(heads, mask, proj, multiroot).tolist() == [CoNLL.istree(seq[1:i+1], proj, multiroot)
+                                                                     for i, seq in zip(lens.tolist(), heads.tolist())]
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from supar.parsers.parser import Parser
+from supar.utils import CoNLL, Config, Dataset, Field, bucketize
+from supar.utils.common import bos, eos, pad, unk
+from supar.utils.data import Sampler, prefetch
+from supar.utils.field import SubwordField
+from supar.utils.fn import pad as pad_tensors
+from supar.utils.transform import CoNLLCorpus
+
+
+def write(path, n_sentences=60, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for _ in range(n_sentences):
+            length = rng.randint(1, 20)
+            # each token is attached to the root or a token placed before it
+            heads = [rng.randint(0, i) for i in range(length)]
+            for i, head in enumerate(heads, 1):
+                word, tag, rel = f"w{rng.randint(0, 30)}", f"T{rng.randint(0, 5)}", f"r{rng.randint(0, 4)}"
+                f.write(f"{i}\t{word}\t_\t{tag}\t_\t_\t{head}\t{rel}\t_\t_\n")
+            f.write('\n')
+
+
+@pytest.fixture
+def transform(tmp_path):
+    path = str(tmp_path / 'train.conllx')
+    write(path)
+    WORD = Field('words', pad=pad, unk=unk, bos=bos, lower=True)
+    CPOS = Field('tags', bos=bos)
+    ARC = Field('arcs', bos=bos, use_vocab=False, fn=CoNLL.get_arcs)
+    REL = Field('rels', bos=bos)
+    transform = CoNLL(FORM=WORD, CPOS=CPOS, HEAD=ARC, DEPREL=REL)
+    train = Dataset(transform, path)
+    for field in (WORD, CPOS, REL):
+        field.build(train)
+    return transform
+
+
+def test_cache(tmp_path, transform):
+    path, cache = str(tmp_path / 'data.conllx'), str(tmp_path / 'cache')
+    write(path, seed=2)
+    cold = Dataset(transform, path)
+    cold.build(100, 4)
+    Dataset(transform, path, cache=cache).build(100, 4)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the cached data should not be loaded again")
+    load, transform.load = transform.load, fail
+    try:
+        warm = Dataset(transform, path, cache=cache)
+        warm.build(100, 4)
+    finally:
+        transform.load = load
+    assert [str(i) for i in warm.sentences] == [str(i) for i in cold.sentences]
+    assert list(warm.fields) == list(cold.fields)
+    for field in cold.fields:
+        assert all(torch.equal(i, j) for i, j in zip(warm.fields[field], cold.fields[field]))
+    assert warm.lengths == cold.lengths
+    assert warm.buckets == cold.buckets
+    # the vocabs of pretrained tokenizers are dicts
+    vocab, transform.FORM.vocab = transform.FORM.vocab, dict(transform.FORM.vocab.stoi)
+    try:
+        assert Dataset(transform, path).cache_dir(cache) != warm.cache
+    finally:
+        transform.FORM.vocab = vocab
+
+
+def test_cache_empty(tmp_path, transform):
+    path, cache = str(tmp_path / 'data.conllx'), str(tmp_path / 'cache')
+    write(path, seed=2)
+    dataset = Dataset(transform, path, cache=cache, indices=[])
+    dataset.fields = transform(dataset.sentences)
+    dataset.lengths = []
+    dataset.save(dataset.cache)
+    dataset = Dataset(transform, path, cache=cache, indices=[])
+    assert len(dataset) == 0 and dataset.lengths == []
+    assert all(len(i) == 0 for i in dataset.fields.values())
+
+
+def test_parallel_columnar(tmp_path, transform):
+    path = str(tmp_path / 'data.conllx')
+    write(path, seed=2)
+    serial, parallel = Dataset(transform, path, columnar=True), Dataset(transform, path, 4, columnar=True)
+    assert isinstance(parallel.sentences, CoNLLCorpus)
+    assert [str(i) for i in parallel.sentences] == [str(i) for i in serial.sentences]
+    serial.build(100, 4)
+    parallel.build(100, 4)
+    for field in serial.fields:
+        assert all(torch.equal(i, j) for i, j in zip(parallel.fields[field], serial.fields[field]))
+
+
+def test_stream(tmp_path, transform):
+    for seed in range(3):
+        write(str(tmp_path / f"shard{seed}.conllx"), seed=seed)
+    # the arguments of `Parser.train`, which include the path of the model besides the loading options
+    args = Config(path=str(tmp_path / 'model'), train=str(tmp_path / 'shard*.conllx'), stream=16, proj=False,
+                  max_len=10, data_cache=None, workers=0, batch_size=100, buckets=4)
+    train = Parser(args, None, transform)._load_train(args)
+    train.build(args.batch_size, args.buckets, True)
+    lengths = [n for batch in train.loader for n in batch.words.ne(transform.FORM.pad_index).sum(1).tolist()]
+    sentences = [i for seed in range(3)
+                 for i in Dataset(transform, str(tmp_path / f"shard{seed}.conllx"), max_len=10).sentences]
+    # each sentence is prepended with the bos token
+    assert sorted(lengths) == sorted(len(i.words) + 1 for i in sentences)
+
+
+def test_predict_stream(tmp_path, transform):
+    class Echo(Parser):
+        def _predict(self, loader):
+            return {}
+
+    args = Config(window=16, batch_size=100, buckets=4, prefetch=0, cost_aware=False)
+    data, pred = str(tmp_path / 'data.conllx'), str(tmp_path / 'pred.conllx')
+    write(data, seed=2)
+    assert Echo(args, None, transform)._stream(data, pred) is None
+    with open(data) as f, open(pred) as g:
+        assert g.read().split() == f.read().split()
+    # the results of the previous run are overwritten even if there are no sentences
+    open(data, 'w').close()
+    Echo(args, None, transform)._stream(data, pred)
+    with open(pred) as f:
+        assert f.read() == ''
+
+
+def test_field():
+    rng = random.Random(1)
+    sequences = [[rng.choice('aAbBcdEF') * rng.randint(1, 3) for _ in range(rng.randint(0, 8))] for _ in range(50)]
+    fields = [Field('words', pad=pad, unk=unk, bos=bos, eos=eos, lower=True),
+              Field('words', pad=pad, unk=unk, bos=bos),
+              Field('words', pad=pad, unk=unk, eos=eos, fn=lambda seq: [token[::-1] for token in seq]),
+              Field('words', pad=pad, unk=unk),
+              Field('heads', bos=bos, use_vocab=False, fn=lambda seq: [len(token) for token in seq])]
+    for field in fields:
+        if field.use_vocab:
+            # the tokens in the last sentences are left out of the vocab
+            field.build(SimpleNamespace(words=sequences[:5]))
+        tensors = field.transform(sequences)
+        # the ids of each sequence one by one
+        for seq, tensor in zip(sequences, tensors):
+            ids = field.preprocess(seq)
+            if field.use_vocab:
+                ids = [field.vocab.stoi.get(token, field.unk_index) for token in ids]
+            ids = ([field.bos_index] if field.bos else []) + ids + ([field.eos_index] if field.eos else [])
+            assert tensor.tolist() == ids
+        assert len(tensors) == len(sequences)
+        assert field.transform([]) == []
+
+
+def test_subword_field():
+    rng = random.Random(1)
+    sequences = [[''.join(rng.choice('abcdeXYZ') for _ in range(rng.randint(0, 6))) for _ in range(rng.randint(1, 8))]
+                 for _ in range(50)]
+    for fix_len, cache_size in ((0, 65536), (3, 4)):
+        field = SubwordField('chars', pad=pad, unk=unk, bos=bos, eos=eos, lower=True,
+                             fix_len=fix_len, cache_size=cache_size, tokenize=list)
+        field.build(SimpleNamespace(chars=sequences[:5]))
+        # the pieces of each token padded sentence by sentence
+        pieces = [[field.preprocess(token) for token in seq] for seq in sequences]
+        fix_len = field.fix_len or max(len(token) for seq in pieces for token in seq)
+        pieces = [[[field.vocab.stoi.get(i, field.unk_index) for i in token] if token else [field.unk_index]
+                   for token in seq] for seq in pieces]
+        pieces = [[[field.bos_index]] + seq + [[field.eos_index]] for seq in pieces]
+        lens = [min(fix_len, max(len(ids) for ids in seq)) for seq in pieces]
+        expected = [pad_tensors([torch.tensor(ids[:i]) for ids in seq], field.pad_index, i)
+                    for i, seq in zip(lens, pieces)]
+        # transformed twice to check the memoized pieces
+        for _ in range(2):
+            tensors = field.transform(sequences)
+            assert len(tensors) == len(expected)
+            assert all(torch.equal(x, y) for x, y in zip(tensors, expected))
+        assert len(field.memo) <= cache_size
+    # the memo is not pickled
+    assert 'memo' not in field.__getstate__()
+
+
+def test_sampler():
+    rng = random.Random(1)
+    lengths = [rng.randint(1, 80) for _ in range(2000)]
+    mean, batch_size = sum(lengths) / len(lengths), 1000
+
+    def costs(sampler, cost):
+        batches = list(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+        return [sum(lengths[i] ** cost for i in batch) for batch in batches]
+
+    for cost in (2, 3):
+        budget = batch_size * mean ** (cost - 1)
+        # with a bucket per length, each batch costs at most one sentence more than the budget
+        buckets = dict(zip(*bucketize(lengths, 100)))
+        sampler = Sampler(buckets, batch_size, True, cost=cost, lengths=lengths)
+        assert all(c <= budget + max(lengths) ** cost for c in costs(sampler, cost))
+        # with fewer buckets, the mean cost of the batches of each bucket is within the budget
+        buckets = dict(zip(*bucketize(lengths, 8)))
+        sampler = Sampler(buckets, batch_size, cost=cost, lengths=lengths)
+        for bucket, chunks in zip(sampler.buckets, sampler.chunks):
+            assert sum(lengths[i] ** cost for i in bucket) / chunks <= budget
+        # batches of long sentences are no longer far more costly than those of short ones by token counts
+        assert max(costs(sampler, cost)) < max(costs(Sampler(buckets, batch_size, lengths=lengths), cost))
+
+
+def test_prefetch(tmp_path, transform):
+    assert list(prefetch(iter(range(100)), 2)) == list(range(100))
+
+    def fail():
+        yield from range(3)
+        raise ValueError("failed while preparing the batch")
+    items = prefetch(fail(), 2)
+    assert [next(items) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(items)
+
+    produced = []
+
+    def produce():
+        while True:
+            produced.append(len(produced))
+            yield produced[-1]
+    n_threads, items = threading.active_count(), prefetch(produce(), 2)
+    for i in range(5):
+        assert next(items) == i
+        time.sleep(.05)
+        # the queue is bounded, so that the producer never runs far ahead of the consumer
+        assert len(produced) <= i + 4
+    # the producer is stopped once the consumer is closed
+    items.close()
+    assert threading.active_count() == n_threads
+    n_produced = len(produced)
+    time.sleep(.05)
+    assert len(produced) == n_produced
+
+    path = str(tmp_path / 'data.conllx')
+    write(path, seed=2)
+    dataset = Dataset(transform, path)
+    batches = []
+    for size in (0, 2):
+        dataset.build(10, 4, prefetch=size)
+        batches.append(list(dataset.loader))
+    assert len(batches[0]) == len(batches[1])
+    assert all(torch.equal(i.words, j.words) for i, j in zip(*batches))
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType, SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from supar import BiaffineDependencyParser
+from supar.models import BiaffineDependencyModel
+from supar.utils import Config, ElmoCache, Field
+from supar.utils.elmo import ElmoTypeCache, TypeTable, pad_layers, registered
+from supar.xlingual import elmogan_torch
+from supar.xlingual.elmo_mapper import Elmogan, Muse, Vecmap
+
+
+def test_cache_unchanged_by_mapping(tmp_path):
+    rng = np.random.RandomState(1)
+    sentences = [['She', 'enjoys', 'tennis'], ['He', 'runs']]
+    embs = {tuple(tokens): rng.randn(3, len(tokens), 4).astype(np.float32) for tokens in sentences}
+
+    parser = BiaffineDependencyParser.__new__(BiaffineDependencyParser)
+    parser.args = Config(feat='elmo', map_method='vecmap')
+    parser.model = nn.Module().eval()
+    parser.FEAT = Field('feats')
+    parser.elmo = SimpleNamespace(embed_batch=lambda batch: [embs[tuple(tokens)].copy() for tokens in batch])
+    parser.cache = ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4)
+    parser.mapper = Vecmap.__new__(Vecmap)
+    parser.mapper.weights = [rng.randn(4, 4).astype(np.float32) for _ in range(3)]
+    parser.types = None
+
+    batch = namedtuple('Batch', ['words', 'feats'])(torch.ones(2, 3, dtype=torch.long), sentences)
+    # the first batch computes the representations, and the second reads them from the cache
+    feats = [parser._compose(batch).feats for _ in range(3)]
+    for tokens in sentences:
+        assert np.array_equal(parser.cache[tokens], embs[tuple(tokens)])
+    assert torch.equal(feats[0], feats[1]) and torch.equal(feats[1], feats[2])
+
+
+def test_mapping_mismatch():
+    torch.manual_seed(1)
+    parser = BiaffineDependencyParser.__new__(BiaffineDependencyParser)
+    parser.model = BiaffineDependencyModel(n_words=10, n_feats=10, n_rels=3, feat='elmo', mapping='muse', n_lstm_hidden=4,
+                                           n_lstm_layers=1, n_mlp_arc=4, n_mlp_rel=4).eval()
+    parser.mapper = None
+    # the biaffine layers are initialized with zeros, which would hide the changes of the inputs
+    for attn in (parser.model.arc_attn, parser.model.rel_attn):
+        nn.init.normal_(attn.weight)
+    words, feats = torch.ones(2, 3, dtype=torch.long), torch.randn(2, 3, 3*1024)
+    parser.model.mapping.enabled = False
+    unmapped = parser.model(words, feats)
+    parser.model.mapping.load([torch.randn(1024, 1024) for _ in range(3)])
+    parser._set_mapping('muse')
+    assert not torch.equal(parser.model(words, feats)[0], unmapped[0])
+    # the features mapped by another mapper or not at all are left untouched by the model
+    for map_method in ('elmogan', 'none', None):
+        parser._set_mapping(map_method)
+        assert all(torch.equal(i, j) for i, j in zip(parser.model(words, feats), unmapped))
+
+
+def test_cache_shared(tmp_path):
+    rng = np.random.RandomState(1)
+    sentences = [['She', 'enjoys', 'tennis'], ['He', 'runs'], ['Yes', '!'], ['I', 'like', 'it', '.']]
+    embs = {tuple(tokens): rng.randn(3, len(tokens), 4).astype(np.float32) for tokens in sentences}
+    # two processes, e.g., DDP ranks, appending to the same files
+    caches = [ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4) for _ in range(2)]
+    for i, tokens in enumerate(sentences):
+        caches[i % 2].update([tokens], [embs[tuple(tokens)]])
+    for i, tokens in enumerate(sentences):
+        assert np.array_equal(caches[i % 2][tokens], embs[tuple(tokens)])
+    cache = ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4)
+    assert len(cache) == len(sentences)
+    assert all(np.array_equal(cache[tokens], embs[tuple(tokens)]) for tokens in sentences)
+
+
+def test_mapping_saved():
+    parser = BiaffineDependencyParser.__new__(BiaffineDependencyParser)
+    parser.args = Config(device='cpu')
+    parser.model = BiaffineDependencyModel(n_words=10, n_feats=10, n_rels=3, feat='elmo', mapping='muse', n_lstm_hidden=4,
+                                           n_lstm_layers=1, n_mlp_arc=4, n_mlp_rel=4)
+    parser.model.mapping.load([torch.randn(1024, 1024) for _ in range(3)])
+    # a model loaded from the checkpoint holds the matrices, so the mapping files are not needed
+    model = BiaffineDependencyModel(**parser.model.args)
+    model.load_state_dict(parser.model.state_dict(), False)
+    parser.model = model
+    parser.mapper = parser._build_mapper({'map_method': 'muse', 'map_layer0': None})
+    assert parser.mapper is None
+    parser._set_mapping('muse')
+    assert parser.model.mapping.enabled and torch.equal(model.mapping.weight, parser.model.mapping.weight)
+
+
+def test_type_cache():
+    rng = np.random.RandomState(1)
+    layer0 = rng.randn(4, 4).astype(np.float32)
+    calls = []
+
+    def apply_mapping(x, weights):
+        calls.append(len(x))
+        return x @ weights
+
+    mapper = SimpleNamespace(layer0=layer0, apply_mapping=apply_mapping, map_batch=lambda embs, layers: embs)
+    batches = [[['a', 'b', 'a'], ['c']], [['b', 'c']], [['d', 'a', 'e']]]
+    for max_size, n_calls in ((None, [3, 2]), (4, [3, 3])):
+        types, calls[:] = ElmoTypeCache(mapper=mapper, max_size=max_size), []
+        for batch in batches:
+            embs = [rng.randn(3, len(tokens), 4).astype(np.float32) for tokens in batch]
+            mapped = types.map_batch(batch, [emb.copy() for emb in embs])
+            for tokens, emb, out in zip(batch, embs, mapped):
+                # layers 1 and 2 are untouched, while layer 0 is taken from the first occurrence of each type
+                assert np.allclose(out[1:], emb[1:])
+                for token, vector in zip(tokens, out[0]):
+                    assert np.allclose(vector, types.mapped.data[types.mapped.stoi[token]])
+            assert len(types.mapped) <= (max_size or len(types.mapped))
+        # only the types missing from the cache are mapped, a flushed cache maps all types of the batch again
+        assert [i for i in calls if i] == n_calls
+    assert not types.mapped.data[0].any()
+
+    # the table grows geometrically and keeps the vectors already added
+    table = TypeTable()
+    vectors = torch.randn(3000, 4)
+    for i in range(0, 3000, 100):
+        table.add([str(j) for j in range(i, i + 100)], vectors[i:i+100])
+    assert len(table) == 3000 and len(table.data) == 4096
+    assert torch.equal(table.data[table.index([str(j) for j in range(3000)])], vectors)
+
+
+def test_pad_layers():
+    embs = [np.arange(3 * i * 4, dtype=np.float32).reshape(3, i, 4) for i in (2, 5, 1)]
+    embs[0].flags.writeable = False
+    x = pad_layers(embs, (3, 6))
+    assert x.shape == (3, 6, 12)
+    for i, emb in enumerate(embs):
+        assert torch.equal(x[i, :emb.shape[1]], torch.tensor(emb.transpose(1, 0, 2).reshape(emb.shape[1], -1)))
+        assert not x[i, emb.shape[1]:].any()
+
+
+def test_vecmap():
+    rng = np.random.RandomState(1)
+    batch = [rng.randn(3, i, 8).astype(np.float32) for i in (4, 1, 6)]
+    layer = {'wx2': rng.randn(8, 8).astype(np.float32), 's': rng.rand(8).astype(np.float32) + 0.5}
+    for orth in (False, True):
+        mapper = Vecmap.__new__(Vecmap)
+        mapper.lang, mapper.orth = 'wx2', orth
+        # layer 2 is left unmapped
+        mapper.layer0, mapper.layer1, mapper.layer2 = layer, layer, None
+        mapper.weights = [mapper.compose(W) for W in (mapper.layer0, mapper.layer1, mapper.layer2)]
+        mapped = mapper.map_batch([sentence.copy() for sentence in batch])
+        # the packed batch is mapped the same as each sentence one by one
+        for sentence, emb in zip(batch, mapped):
+            for i, W in enumerate((mapper.layer0, mapper.layer1, mapper.layer2)):
+                assert np.allclose(emb[i], mapper.apply_mapping(sentence[i].copy(), W), atol=1e-5)
+
+
+def test_muse():
+    torch.manual_seed(1)
+    batch = [torch.randn(3, i, 8).numpy() for i in (4, 1, 6)]
+    mapper = Muse.__new__(Muse)
+    mapper.layer0, mapper.layer1, mapper.layer2 = torch.randn(3, 8, 8).unbind()
+    # the per-sentence mapping of each layer
+    expected = [np.stack([sentence[i] @ W.numpy().T for i, W in enumerate((mapper.layer0, mapper.layer1, mapper.layer2))])
+                for sentence in batch]
+    for sentence, emb in zip(expected, mapper.map_batch([sentence.copy() for sentence in batch])):
+        assert np.allclose(sentence, emb, atol=1e-5)
+    x = pad_layers(batch, (3, 6))
+    mapped = mapper.map_tensor(x.clone())
+    for i, sentence in enumerate(expected):
+        assert np.allclose(mapped[i, :sentence.shape[1]].view(-1, 3, 8).transpose(0, 1).numpy(), sentence, atol=1e-5)
+        assert not mapped[i, sentence.shape[1]:].any()
+    # layers left out are untouched
+    assert torch.equal(mapper.map_tensor(x.clone(), layers=(1, 2))[..., :8], x[..., :8])
+
+
+def test_cache(tmp_path):
+    rng = np.random.RandomState(1)
+    sentences = [['She', 'enjoys', 'tennis'], ['He', 'runs'], ['She', 'enjoys', 'tennis']]
+    embs = {tuple(tokens): rng.randn(3, len(tokens), 4).astype(np.float32) for tokens in sentences}
+    calls = []
+
+    def fn(batch):
+        calls.append(batch)
+        return [embs[tuple(tokens)] for tokens in batch]
+
+    cache = ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4)
+    # repeated sentences are computed only once, and cached ones never again
+    assert all(np.array_equal(emb, embs[tuple(tokens)]) for tokens, emb in zip(sentences, cache.embed(sentences, fn)))
+    assert all(np.array_equal(emb, embs[tuple(tokens)]) for tokens, emb in zip(sentences, cache.embed(sentences, fn)))
+    assert calls == [sentences[:2]]
+    # the lookups are read-only views into the memory map
+    assert not cache[sentences[0]].flags.writeable
+    # the same sentences of another embedder are not taken from the cache
+    assert sentences[0] not in ElmoCache(str(tmp_path / 'elmo'), 'other', n_layers=3, n_embed=4)
+    # the entries left incomplete by interrupted writes are discarded
+    with open(cache.bin, 'r+b') as f:
+        f.truncate(cache.size - 4)
+    cache = ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4)
+    assert sentences[0] in cache and sentences[1] not in cache
+
+
+def test_compose(tmp_path):
+    rng = np.random.RandomState(1)
+    sentences = [['She', 'enjoys', 'tennis'], ['He', 'runs'], ['Yes']]
+    embs = {tuple(tokens): rng.randn(3, len(tokens), 4).astype(np.float32) for tokens in sentences}
+
+    parser = BiaffineDependencyParser.__new__(BiaffineDependencyParser)
+    parser.args = Config(feat='elmo', map_method=None)
+    parser.model = nn.Module().eval()
+    parser.FEAT = Field('feats')
+    parser.elmo = SimpleNamespace(embed_batch=lambda batch: [embs[tuple(tokens)] for tokens in batch])
+    parser.mapper, parser.types = None, None
+    batch = namedtuple('Batch', ['words', 'feats'])(torch.ones(3, 4, dtype=torch.long), sentences)
+    # the layers of each token copied one by one and concatenated
+    layers = torch.zeros(3, 3, 4, 4)
+    for i, tokens in enumerate(sentences):
+        for j in range(len(tokens)):
+            for k in range(3):
+                layers[k, i, j] = torch.tensor(embs[tuple(tokens)][k, j])
+    expected = torch.cat(layers.unbind(), -1)
+    for cache in (None, ElmoCache(str(tmp_path / 'elmo'), 'elmo', n_layers=3, n_embed=4)):
+        parser.cache = cache
+        # the cached ones are read from the memory map
+        for _ in range(2):
+            assert torch.equal(parser._compose(batch).feats, expected)
+
+
+def test_registered(tmp_path):
+    calls = []
+
+    def load(name):
+        calls.append(name)
+        time.sleep(.05)
+        return object()
+    # concurrent requests load the object only once
+    with ThreadPoolExecutor(4) as executor:
+        objects = list(executor.map(lambda _: registered(('test', str(tmp_path)), load, 'a'), range(8)))
+    assert calls == ['a'] and all(i is objects[0] for i in objects)
+    assert registered(('test', str(tmp_path), 'b'), load, 'b') is not objects[0]
+
+    def fail():
+        raise OSError("failed to load")
+    # failed loads are not registered and can be retried
+    with pytest.raises(OSError):
+        registered(('test', str(tmp_path), 'c'), fail)
+    assert registered(('test', str(tmp_path), 'c'), load, 'c') is not None
+
+    # the mappers of the same files are shared by all parsers, regardless of how the paths are given
+    for i in range(3):
+        torch.save(torch.eye(4), str(tmp_path / f"layer{i}.pt"))
+    parsers = [BiaffineDependencyParser.__new__(BiaffineDependencyParser) for _ in range(2)]
+    for parser in parsers:
+        parser.args, parser.model = Config(device='cpu'), nn.Module()
+    args = {'map_method': 'muse', **{f'map_layer{i}': str(tmp_path / f"layer{i}.pt") for i in range(3)}}
+    mapper = parsers[0]._build_mapper(args)
+    assert isinstance(mapper, Muse)
+    assert parsers[1]._build_mapper({**args, 'map_layer0': os.path.relpath(args['map_layer0'])}) is mapper
+    torch.save(torch.eye(4), str(tmp_path / "other.pt"))
+    assert parsers[1]._build_mapper({**args, 'map_layer0': str(tmp_path / "other.pt")}) is not mapper
+
+
+def test_elmo_mix():
+    torch.manual_seed(1)
+    words, feats = torch.ones(2, 3, dtype=torch.long), torch.randn(2, 3, 3*1024)
+    arcs, rels = torch.zeros(2, 3, dtype=torch.long), torch.zeros(2, 3, dtype=torch.long)
+    mask = words.ne(0)
+    mask[:, 0] = False
+    kwargs = dict(n_words=10, n_feats=10, n_rels=3, feat='elmo', n_lstm_hidden=4, n_lstm_layers=1, n_mlp_arc=4, n_mlp_rel=4)
+    # the layers are concatenated by default
+    assert BiaffineDependencyModel(**kwargs).lstm.input_size == 3 * 1024
+    for n_elmo_proj, input_size in ((0, 1024), (16, 16)):
+        model = BiaffineDependencyModel(**kwargs, elmo_mix=True, n_elmo_proj=n_elmo_proj)
+        assert model.lstm.input_size == input_size
+        inputs = []
+        model.elmo_proj.register_forward_hook(lambda module, x, y: inputs.append(x[0]))
+        model.eval()(words, feats)
+        # the layers are mixed with equal weights at initialization
+        assert torch.allclose(inputs[0], feats.view(2, 3, 3, 1024).mean(2), atol=1e-6)
+        # the mixture weights are trained along with the model, which would get no gradients from zero biaffine layers
+        for attn in (model.arc_attn, model.rel_attn):
+            nn.init.normal_(attn.weight)
+        s_arc, s_rel = model.train()(words, feats)
+        model.loss(s_arc, s_rel, arcs, rels, mask).backward()
+        assert model.elmo_mix.weights.grad is not None and model.elmo_mix.weights.grad.ne(0).any()
+
+
+def test_elmogan(tmp_path, monkeypatch):
+    torch.manual_seed(1)
+
+    def keras(kind, **kwargs):
+        # a keras layer described by its class name and attributes
+        return type(kind, (SimpleNamespace,), {})(**kwargs)
+    W1, b1, W2 = torch.randn(8, 6), torch.randn(6), torch.randn(6, 8)
+    gamma, beta, mean, var = torch.rand(6) + .5, torch.randn(6), torch.randn(6), torch.rand(6) + .5
+    model = SimpleNamespace(outputs=[None], layers=[
+        keras('InputLayer'),
+        # the layers of nested models are flattened
+        SimpleNamespace(layers=[keras('Dense', kernel=W1, bias=b1, use_bias=True, activation=SimpleNamespace(__name__='relu')),
+                                keras('Dropout')]),
+        keras('BatchNormalization', moving_mean=mean, moving_variance=var, gamma=gamma, beta=beta,
+              scale=True, center=True, epsilon=1e-3),
+        keras('LeakyReLU', alpha=.2),
+        keras('Dense', kernel=W2, use_bias=False, activation=SimpleNamespace(__name__='linear'))])
+
+    def generator(x):
+        x = (x @ W1 + b1).relu()
+        x = (x - mean) / (var + 1e-3).sqrt() * gamma + beta
+        return torch.where(x > 0, x, x * .2) @ W2
+
+    for i in range(3):
+        elmogan_torch.save(str(tmp_path / f"layer{i}.pt"), *elmogan_torch.convert(model))
+    mapper = Elmogan({'map_direction': 0, **{f'map_layer{i}': str(tmp_path / f"layer{i}.pt") for i in range(3)}})
+    batch = [torch.randn(3, i, 8).numpy() for i in (4, 1, 6)]
+    for sentence, emb in zip(batch, mapper.map_batch([sentence.copy() for sentence in batch])):
+        assert np.allclose(emb, generator(torch.tensor(sentence)).numpy(), atol=1e-5)
+    with pytest.raises(ValueError):
+        elmogan_torch.convert(SimpleNamespace(outputs=[None], layers=[keras('Conv1D', name='conv')]))
+    with pytest.raises(ValueError):
+        elmogan_torch.convert(SimpleNamespace(outputs=[None], layers=[keras('Activation', name='act',
+                                                                            activation=SimpleNamespace(__name__='swish'))]))
+
+    # the keras models are only loaded through tensorflow if not exported
+    models = {'single.h5': SimpleNamespace(inputs=['x'], outputs=['xx->yy'])}
+
+    def load_model(path):
+        if path not in models:
+            raise OSError(f"Unable to open {path}")
+        return models[path]
+    keras_models = ModuleType('tensorflow.keras.models')
+    keras_models.load_model, keras_models.Model = load_model, lambda inputs, outputs: (inputs, outputs)
+    for name, module in (('tensorflow', ModuleType('tensorflow')), ('tensorflow.keras', ModuleType('tensorflow.keras')),
+                         ('tensorflow.keras.models', keras_models)):
+        monkeypatch.setitem(sys.modules, name, module)
+    models['double.h5'] = SimpleNamespace(inputs=['x', 'y'], outputs=['xx->yy', 'yy->xx'])
+    # only the output of the requested direction is kept, or the single one as a whole
+    assert mapper.load('double.h5') == (['x', 'y'], 'xx->yy')
+    assert mapper.load('single.h5') is models['single.h5']
+    # load errors are never hidden
+    with pytest.raises(OSError):
+        mapper.load('missing.h5')
+    with pytest.raises(FileNotFoundError):
+        mapper.load(str(tmp_path / 'missing.pt'))
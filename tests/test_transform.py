@@ -4,6 +4,7 @@ import itertools
 
 import nltk
 from supar.utils import CoNLL, Tree
+from supar.utils.transform import CoNLLCorpus, CoNLLIndex
 
 
 class TestCoNLL:
@@ -50,6 +51,58 @@ class TestCoNLL:
             assert CoNLL.istree(sequence, True, False) == self.istree_naive(sequence, True, False), f"{sequence}"
             assert CoNLL.istree(sequence, True, True) == self.istree_naive(sequence, True, True), f"{sequence}"
 
+    def test_stream(self, tmp_path):
+        path = str(tmp_path / 'data.conllx')
+        sentences = [['She', 'enjoys', 'playing', 'tennis', '.'], ['I', 'like', 'it'], ['Yes', '!']] * 3
+        with open(path, 'w') as f:
+            f.write('\n'.join(CoNLL.toconll(i) for i in sentences) + '\n')
+        transform = CoNLL()
+        loaded = [str(i) for i in transform.load(path)]
+        for size in (1, 2, 4, 9, 10):
+            windows = list(transform.stream(path, size))
+            assert all(len(window) <= size for window in windows)
+            assert [str(i) for window in windows for i in window] == loaded
+        assert [len(i) for window in transform.stream(path, 4, max_len=5) for i in window] == [3, 2] * 3
+
+    def test_split(self, tmp_path):
+        path = str(tmp_path / 'data.conllx')
+        sentences = [['She', 'enjoys', 'playing', 'tennis', '.'], ['I', 'like', 'it'], ['Yes', '!']] * 10
+        with open(path, 'w') as f:
+            f.write('\n'.join(CoNLL.toconll(i) for i in sentences) + '\n')
+        transform = CoNLL()
+        loaded = [str(i) for i in transform.load(path)]
+        for n in range(1, 40):
+            chunks = transform.split(path, n)
+            assert len(chunks) <= n
+            assert [str(i) for start, end in chunks for i in transform.read(path, start, end)] == loaded
+
+    def test_index(self, tmp_path):
+        path = str(tmp_path / 'data.conllx')
+        sentences = [['She', 'enjoys', 'playing', 'tennis', '.'], ['I', 'like', 'it'], ['Yes', '!']] * 10
+        with open(path, 'w') as f:
+            f.write('\n'.join(CoNLL.toconll(i) for i in sentences) + '\n')
+        transform = CoNLL()
+        loaded = [str(i) for i in transform.load(path)]
+        index = CoNLLIndex.load(path)
+        assert index.lengths.tolist() == [len(i) for i in sentences]
+        assert CoNLLIndex.load(path).offsets.tolist() == index.offsets.tolist()
+        indices = [29, 0, 3, 3]
+        assert [str(i) for i in transform.load(path, indices=indices)] == [loaded[i] for i in indices]
+        assert sorted(i for rank in range(4) for i in index.shard(rank, 4, True)) == list(range(len(sentences)))
+
+    def test_corpus(self, tmp_path):
+        path = str(tmp_path / 'data.conllx')
+        sentences = [['She', 'enjoys', 'playing', 'tennis', '.'], ['I', 'like', 'it'], ['Yes', '!']] * 3
+        with open(path, 'w') as f:
+            f.write('# comment\n' + '\n'.join(CoNLL.toconll(i) for i in sentences) + '\n')
+        transform = CoNLL()
+        loaded = transform.load(path)
+        corpus = transform.load(path, columnar=True)
+        assert isinstance(corpus, CoNLLCorpus)
+        assert [str(i) for i in corpus] == [str(i) for i in loaded]
+        assert [len(i) for i in corpus] == [len(i) for i in loaded]
+        assert len(transform.load(path, max_len=4, columnar=True)) == 6
+
 
 class TestTree:
 